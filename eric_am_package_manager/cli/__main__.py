@@ -16,21 +16,27 @@
 '''am-package-manager'''
 import os
 import sys
+import copy
+import tarfile
 import zipfile
 import argparse
 import logging
-import pathlib
-import tarfile
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import TemporaryDirectory
 
 from yaml import safe_load, dump, YAMLError
 
 from vnfsdk_pkgtools.packager import utils as packager_utils, csar
 
-from eric_am_package_manager.generator import generate, product_report, hash_utils, utils
+from eric_am_package_manager.generator import generate, product_report, hash_utils, utils, \
+    csar_writer, inventory, build_cache, docker_archive, image_exporter
 from eric_am_package_manager.generator.utils import CertificateInfo, get_general_licenses_path
 
 SIGNATURE_FILE_NAME = 'signature.csm'
+# Arguments not affecting the contents of the CSAR package
+CACHE_EXCLUDED_ARGS = ('build_cache', 'explain_cache', 'log', 'timeout', 'docker_config',
+                       'compress_threads', 'product_report', 'images_lock', 'refresh_lock',
+                       'layer_index', 'save_workers', 'export_workers', 'blob_cache', 'offline')
 SUPPORTED_HELM3_VERSIONS = ['3.4.2', '3.5.1', '3.6.3', '3.7.1', '3.8.1',
                             '3.8.2', '3.10.1', '3.10.3', '3.11.3',
                             '3.12.0', '3.13.0']
@@ -51,6 +57,29 @@ def __check_arguments(parser, args):
             parser.error('The name of both VNFD yaml file and manifest file must match.')
     check_pkg_option_arguments(args, parser)
 
+    if getattr(args, 'refresh_lock', False) and not args.images_lock:
+        parser.error('--refresh-lock requires --images-lock')
+    if getattr(args, 'explain_cache', False) and not args.build_cache:
+        parser.error('--explain-cache requires --build-cache')
+    if args.no_images and (args.delta_baseline or args.layer_index):
+        parser.error('--delta-baseline and --layer-index cannot be used with --no-images')
+    if args.delta_baseline and (args.pkgOption == '2' or args.certificate):
+        parser.error('--delta-baseline cannot be used with --pkgOption 2 or --certificate, '
+                     'the signature would not apply to the rebuilt CSAR')
+    if args.agentk and args.image_exporter not in (None, image_exporter.EXPORTER_AGENTK):
+        parser.error('--agentk cannot be used with --image-exporter ' + args.image_exporter)
+    if args.image_exporter == image_exporter.EXPORTER_OCI_LAYOUT and not (args.oci_layout or
+                                                                          args.blob_cache):
+        parser.error('--image-exporter oci-layout requires --oci-layout or --blob-cache')
+    if args.offline and not (args.oci_layout or args.blob_cache):
+        parser.error('--offline requires --oci-layout or --blob-cache')
+    if args.split_images and (args.images or args.no_images):
+        parser.error('--split-images cannot be used with --images or --no-images')
+    if args.split_images and (args.delta_baseline or args.layer_index):
+        parser.error('--split-images cannot be used with --delta-baseline or --layer-index')
+    if args.split_images == generate.SPLIT_IMAGES_SIZE and not args.split_size:
+        parser.error('--split-images size requires --split-size')
+
 
 def check_pkg_option_arguments(args, parser):
     """Check package option arguments
@@ -77,14 +106,8 @@ def __check_helm_arguments(parser, args):
         if not args.helm and not args.helm_dir:
             parser.error('--helm or --helm-dir is required')
 
-        if args.helm_dir:
-            helm_charts_exist = False
-            for _, _, files in os.walk(args.helm_dir):
-                for filename in files:
-                    if '.tgz' in filename:
-                        helm_charts_exist = True
-            if not helm_charts_exist:
-                parser.error('The specified directory does not contain any helm charts')
+        if args.helm_dir and not inventory.get_helm_dir_charts(args.helm_dir):
+            parser.error('The specified directory does not contain any helm charts')
 
 
 def __check_helmfile_arguments(parser, args):
@@ -97,13 +120,7 @@ def __check_helmfile_arguments(parser, args):
 
 def is_valid_helmfile(args):
     """Check if archive is a valid helmfile tgz."""
-    tgz_filename = pathlib.Path(args.helmfile[0])
-    with tarfile.open(tgz_filename, 'r:gz') as tgz:
-        for member in tgz.getmembers():
-            if member.isfile() and member.name.endswith('.yaml'):
-                if member.name.split("/")[-1] == 'helmfile.yaml':
-                    return True
-        return False
+    return inventory.get_archive(args.helmfile[0]).has_helmfile()
 
 
 def __check_values_csar_validity(parser, values_file):
@@ -188,7 +205,8 @@ def generate_option1(directory, args, vnfd):
 
     logging.debug('Csar args Option 1 %s', str(csar_args))
 
-    csar.write(directory, vnfd, filename, csar_args)
+    with csar_writer.csar_zip_policy(csar, csar_writer.CompressionPolicy.from_args(args)):
+        csar.write(directory, vnfd, filename, csar_args)
 
 
 def get_path_to_manifest(args, directory):
@@ -221,7 +239,8 @@ def generate_option2(directory, args, vnfd):
 
     logging.info('Csar args Option 2: %s', str(csar_args))
 
-    csar.write(directory, vnfd, filename, csar_args)
+    with csar_writer.csar_zip_policy(csar, csar_writer.CompressionPolicy.from_args(args)):
+        csar.write(directory, vnfd, filename, csar_args)
 
     write_signature_for_option2(args, filename)
 
@@ -243,8 +262,9 @@ def write_signature_for_option2(args, filename):
     if os.path.isfile(destination):
         logging.info('Deleting pre-existing csar file with the name: %s', destination)
         os.remove(destination)
-    logging.debug('Compressing to make Option 2 csar')
-    with zipfile.ZipFile(destination, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as file:
+    logging.debug('Archiving to make Option 2 csar')
+    # The CSAR is already compressed, it is stored in the Option 2 archive as-is
+    with zipfile.ZipFile(destination, 'w', zipfile.ZIP_STORED, allowZip64=True) as file:
         cert_file_full_path = os.path.abspath(args.certificate)
 
         logging.debug('Writing to archive: %s', cert_file_full_path)
@@ -269,34 +289,109 @@ def generate_func(args):
 
     :param args: Command line arguments
     """
-    with TemporaryDirectory(dir='.') as tempdir:
+    cache = None
+    if getattr(args, 'build_cache', None):
+        cache = build_cache.BuildCache(args.build_cache, args.explain_cache)
+
+    with TemporaryDirectory(dir='.') as tempdir, ThreadPoolExecutor(max_workers=2) as executor:
+        chart_images = None
+        if args.images and not args.skip_images_check:
+            # Collect the images of the charts while the CSAR content is staged
+            chart_images = executor.submit(generate.get_images, args)
+
         generate.create_source(tempdir, args)
         vnfd_path = generate.get_vnfd(tempdir, args)
 
+        report = None
+        if args.product_report:
+            # Only the validation against the exported images waits for the export
+            report = executor.submit(product_report.collect_directory_product_report,
+                                     args, tempdir)
+
         if args.no_images:
             logging.info('Lightweight CSAR requested, skipping docker.tar file generation')
             generate.empty_images_section(tempdir)
         elif args.images:
             logging.info('docker.tar file has been passed in, skipping docker.tar file generation')
             docker_file = generate.create_docker_tar_link(tempdir, args.images)
+            if chart_images is not None:
+                generate.verify_docker_tar_images(docker_file, chart_images.result())
             generate.create_images_section(tempdir, docker_file)
+            if args.delta_baseline or args.layer_index:
+                generate.create_delta(args, docker_file)
         else:
             logging.info('Generating the docker.tar file')
-            docker_file = generate.create_docker_tar(tempdir, args)
+            docker_file = generate.create_docker_tar(
+                tempdir, args, get_docker_tar_hash_algorithms(tempdir, vnfd_path), cache)
             generate.create_images_section(tempdir, docker_file)
             generate_hash_for_docker_tar(tempdir, vnfd_path, docker_file)
+            if args.delta_baseline or args.layer_index:
+                generate.create_delta(args, docker_file)
 
-        if args.pkgOption == '2':
-            generate_option2(tempdir, args, vnfd_path)
-        else:
-            generate_option1(tempdir, args, vnfd_path)
+        write_csar(tempdir, args, vnfd_path, cache)
 
-    if args.product_report:
-        try:
-            product_report.csar_product_report(args)
-        except product_report.ProductReportError as exc:
-            logging.error(exc)
-            sys.exit(1)
+        if report is not None:
+            try:
+                product_report.write_directory_product_report(args, tempdir,
+                                                              report.result())
+            except product_report.ProductReportError as exc:
+                logging.error(exc)
+                sys.exit(1)
+
+
+def rebuild_func(args):
+    """Rebuild command
+
+    :param args: Command line arguments
+    """
+    filename = create_filename(args)
+    try:
+        docker_archive.rebuild_csar(args.baseline, args.delta, filename)
+    except (docker_archive.DockerArchiveError, zipfile.BadZipFile, tarfile.TarError) as exc:
+        logging.error('Failed to rebuild %s: %s', filename, exc)
+        if os.path.exists(filename):
+            os.remove(filename)
+        sys.exit(1)
+
+
+def write_csar(directory, args, vnfd_path, cache=None):
+    """Write the CSAR package of the staged directory
+
+    :param directory: CSAR packaging directory
+    :param args: Command line arguments
+    :param vnfd_path: Path to VNFD file
+    :param cache: BuildCache object reusing the package of the previous build, optional
+    """
+    outputs = get_csar_outputs(args)
+    inputs = None
+    if cache is not None:
+        inputs = build_cache.get_tree_inputs(directory)
+        inputs.update(build_cache.get_args_inputs(args, exclude=CACHE_EXCLUDED_ARGS))
+        if cache.get('csar', inputs) is not None:
+            for output in outputs:
+                cache.restore('csar', output, output)
+            return
+
+    if args.pkgOption == '2':
+        generate_option2(directory, args, vnfd_path)
+    else:
+        generate_option1(directory, args, vnfd_path)
+
+    if cache is not None:
+        cache.put('csar', inputs, data={'outputs': outputs},
+                  files={output: output for output in outputs})
+
+
+def get_csar_outputs(args):
+    """Get the files written for the CSAR package
+
+    :param args: Command line arguments
+    :return: List of file names in the working directory
+    """
+    if args.pkgOption == '2':
+        signature_name = os.path.basename(str(args.certificate)).rsplit('.', 1)[0] + '.cms'
+        return [f'{args.name}.zip', signature_name]
+    return [f'{args.name}.csar']
 
 
 def generate_hash_for_docker_tar(directory, vnfd_path, docker_file):
@@ -323,6 +418,25 @@ def generate_hash_for_docker_tar(directory, vnfd_path, docker_file):
             logging.exception('Failed to fill hash values for docker.tar artifact')
 
 
+def get_docker_tar_hash_algorithms(directory, vnfd_path):
+    """Get hash algorithms of the software_images artifacts in VNFD
+
+    :param directory: CSAR packaging directory
+    :param vnfd_path: Path to VNFD file
+    :return: Set of hash algorithms, e.g. sha-256
+    """
+    algorithms = set()
+    try:
+        with open(os.path.join(directory, vnfd_path), encoding='utf-8') as values_file:
+            vnfd_dict = safe_load(values_file)
+        for node_type in vnfd_dict['node_types'].values():
+            checksum = node_type['artifacts']['software_images']['properties']['checksum']
+            algorithms.add(checksum.get('algorithm'))
+    except (IOError, YAMLError, KeyError, TypeError, AttributeError):
+        logging.debug('No software_images checksums in %s', vnfd_path)
+    return algorithms & set(hash_utils.HASH)
+
+
 def calculate_and_write_hash_for_docker_tar(vnfd_dict, docker_file):
     """Calculate hash for Docker tar file
 
@@ -360,6 +474,28 @@ def calculate_and_write_hash_for_docker_tar(vnfd_dict, docker_file):
         checksum_hash = hash_utils.HASH[hash_algorithm](docker_file)
         checksum['hash'] = checksum_hash
 
+        add_split_image_artifacts(node_type['artifacts'], docker_file)
+
+
+def add_split_image_artifacts(artifacts, docker_file):
+    """Add a software_images artifact for each archive split from the Docker tar
+
+    The artifact of docker-<partition>.tar is software_images_<partition>,
+    a copy of the software_images artifact with the path and checksum of the archive.
+
+    :param artifacts: Artifacts of a VNFD node type
+    :param docker_file: Docker tar file
+    """
+    stem = os.path.splitext(os.path.basename(docker_file))[0]
+    for archive in generate.get_image_archives(docker_file)[1:]:
+        partition = os.path.splitext(os.path.basename(archive))[0][len(stem) + 1:]
+        artifact = copy.deepcopy(artifacts['software_images'])
+        artifact['file'] = os.path.join(os.path.dirname(artifact.get('file', 'Files/images/')),
+                                        os.path.basename(archive))
+        checksum = artifact['properties']['checksum']
+        checksum['hash'] = hash_utils.HASH[checksum['algorithm']](archive)
+        artifacts[f'software_images_{partition}'] = artifact
+
 
 def parse_args(args_list):
     """
@@ -368,7 +504,7 @@ def parse_args(args_list):
 
     parser = argparse.ArgumentParser(description='CSAR File Utilities')
 
-    subparsers = parser.add_subparsers(help='generate')
+    subparsers = parser.add_subparsers(help='generate, rebuild')
     generate_parser = subparsers.add_parser('generate')
     generate_parser.set_defaults(func=generate_func)
     generate_parser.add_argument(
@@ -525,11 +661,72 @@ def parse_args(args_list):
              'exported from the Helm chart',
         default=None
     )
+    generate_parser.add_argument(
+        '--skip-images-check',
+        help='Skip the verification of the images in the file given with --images '
+             'against the images referenced by the Helm charts',
+        action='store_true'
+    )
     generate_parser.add_argument(
         '--no-images',
         help='Flag to skip generation of the docker.tar file',
         action='store_true'
     )
+    generate_parser.add_argument(
+        '--compression',
+        help='Compression of the CSAR members not stored by other rules. deflate compresses '
+             'all of them, auto stores the ones which do not compress in a sample. '
+             'Set to deflate by default',
+        choices=[csar_writer.COMPRESSION_DEFLATE, csar_writer.COMPRESSION_AUTO],
+        default=csar_writer.COMPRESSION_DEFLATE
+    )
+    generate_parser.add_argument(
+        '--store-extensions',
+        help='File extensions of CSAR members to store without compression, e.g. .tgz .tar',
+        nargs='*',
+        default=[]
+    )
+    generate_parser.add_argument(
+        '--store-size',
+        help='Size in MB from which CSAR members are stored without compression',
+        type=int
+    )
+    generate_parser.add_argument(
+        '--compress-level',
+        help='Deflate compression level of the CSAR members, from 1 (fastest) to 9 (smallest)',
+        type=int,
+        choices=range(1, 10)
+    )
+    generate_parser.add_argument(
+        '--compress-threads',
+        help='Number of threads deflating large CSAR members. Set to 1 by default',
+        type=utils.positive_int,
+        default=1
+    )
+    generate_parser.add_argument(
+        '--save-workers',
+        help='Number of docker save commands saving disjoint sets of the images concurrently, '
+             'merged into one docker.tar. Set to 1 by default',
+        type=utils.positive_int,
+        default=1
+    )
+    generate_parser.add_argument(
+        '--reproducible',
+        action='store_true',
+        default=False,
+        help='Write the same CSAR bytes for the same inputs: sorted members with the '
+             'timestamp of --source-date-epoch, normalized permissions and a docker.tar '
+             'with deterministic layout'
+    )
+    generate_parser.add_argument(
+        '--source-date-epoch',
+        action=utils.EnvDefault,
+        variable='SOURCE_DATE_EPOCH',
+        required=False,
+        type=int,
+        help='Timestamp of the files of a --reproducible build in seconds since the epoch, '
+             'read from SOURCE_DATE_EPOCH if not given. Set to 1980-01-01 by default'
+    )
     generate_parser.add_argument(
         '--pkgOption',
         help='To generate signed VNF package, 1 for Option1 and 2 for Option2. '
@@ -577,6 +774,93 @@ def parse_args(args_list):
         default=False,
         help='Enable Agent K'
     )
+    generate_parser.add_argument(
+        '--image-exporter',
+        choices=image_exporter.get_exporter_names(),
+        help='How the images are exported to docker.tar: docker pulls and saves them with the '
+             'Docker daemon (default), agent-k is the same as --agentk, registry downloads '
+             'them from the registries with --docker-config and oci-layout reads them only from '
+             'the --oci-layout and --blob-cache directories'
+    )
+    generate_parser.add_argument(
+        '--oci-layout',
+        type=utils.valid_directory,
+        help='OCI image layout directories the images are read from before any network access. '
+             'Used by all image exporters',
+        nargs='*'
+    )
+    generate_parser.add_argument(
+        '--blob-cache',
+        help='OCI image layout directory, created if missing, caching the manifests and blobs '
+             'downloaded by --image-exporter registry. Read like --oci-layout'
+    )
+    generate_parser.add_argument(
+        '--offline',
+        action='store_true',
+        default=False,
+        help='Fail instead of accessing the registries if an image is not found from the '
+             '--oci-layout and --blob-cache directories'
+    )
+    generate_parser.add_argument(
+        '--export-workers',
+        help='Number of images pulled or downloaded concurrently. '
+             'Set to the number of CPUs by default',
+        type=utils.positive_int
+    )
+    generate_parser.add_argument(
+        '--collapse-tags',
+        action='store_true',
+        default=False,
+        help='Resolve image tags to digests in the registry and pull the images '
+             'with several tags once'
+    )
+    generate_parser.add_argument(
+        '--images-lock',
+        help='Path to an images lock file pinning the images of the charts to digests. '
+             'Written if it does not exist, image discovery is skipped if the charts '
+             'have not changed and images are pulled by digest'
+    )
+    generate_parser.add_argument(
+        '--refresh-lock',
+        action='store_true',
+        default=False,
+        help='Update the images of the changed charts in the --images-lock file'
+    )
+    generate_parser.add_argument(
+        '--build-cache',
+        help='Directory caching the outputs of the build stages. The images, docker.tar and '
+             'CSAR of the previous build are reused if the inputs of the stage have not changed'
+    )
+    generate_parser.add_argument(
+        '--explain-cache',
+        action='store_true',
+        default=False,
+        help='Log why each build stage is rerun or reused from --build-cache'
+    )
+    generate_parser.add_argument(
+        '--split-images',
+        choices=[generate.SPLIT_IMAGES_CHART, generate.SPLIT_IMAGES_SIZE],
+        help='Write the images to an archive per chart or per --split-size under Files/images '
+             'instead of one docker.tar. Layers shared by several archives are written to '
+             'docker.tar'
+    )
+    generate_parser.add_argument(
+        '--split-size',
+        help='Size in MB of the image archives of --split-images size',
+        type=utils.positive_int
+    )
+    generate_parser.add_argument(
+        '--delta-baseline',
+        type=utils.valid_file,
+        help='Previous CSAR or its --layer-index file. The CSAR is written as a delta '
+             'carrying only the docker.tar layers missing from the baseline, '
+             'see the rebuild command'
+    )
+    generate_parser.add_argument(
+        '--layer-index',
+        help='Path to write the layer index of the generated docker.tar to, '
+             'usable as --delta-baseline of the next release'
+    )
     generate_parser.add_argument(
         '--disable-helm-template',
         action='store_true',
@@ -584,6 +868,14 @@ def parse_args(args_list):
         help='Disable Helm template usage. Prints out a warning if '
              'for successful operation would be needed.'
     )
+    generate_parser.add_argument(
+        '--image-discovery',
+        choices=[generate.IMAGE_DISCOVERY_HELM_TEMPLATE, generate.IMAGE_DISCOVERY_VALUES],
+        default=generate.IMAGE_DISCOVERY_HELM_TEMPLATE,
+        help='How images of the Helm charts are found. helm-template (default) renders '
+             'the charts with Helm, values reads eric-product-info.yaml and values.yaml '
+             'with --values and --set overrides without Helm'
+    )
     generate_parser.add_argument(
         '--eric-product-info-charts',
         type=utils.valid_file,
@@ -597,8 +889,36 @@ def parse_args(args_list):
         help='Extract CRDs from Helm charts to be packaged separately.'
     )
 
+    rebuild_parser = subparsers.add_parser('rebuild')
+    rebuild_parser.set_defaults(func=rebuild_func)
+    rebuild_parser.add_argument(
+        '--baseline',
+        type=utils.valid_file,
+        help='The CSAR the delta was generated against',
+        required=True
+    )
+    rebuild_parser.add_argument(
+        '--delta',
+        type=utils.valid_file,
+        help='The delta CSAR generated with --delta-baseline',
+        required=True
+    )
+    rebuild_parser.add_argument(
+        '-n',
+        '--name',
+        help='The name to give the rebuilt CSAR file',
+        required=True
+    )
+    rebuild_parser.add_argument(
+        '-l',
+        '--log',
+        help='Change the logging level for this execution, default is INFO',
+        default='INFO'
+    )
+
     args = parser.parse_args(args_list)
-    __check_arguments(parser, args)
+    if getattr(args, 'func', None) is generate_func:
+        __check_arguments(parser, args)
     return args
 
 
@@ -23,7 +23,7 @@ import logging
 from eric_am_package_manager.generator.product_report import helm_product_report, \
     csar_product_report, \
     ProductReportError
-from eric_am_package_manager.generator.utils import valid_file
+from eric_am_package_manager.generator.utils import valid_file, positive_int
 from .__main__ import SUPPORTED_HELM3_VERSIONS
 
 DEFAULT_LOG_FORMAT = '[%(levelname)s] %(message)s'
@@ -83,6 +83,12 @@ def main():
                 DR-D1121-067 (eric_product_info.yaml) is not supported''',
         required=False
     )
+    common_parser.add_argument(
+        '--jobs',
+        help='Number of Helm charts processed in parallel. Set to 1 by default',
+        type=positive_int,
+        default=1
+    )
     subparsers = parser.add_subparsers(
         description='Parse product report from a Helm chart',
         dest='command'
@@ -0,0 +1,190 @@
+# ******************************************************************************
+# COPYRIGHT Ericsson 2024
+#
+#
+#
+# The copyright to the computer program(s) herein is the property of
+#
+# Ericsson Inc. The programs may be used and/or copied only with written
+#
+# permission from Ericsson Inc. or in accordance with the terms and
+#
+# conditions stipulated in the agreement/contract under which the
+#
+# program(s) have been supplied.
+# ******************************************************************************
+"""Build cache reusing the outputs of unchanged CSAR build stages"""
+
+import os
+import json
+import shutil
+import logging
+
+from . import hash_utils
+
+ENTRY_FILENAME = 'entry.json'
+# Maximum number of changed inputs listed when explaining a rerun
+EXPLAIN_LIMIT = 10
+
+
+class BuildCache:
+    """Outputs of the previous build of each stage
+
+    A stage is identified by a name and its inputs by a dictionary of
+    input names and fingerprints. The outputs of a stage are reused if its
+    inputs are the same as in the previous build, only the latest build of
+    each stage is kept.
+    """
+
+    def __init__(self, directory, explain=False):
+        """Object initialization
+
+        :param directory: Cache directory
+        :param explain: Log why each stage is rerun or reused on info level
+        """
+        self.directory = directory
+        self.explain = explain
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, stage, inputs):
+        """Get the data of the previous build of a stage with the same inputs
+
+        :param stage: Stage name
+        :param inputs: Dictionary of input names and fingerprints
+        :return: Stage data, None if the stage must be rerun
+        """
+        entry = self._load(stage)
+        if entry is None:
+            self._explain('Stage %s rerun: no previous build', stage)
+            return None
+
+        changed = get_changed_inputs(entry['inputs'], inputs)
+        if changed:
+            if len(changed) > EXPLAIN_LIMIT:
+                changed = changed[:EXPLAIN_LIMIT] + [f'{len(changed) - EXPLAIN_LIMIT} more']
+            self._explain('Stage %s rerun: %s', stage, ', '.join(changed))
+            return None
+
+        self._explain('Stage %s reused: inputs unchanged', stage)
+        return entry['data']
+
+    def skip(self, stage, reason):
+        """Rerun a stage without using or updating the cache
+
+        :param stage: Stage name
+        :param reason: Why the inputs of the stage cannot be fingerprinted
+        """
+        self._explain('Stage %s rerun: %s', stage, reason)
+
+    def restore(self, stage, name, destination):
+        """Link or copy an output file of the previous build of a stage
+
+        :param stage: Stage name
+        :param name: Name of the output file
+        :param destination: Path to restore the file to
+        """
+        if os.path.lexists(destination):
+            os.remove(destination)
+        link_or_copy(os.path.join(self.directory, stage, name), destination)
+
+    def put(self, stage, inputs, data=None, files=None):
+        """Store the build of a stage replacing the previous build
+
+        :param stage: Stage name
+        :param inputs: Dictionary of input names and fingerprints
+        :param data: JSON serializable stage data
+        :param files: Dictionary of output file paths by name
+        """
+        stage_dir = os.path.join(self.directory, stage)
+        temp_dir = f'{stage_dir}.tmp'
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        os.makedirs(temp_dir)
+
+        for name, path in (files or {}).items():
+            link_or_copy(path, os.path.join(temp_dir, name))
+        with open(os.path.join(temp_dir, ENTRY_FILENAME), 'w', encoding='utf-8') as entry:
+            json.dump({'inputs': inputs, 'data': data}, entry, indent=2, sort_keys=True)
+
+        shutil.rmtree(stage_dir, ignore_errors=True)
+        os.rename(temp_dir, stage_dir)
+        logging.debug('Stored stage %s to build cache %s', stage, self.directory)
+
+    def _load(self, stage):
+        try:
+            with open(os.path.join(self.directory, stage, ENTRY_FILENAME), 'r',
+                      encoding='utf-8') as entry:
+                return json.load(entry)
+        except (OSError, ValueError):
+            return None
+
+    def _explain(self, message, *args):
+        logging.log(logging.INFO if self.explain else logging.DEBUG,
+                    'Build cache: ' + message, *args)
+
+
+def get_changed_inputs(previous, current):
+    """Describe the differences of stage inputs
+
+    :param previous: Dictionary of input names and fingerprints of the previous build
+    :param current: Dictionary of input names and fingerprints of this build
+    :return: List of descriptions, empty if the inputs are the same
+
+    >>> get_changed_inputs({'a': '1', 'b': '1'}, {'a': '2', 'c': '1'})
+    ['a changed', 'b removed', 'c added']
+    """
+    changed = []
+    for name in sorted(set(previous) | set(current)):
+        if name not in current:
+            changed.append(f'{name} removed')
+        elif name not in previous:
+            changed.append(f'{name} added')
+        elif previous[name] != current[name]:
+            changed.append(f'{name} changed')
+    return changed
+
+
+def get_tree_inputs(directory):
+    """Fingerprint the files of a directory tree
+
+    :param directory: Directory
+    :return: Dictionary of SHA-256 digests by relative file path
+    """
+    inputs = {}
+    for root, _, files in os.walk(directory):
+        for filename in files:
+            path = os.path.join(root, filename)
+            inputs[f'file {os.path.relpath(path, directory)}'] = hash_utils.sha256(path)
+    return inputs
+
+
+def get_args_inputs(args, exclude=()):
+    """Fingerprint command line arguments
+
+    Arguments naming existing files are fingerprinted by the file contents.
+
+    :param args: Command line arguments
+    :param exclude: Names of the arguments to leave out
+    :return: Dictionary of fingerprints by argument name
+    """
+    inputs = {}
+    for name, value in sorted(vars(args).items()):
+        if name in exclude or callable(value):
+            continue
+        values = value if isinstance(value, list) else [value]
+        inputs[f'argument {name}'] = json.dumps(
+            [f'sha256:{hash_utils.sha256(item)}'
+             if isinstance(item, str) and os.path.isfile(item) else str(item)
+             for item in values])
+    return inputs
+
+
+def link_or_copy(source, destination):
+    """Hard link a file, copy it if linking is not possible
+
+    :param source: Source file
+    :param destination: Destination path
+    """
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
@@ -18,8 +18,12 @@ import os
 import shutil
 import logging
 import re
+import tarfile
+from collections import defaultdict
 from pathlib import Path
 
+from . import inventory
+
 
 COMPONENT_PATTERN = r'(.*)-([0-9]+.[0-9]+.[0-9]+(?:[+-][0-9]+)?)'
 VERSION_PATTERN = r'[+-.]'
@@ -50,50 +54,148 @@ def parse_filename(file):
     return component, version
 
 
-def copy_crd(filepath, destination):
-    """Copy or replace file in destination directory leaving the newer version
+def get_version_key(version):
+    """Get sort key of a parsed version comparing the parts as numbers
 
-    :param filepath: Path of the file to copy
-    :param destination: Destination to copy to
-    """
-    component, version = parse_filename(filepath)
+    :param version: List of version parts from parse_filename
+    :return Tuple of integers
 
-    if not component or not version:
-        logging.warning("Failed to copy CRD '%s'", filepath.name)
-        return
+    >>> get_version_key(['1', '10', '0']) > get_version_key(['1', '9', '0'])
+    True
+    >>> get_version_key(['1', '2', '3', '1']) > get_version_key(['1', '2', '3'])
+    True
+    """
+    return tuple(int(part) for part in version)
 
-    existing = next(destination.glob(f"{component}*"), None)
 
-    if not existing:
-        shutil.copy2(filepath, destination)
-        return
+class CrdIndex:
+    """Index of the newest CRD package of each component
 
-    oldcomponent, oldversion = parse_filename(existing)
-    if oldversion >= version:
-        logging.debug('Newer or equal version already exists for "%s"', oldcomponent)
-        return
+    The CRD packages of all charts are added first and only the newest version
+    of each component is copied to the destination once. Of equal versions the
+    package added first is kept.
+    """
 
-    logging.info('Replacing old version of "%s"', oldcomponent)
-    os.unlink(existing)
-    shutil.copy2(filepath, destination)
+    def __init__(self):
+        """Object initialization"""
+        # Component name mapped to version key, file name and source
+        self.crds = {}
+
+    def add(self, name, source):
+        """Add a CRD package
+
+        :param name: File name of the package
+        :param source: Path of the package or tuple of chart archive path and member name
+        :return True if the package is the newest of its component so far
+        """
+        component, version = parse_filename(Path(name))
+
+        if not component or not version:
+            logging.warning("Failed to copy CRD '%s'", name)
+            return False
+
+        key = get_version_key(version)
+        existing = self.crds.get(component)
+        if existing is not None:
+            if existing[0] >= key:
+                logging.debug('Newer or equal version already exists for "%s"', component)
+                return False
+            logging.info('Replacing old version of "%s"', component)
+
+        self.crds[component] = key, name, source
+        return True
+
+    def add_existing(self, destination):
+        """Add the packages already in the destination directory
+
+        :param destination: Destination directory of write
+        """
+        for existing in sorted(filter(Path.is_file, Path(destination).iterdir())):
+            self.add(existing.name, existing)
+
+    def add_directory(self, helm_dir):
+        """Add the CRD packages of an extracted Helm chart and its unpacked subcharts
+
+        :param helm_dir: Path of the extracted Helm chart
+        """
+        crd_dir = Path(helm_dir, "eric-crd")
+        charts_dir = Path(helm_dir, "charts")
+
+        if crd_dir.is_dir():
+            for crd in sorted(filter(Path.is_file, crd_dir.iterdir())):
+                logging.info('Extracting CRD "%s" from chart "%s"',
+                             crd.name,
+                             Path(helm_dir).name)
+                self.add(crd.name, crd)
+
+        if charts_dir.is_dir():
+            for helm in sorted(filter(Path.is_dir, charts_dir.iterdir())):
+                self.add_directory(helm)
+
+    def add_archive(self, chart):
+        """Add the CRD packages of a Helm chart archive and its unpacked subcharts
+
+        Only the member headers of the archive are read.
+
+        :param chart: Path of the Helm chart archive
+        """
+        for member in inventory.get_archive(chart).get_members():
+            if member.isfile() and inventory.CRD_MEMBER_PATTERN.fullmatch(member.name):
+                name = member.name.rsplit('/', 1)[-1]
+                logging.info('Extracting CRD "%s" from chart "%s"',
+                             name,
+                             os.path.basename(chart))
+                self.add(name, (chart, member.name))
+
+    def write(self, destination):
+        """Link or copy the newest CRD packages to a directory
+
+        Packages in the destination which are not the newest of their component
+        are removed. Each chart archive is read once for all its packages.
+
+        :param destination: Destination directory
+        """
+        destination = Path(destination)
+        members = defaultdict(dict)
+
+        for _, name, source in self.crds.values():
+            target = destination / name
+            if isinstance(source, tuple):
+                chart, member_name = source
+                members[chart][member_name] = target
+            elif source != target:
+                try:
+                    os.link(source, target)
+                except OSError:
+                    shutil.copy2(source, target)
+
+        for existing in filter(Path.is_file, destination.iterdir()):
+            component, _ = parse_filename(existing)
+            if component in self.crds and self.crds[component][1] != existing.name:
+                os.unlink(existing)
+
+        for chart, targets in members.items():
+            with tarfile.open(chart, 'r:*') as tar:
+                for member in tar:
+                    target = targets.pop(member.name, None)
+                    if target is None:
+                        continue
+                    with tar.extractfile(member) as source, open(target, 'wb') as file:
+                        shutil.copyfileobj(source, file)
+                    os.utime(target, (member.mtime, member.mtime))
+                    if not targets:
+                        break
 
 
 def extract_crds(helm_dir, destination):
     """Extract CRDs from Helm chart to given directory
 
+    Packages already in the destination are replaced only by newer versions.
+
     :param helm_dir: Path of the extracted Helm chart
     :param destination: Destination to copy to
     """
-    crd_dir = Path(helm_dir, "eric-crd")
-    charts_dir = Path(helm_dir, "charts")
-
-    if crd_dir.is_dir():
-        for crd in filter(Path.is_file, crd_dir.iterdir()):
-            logging.info('Extracting CRD "%s" from chart "%s"',
-                         crd.name,
-                         helm_dir.name)
-            copy_crd(crd, destination)
-
-    if os.path.isdir(charts_dir):
-        for helm in filter(Path.is_dir, charts_dir.iterdir()):
-            extract_crds(Path(charts_dir, helm), destination)
+    crds = CrdIndex()
+    crds.add_existing(destination)
+    crds.add_directory(helm_dir)
+    crds.write(destination)
@@ -0,0 +1,360 @@
+# ******************************************************************************
+# COPYRIGHT Ericsson 2024
+#
+#
+#
+# The copyright to the computer program(s) herein is the property of
+#
+# Ericsson Inc. The programs may be used and/or copied only with written
+#
+# permission from Ericsson Inc. or in accordance with the terms and
+#
+# conditions stipulated in the agreement/contract under which the
+#
+# program(s) have been supplied.
+# ******************************************************************************
+"""CSAR zip writer"""
+
+import os
+import stat
+import time
+import types
+import zlib
+import shutil
+import logging
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from .utils import get_source_date_epoch
+
+COMPRESSION_DEFLATE = 'deflate'
+COMPRESSION_AUTO = 'auto'
+
+# Members deflated to more than this share of their size in the sample are stored
+AUTO_STORE_RATIO = 0.95
+_SAMPLE_SIZE = 256 * 1024
+_SAMPLE_COUNT = 4
+
+# Members smaller than this are deflated on a single thread
+PARALLEL_MIN_SIZE = 16 * 1024 * 1024
+PARALLEL_BLOCK_SIZE = 1024 * 1024
+# Size of the deflate window primed from the end of the previous block
+_DICTIONARY_SIZE = 32 * 1024
+
+# Earliest modification time a zip member can have, 1980-01-01
+ZIP_EPOCH = 315532800
+
+
+class CompressionPolicy:
+    """Per member compression policy of the CSAR zip"""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, compression=COMPRESSION_DEFLATE, store_extensions=(),
+                 store_size=None, compresslevel=None, threads=1, mtime=None):
+        """Object initialization
+
+        :param compression: deflate to deflate all members not stored by other rules,
+            auto to store members which do not compress in a sample
+        :param store_extensions: File extensions of members to store without compression
+        :param store_size: Size in bytes from which members are stored without compression
+        :param compresslevel: Deflate compression level, zlib default if not given
+        :param threads: Number of threads deflating large members, defaults to 1
+        :param mtime: Modification time of all members in seconds since the epoch for
+            a reproducible archive, members also get normalized permissions and are
+            written in sorted order. File times are used if not given.
+        """
+        self.compression = compression
+        self.store_extensions = tuple(ext.lower() for ext in store_extensions or ())
+        self.store_size = store_size
+        self.compresslevel = compresslevel
+        self.threads = threads
+        self.mtime = mtime
+
+    @classmethod
+    def from_args(cls, args):
+        """Create policy from command line arguments
+
+        :param args: Command line arguments
+        :return: CompressionPolicy object
+        """
+        store_size = args.store_size * 1024 * 1024 if args.store_size is not None else None
+        return cls(compression=args.compression,
+                   store_extensions=args.store_extensions,
+                   store_size=store_size,
+                   compresslevel=args.compress_level,
+                   threads=args.compress_threads,
+                   mtime=get_source_date_epoch(args))
+
+    def select(self, filename):
+        """Select compression for a file
+
+        :param filename: Path of the file to write
+        :return: Tuple of zipfile compression type and compression level
+        """
+        size = os.path.getsize(filename)
+
+        if str(filename).lower().endswith(self.store_extensions):
+            reason = 'extension'
+        elif self.store_size is not None and size >= self.store_size:
+            reason = 'size'
+        elif self.compression == COMPRESSION_AUTO and not self.is_compressible(filename, size):
+            reason = 'sampled ratio'
+        else:
+            return zipfile.ZIP_DEFLATED, self.compresslevel
+
+        logging.debug('Storing %s without compression based on %s', filename, reason)
+        return zipfile.ZIP_STORED, None
+
+    def normalize(self, zinfo):
+        """Give a member the policy modification time and normalized permissions
+
+        :param zinfo: ZipInfo object
+        :return: The same ZipInfo object
+        """
+        if self.mtime is None:
+            return zinfo
+
+        zinfo.date_time = time.gmtime(max(self.mtime, ZIP_EPOCH))[:6]
+        zinfo.create_system = 3
+        if zinfo.is_dir():
+            zinfo.external_attr = (stat.S_IFDIR | 0o755) << 16 | 0x10
+        else:
+            mode = 0o755 if (zinfo.external_attr >> 16) & 0o111 else 0o644
+            zinfo.external_attr = (stat.S_IFREG | mode) << 16
+        return zinfo
+
+    def is_compressible(self, filename, size):
+        """Estimate compression ratio of a file from evenly spread samples
+
+        :param filename: Path of the file
+        :param size: Size of the file
+        :return: True if deflating the samples saves enough space
+        """
+        if size == 0:
+            return True
+
+        raw_size = 0
+        compressed_size = 0
+        step = max(size // _SAMPLE_COUNT, _SAMPLE_SIZE)
+
+        with open(filename, 'rb') as file:
+            for offset in range(0, size, step):
+                file.seek(offset)
+                sample = file.read(_SAMPLE_SIZE)
+                raw_size += len(sample)
+                compressed_size += len(zlib.compress(sample, 1))
+
+        ratio = compressed_size / raw_size
+        logging.debug('Sampled compression ratio of %s is %.2f', filename, ratio)
+        return ratio < AUTO_STORE_RATIO
+
+
+class ParallelCompressor:
+    """Deflate compressor compressing blocks of the data on a thread pool
+
+    Each block is compressed separately with the end of the previous block as
+    the preset dictionary and ended with a sync flush, so the concatenated
+    blocks form a single raw deflate stream as in pigz. zlib releases the GIL
+    while compressing, so the blocks are compressed in parallel.
+    The object has the compress() and flush() interface of zlib compressobj.
+    """
+
+    def __init__(self, executor, threads, compresslevel=None, block_size=PARALLEL_BLOCK_SIZE):
+        """Object initialization
+
+        :param executor: Executor compressing the blocks
+        :param threads: Number of threads in the executor
+        :param compresslevel: Deflate compression level, zlib default if not given
+        :param block_size: Size of the uncompressed blocks
+        """
+        self.executor = executor
+        self.max_pending = 2 * threads
+        self.compresslevel = zlib.Z_DEFAULT_COMPRESSION if compresslevel is None \
+            else compresslevel
+        self.block_size = block_size
+        self._buffer = bytearray()
+        self._dictionary = b''
+        self._pending = deque()
+
+    def compress(self, data):
+        """Add data to compress
+
+        :param data: Uncompressed bytes
+        :return: Compressed bytes of the blocks already finished
+        """
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block, last=False)
+
+        output = []
+        while self._pending and (self._pending[0].done() or
+                                 len(self._pending) > self.max_pending):
+            output.append(self._pending.popleft().result())
+        return b''.join(output)
+
+    def flush(self):
+        """Finish the deflate stream
+
+        :return: Remaining compressed bytes
+        """
+        self._submit(bytes(self._buffer), last=True)
+        self._buffer = bytearray()
+        output = b''.join(future.result() for future in self._pending)
+        self._pending.clear()
+        return output
+
+    def _submit(self, block, last):
+        self._pending.append(self.executor.submit(
+            compress_block, block, self._dictionary, self.compresslevel, last))
+        self._dictionary = block[-_DICTIONARY_SIZE:]
+
+
+def compress_block(block, dictionary, compresslevel, last):
+    """Compress a block as part of a raw deflate stream
+
+    :param block: Uncompressed bytes
+    :param dictionary: End of the previous block, empty for the first block
+    :param compresslevel: Deflate compression level
+    :param last: True for the last block of the stream
+    :return: Compressed bytes
+    """
+    options = {'zdict': dictionary} if dictionary else {}
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS, **options)
+    return compressor.compress(block) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class CsarZipFile(zipfile.ZipFile):
+    """Zip file applying a compression policy to each written member"""
+
+    policy = CompressionPolicy()
+    _executor = None
+
+    def write(self, filename, arcname=None, compress_type=None, compresslevel=None):
+        if os.path.isdir(filename):
+            if self.policy.mtime is None:
+                super().write(filename, arcname, compress_type, compresslevel)
+            else:
+                self.writestr(zipfile.ZipInfo.from_file(filename, arcname), b'')
+            return
+
+        if compress_type is None:
+            compress_type, compresslevel = self.policy.select(filename)
+
+        start = time.monotonic()
+        if compress_type == zipfile.ZIP_DEFLATED and self.policy.threads > 1 and \
+                os.path.getsize(filename) >= PARALLEL_MIN_SIZE:
+            self.write_parallel(filename, arcname, compresslevel)
+        elif self.policy.mtime is not None:
+            self.write_stream(filename, arcname, compress_type, compresslevel)
+        else:
+            super().write(filename, arcname, compress_type, compresslevel)
+        self.report(self.filelist[-1], time.monotonic() - start)
+
+    def writestr(self, zinfo_or_arcname, data, compress_type=None, compresslevel=None):
+        if self.policy.mtime is not None:
+            if not isinstance(zinfo_or_arcname, zipfile.ZipInfo):
+                zinfo_or_arcname = zipfile.ZipInfo(zinfo_or_arcname)
+                zinfo_or_arcname.compress_type = self.compression
+                zinfo_or_arcname._compresslevel = self.compresslevel  # pylint: disable=protected-access
+            self.policy.normalize(zinfo_or_arcname)
+        super().writestr(zinfo_or_arcname, data, compress_type, compresslevel)
+
+    def write_parallel(self, filename, arcname=None, compresslevel=None):
+        """Write a file deflated on multiple threads
+
+        :param filename: Path of the file to write
+        :param arcname: Name of the member, defaults to filename
+        :param compresslevel: Deflate compression level, zlib default if not given
+        """
+        self.write_stream(filename, arcname, zipfile.ZIP_DEFLATED, compresslevel, parallel=True)
+
+    # pylint: disable=too-many-arguments
+    def write_stream(self, filename, arcname=None, compress_type=zipfile.ZIP_DEFLATED,
+                     compresslevel=None, parallel=False):
+        """Write a file with the member normalized by the policy
+
+        :param filename: Path of the file to write
+        :param arcname: Name of the member, defaults to filename
+        :param compress_type: zipfile compression type
+        :param compresslevel: Deflate compression level, zlib default if not given
+        :param parallel: Deflate on the threads of the policy
+        """
+        zinfo = self.policy.normalize(zipfile.ZipInfo.from_file(filename, arcname))
+        zinfo.compress_type = compress_type
+        zinfo._compresslevel = compresslevel  # pylint: disable=protected-access
+
+        if parallel and self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.policy.threads)
+
+        with open(filename, 'rb') as source, self.open(zinfo, 'w') as destination:
+            if parallel:
+                # pylint: disable=protected-access
+                destination._compressor = ParallelCompressor(
+                    self._executor, self.policy.threads, compresslevel)
+            shutil.copyfileobj(source, destination, PARALLEL_BLOCK_SIZE)
+
+    def close(self):
+        super().close()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    @staticmethod
+    def report(zinfo, duration):
+        """Log size and write time of a member
+
+        :param zinfo: ZipInfo of the written member
+        :param duration: Write time in seconds
+        """
+        compression = 'deflated' if zinfo.compress_type == zipfile.ZIP_DEFLATED else 'stored'
+        logging.info('Wrote archive member %s: %s bytes, %s bytes %s, %.1f s',
+                     zinfo.filename, zinfo.file_size, zinfo.compress_size,
+                     compression, duration)
+
+
+def sorted_walk(top, *args, **kwargs):
+    """os.walk listing the directories and files of each directory in sorted order"""
+    for root, dirs, files in os.walk(top, *args, **kwargs):
+        dirs.sort()
+        files.sort()
+        yield root, dirs, files
+
+
+@contextmanager
+def csar_zip_policy(module, policy):
+    """Make a CSAR writer module create its zip archives with the given policy
+
+    Only the zipfile reference of the given module is replaced, the zipfile
+    module itself is not modified. With a reproducible policy the os reference
+    is replaced too, so that the module walks directories in sorted order.
+
+    :param module: Module writing the CSAR zip, e.g. vnfsdk_pkgtools.packager.csar
+    :param policy: CompressionPolicy object
+    """
+    zip_class = type('ZipFile', (CsarZipFile,), {'policy': policy})
+    zipfile_module = types.ModuleType(zipfile.__name__)
+    zipfile_module.__dict__.update(vars(zipfile))
+    zipfile_module.ZipFile = zip_class
+
+    replacements = [('zipfile', zipfile_module), ('ZipFile', zip_class)]
+    if policy.mtime is not None:
+        os_module = types.ModuleType(os.__name__)
+        os_module.__dict__.update(vars(os))
+        os_module.walk = sorted_walk
+        replacements.append(('os', os_module))
+
+    originals = {}
+    for name, replacement in replacements:
+        if hasattr(module, name):
+            originals[name] = getattr(module, name)
+            setattr(module, name, replacement)
+    try:
+        yield
+    finally:
+        for name, original in originals.items():
+            setattr(module, name, original)
@@ -22,8 +22,17 @@ import hashlib
 from base64 import b64decode
 import requests
 
+from .image import Image
+
 API_MANIFEST = 'https://{server}/v2/{path}/manifests/{version}'
 API_BLOB = 'https://{server}/v2/{path}/blobs/{digest}'
+BLOB_CHUNK_SIZE = 1024 * 1024
+DOCKER_MANIFEST_MEDIA_TYPE = 'application/vnd.docker.distribution.manifest.v2+json'
+# Manifests and indexes of both the Docker and the OCI formats
+EXPORT_MEDIA_TYPES = (DOCKER_MANIFEST_MEDIA_TYPE,
+                      'application/vnd.docker.distribution.manifest.list.v2+json',
+                      'application/vnd.oci.image.manifest.v1+json',
+                      'application/vnd.oci.image.index.v1+json')
 
 
 class DockerApiError(Exception):
@@ -67,27 +76,28 @@ class DockerConfig:
 
 # pylint: disable=too-few-public-methods
 class DockerApi:
-    """Docker API v2 client"""
+    """Docker API v2 client
+
+    Successful manifests and image configs are kept by the client, so that
+    an image is fetched only once by the users of the same client.
+    """
 
     def __init__(self, docker_config_path, timeout=600):
         self.docker_config = DockerConfig(docker_config_path)
         self.timeout = timeout
+        self._manifest_cache = {}
+        self._blob_cache = {}
 
     @staticmethod
     def get_path_components(image_path):
         """Split image URL to components
 
         :param image_path: Full Docker image path
-        :raises KeyError: Invalid Docker image URL
-        :return: <server>, <path>, <version>
+        :raises ValueError: Invalid Docker image URL
+        :return: <server>, <path>, <version>, version is the digest if given, else the tag
         """
-        path_components = image_path.split('/')
-
-        # Split image URL to separate variables e.g. <server>/<path>/<image>:<version>
-        server = path_components[0]
-        path, version = '/'.join(path_components[1:]).split(':')
-
-        return server, path, version
+        image = Image.parse(image_path)
+        return image.server, image.repository, image.version
 
     def get_image_manifest(self, image_path):
         """Get image manifest
@@ -97,11 +107,10 @@ class DockerApi:
         :return: Docker image manifest as dictionary
         """
         try:
-            response = self._request_manifest(image_path)
-            return response.json()
+            return json.loads(self._request_manifest(image_path))
         except json.decoder.JSONDecodeError as exc:
             error_message = f'Error parsing manifest for {image_path}'
-            raise DockerApiError(response.status_code, error_message) from exc
+            raise DockerApiError(200, error_message) from exc
 
     def get_manifest_hash(self, image_path):
         """
@@ -109,22 +118,62 @@ class DockerApi:
 
         :param image_path: Docker image URL
         :raises DockerApiError: Failed to fetch data from server
-        :return: sha256sum of the request text body
+        :return: sha256sum of the response body
+        """
+        return hashlib.sha256(self._request_manifest(image_path)).hexdigest()
+
+    def get_manifest_content(self, image_path):
+        """Get the image manifest or index as returned by the registry
+
+        Manifests and indexes of the Docker and OCI formats are accepted.
+
+        :param image_path: Docker image URL
+        :raises DockerApiError: Failed to fetch data from server
+        :return: Manifest bytes
+        """
+        return self._request_manifest(image_path, EXPORT_MEDIA_TYPES)
+
+    def download_blob(self, image_path, digest, output):
+        """Stream a blob of an image repository to a file
+
+        :param image_path: Full Docker image URL
+        :param digest: Digest of the blob
+        :param output: Binary file object to write the blob to
+        :raises DockerApiError: Failed to fetch data from server
+        :return: Number of bytes written
         """
-        response = self._request_manifest(image_path)
-        return hashlib.sha256(response.text.encode('utf-8')).hexdigest()
+        server, path, _ = self.get_path_components(image_path)
+        credentials = self.docker_config.get_credentials(server)
+        size = 0
+        try:
+            with requests.get(API_BLOB.format(server=server, path=path, digest=digest),
+                              auth=credentials, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=BLOB_CHUNK_SIZE):
+                    output.write(chunk)
+                    size += len(chunk)
+        except requests.exceptions.RequestException as exc:
+            logging.debug('Could not download blob %s of %s (%s)', digest, image_path, exc)
+            status_code = exc.response.status_code if exc.response is not None else None
+            raise DockerApiError(status_code, f'Failed to download blob {digest}: {exc}') from exc
+        return size
 
-    def _request_manifest(self, image_path):
+    def _request_manifest(self, image_path, media_types=(DOCKER_MANIFEST_MEDIA_TYPE,)):
         """
-        Make request for image manifest, returning the successful request
-        or raising a DockerAPIError
+        Make request for image manifest, returning the body of the successful
+        response or raising a DockerAPIError
 
         :param image_path: Docker image URL
+        :param media_types: Accepted manifest media types
         :raises DockerAPIError: Failed to fetch data from server
-        :return: request response
+        :return: Manifest bytes
         """
         server, path, version = self.get_path_components(image_path)
         credentials = self.docker_config.get_credentials(server)
+        cache_key = server, path, version, media_types
+        cached = self._manifest_cache.get(cache_key)
+        if cached is not None:
+            return cached
         try:
             response = requests.get(
                 API_MANIFEST.format(server=server,
@@ -132,12 +181,13 @@ class DockerApi:
                                     version=version),
                 auth=credentials,
                 headers={
-                    'Accept': 'application/vnd.docker.distribution.manifest.v2+json'
+                    'Accept': ', '.join(media_types)
                 },
                 timeout=self.timeout
             )
             response.raise_for_status()
-            return response
+            self._manifest_cache[cache_key] = response.content
+            return response.content
         except (requests.exceptions.RequestException,
                 requests.exceptions.HTTPError) as exc:
             logging.debug('Could not get image manifest for %s (%s)', image_path, str(exc))
@@ -163,13 +213,18 @@ class DockerApi:
         except KeyError as exc:
             raise DockerApiError(200, f'Invalid data in image manifest {image_path}') from exc
 
+        cached = self._blob_cache.get((server, path, digest))
+        if cached is not None:
+            return cached
         try:
             response = requests.get(API_BLOB.format(server=server, path=path, digest=digest),
                                     auth=credentials,
                                     headers={'Accept': media_type},
                                     timeout=self.timeout)
             response.raise_for_status()
-            return response.json()
+            blob = response.json()
+            self._blob_cache[(server, path, digest)] = blob
+            return blob
         except requests.exceptions.RequestException as exc:
             logging.debug('Could not get labels for %s (%s)', image_path, exc)
             error_message = f'Failed to get image labels: {str(exc)}'
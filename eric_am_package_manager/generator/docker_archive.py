@@ -0,0 +1,732 @@
+# ******************************************************************************
+# COPYRIGHT Ericsson 2024
+#
+#
+#
+# The copyright to the computer program(s) herein is the property of
+#
+# Ericsson Inc. The programs may be used and/or copied only with written
+#
+# permission from Ericsson Inc. or in accordance with the terms and
+#
+# conditions stipulated in the agreement/contract under which the
+#
+# program(s) have been supplied.
+# ******************************************************************************
+"""Docker image archives in the docker save format"""
+
+import io
+import os
+import re
+import json
+import base64
+import shutil
+import hashlib
+import logging
+import tarfile
+import zipfile
+from tempfile import TemporaryDirectory
+
+from . import hash_utils
+from .image import Image
+
+MANIFEST_FILENAME = 'manifest.json'
+REPOSITORIES_FILENAME = 'repositories'
+INDEX_FILENAME = 'index.json'
+OCI_LAYOUT_FILENAME = 'oci-layout'
+
+# Path of the Docker tar in a CSAR
+CSAR_ARCHIVE_PATH = 'Files/images/docker.tar'
+DELTA_SUFFIX = '.delta'
+DELTA_MANIFEST_SUFFIX = '.delta.json'
+# Signature block of a signed CSAR manifest
+CMS_SIGNATURE_MARKER = '-----BEGIN CMS-----'
+DELTA_VERSION = 1
+LAYER_INDEX_VERSION = 1
+_COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class DockerArchiveError(Exception):
+    """Docker image archive error"""
+
+
+def normalize_archive(source, destination, mtime):
+    """Write an image archive with a deterministic layout
+
+    The members are written sorted by name with the given modification time,
+    root ownership and normalized permissions. The entries of manifest.json,
+    repositories and index.json are sorted, so that saving the same images
+    gives the same bytes whatever the order docker save used.
+
+    :param source: Path of the image archive written by docker save
+    :param destination: Binary file object to write the archive to
+    :param mtime: Modification time of the members in seconds since the epoch
+    """
+    with tarfile.open(source) as archive, \
+            tarfile.open(fileobj=destination, mode='w|', format=tarfile.PAX_FORMAT) as output:
+        for member in sorted(archive.getmembers(), key=lambda member: member.name):
+            info = normalize_member(member, mtime)
+            if not member.isfile():
+                output.addfile(info)
+            elif member.name in _NORMALIZERS:
+                data = _NORMALIZERS[member.name](json.loads(archive.extractfile(member).read()))
+                data = json.dumps(data, separators=(',', ':')).encode()
+                info.size = len(data)
+                output.addfile(info, io.BytesIO(data))
+            else:
+                output.addfile(info, archive.extractfile(member))
+
+
+def normalize_member(member, mtime):
+    """Copy member header with normalized metadata
+
+    :param member: TarInfo object
+    :param mtime: Modification time in seconds since the epoch
+    :return: New TarInfo object
+    """
+    info = tarfile.TarInfo(member.name)
+    info.type = member.type
+    info.size = member.size if member.isfile() else 0
+    info.linkname = member.linkname
+    info.mode = 0o755 if member.isdir() or member.mode & 0o111 else 0o644
+    info.mtime = mtime
+    return info
+
+
+def _normalize_manifest(manifest):
+    for image in manifest:
+        image['RepoTags'] = sorted(image.get('RepoTags') or [])
+    return sorted(manifest, key=lambda image: (image['RepoTags'], image.get('Config', '')))
+
+
+def _normalize_repositories(repositories):
+    return {repository: dict(sorted(tags.items()))
+            for repository, tags in sorted(repositories.items())}
+
+
+def _normalize_index(index):
+    index['manifests'] = sorted(
+        index.get('manifests') or [],
+        key=lambda manifest: (json.dumps(manifest.get('annotations', {}), sort_keys=True),
+                              manifest.get('digest', '')))
+    return index
+
+
+_NORMALIZERS = {
+    MANIFEST_FILENAME: _normalize_manifest,
+    REPOSITORIES_FILENAME: _normalize_repositories,
+    INDEX_FILENAME: _normalize_index,
+}
+
+
+def merge_archives(sources, destination, mtime=None):
+    """Merge image archives saved from disjoint sets of images into one archive
+
+    Members with the same name, i.e. the layers and configs found from
+    several archives, are written once. The images of manifest.json with the
+    same config are merged, as are the tags of repositories and the
+    manifests of index.json.
+
+    :param sources: Paths of the image archives
+    :param destination: Binary file object to write the archive to
+    :param mtime: Modification time of the merged manifest members, the time
+        of the first source manifest if not given
+    :raises DockerArchiveError: Members with the same name and different size
+    """
+    sizes = {}
+    manifest = {}
+    repositories = {}
+    index = None
+    with tarfile.open(fileobj=destination, mode='w|', format=tarfile.PAX_FORMAT) as output:
+        for source in sources:
+            with tarfile.open(source) as archive:
+                for member in archive:
+                    if member.name in _NORMALIZERS:
+                        if mtime is None:
+                            mtime = member.mtime
+                        data = json.load(archive.extractfile(member))
+                        if member.name == MANIFEST_FILENAME:
+                            _merge_manifest(manifest, data)
+                        elif member.name == REPOSITORIES_FILENAME:
+                            for repository, tags in data.items():
+                                repositories.setdefault(repository, {}).update(tags)
+                        else:
+                            index = _merge_index(index, data)
+                        continue
+                    if member.name in sizes:
+                        if member.size != sizes[member.name]:
+                            raise DockerArchiveError(f'{member.name} differs between '
+                                                     f'the merged archives')
+                        continue
+                    sizes[member.name] = member.size
+                    output.addfile(member, archive.extractfile(member)
+                                   if member.isfile() else None)
+
+        _add_json(output, MANIFEST_FILENAME, list(manifest.values()), mtime or 0)
+        if repositories:
+            _add_json(output, REPOSITORIES_FILENAME, repositories, mtime or 0)
+        if index is not None:
+            _add_json(output, INDEX_FILENAME, index, mtime or 0)
+    logging.debug('Merged %s archives with %s members', len(sources), len(sizes) + 1)
+
+
+def _merge_manifest(manifest, entries):
+    for entry in entries:
+        merged = manifest.setdefault(entry['Config'], entry)
+        if merged is not entry:
+            merged['RepoTags'] = list(dict.fromkeys(
+                (merged.get('RepoTags') or []) + (entry.get('RepoTags') or [])))
+
+
+def _merge_index(index, data):
+    if index is None:
+        return data
+    known = {json.dumps(manifest, sort_keys=True) for manifest in index.get('manifests', [])}
+    for manifest in data.get('manifests') or []:
+        if json.dumps(manifest, sort_keys=True) not in known:
+            index.setdefault('manifests', []).append(manifest)
+    return index
+
+
+def read_manifest(path):
+    """Read manifest.json and the member sizes of an image archive
+
+    :param path: Path of the image archive
+    :raises DockerArchiveError: Archive without manifest.json
+    :return: Tuple of list of manifest entries and dictionary of member sizes by name
+    """
+    manifest = None
+    sizes = {}
+    with tarfile.open(path) as archive:
+        for member in archive:
+            sizes[member.name] = member.size
+            if member.name == MANIFEST_FILENAME:
+                manifest = json.load(archive.extractfile(member))
+    if manifest is None:
+        raise DockerArchiveError(f'{path} does not contain {MANIFEST_FILENAME}')
+    return manifest, sizes
+
+
+def assign_by_images(manifest, partitions):
+    """Assign the images of an archive to the partitions referencing them
+
+    Images referenced by several partitions or by none are assigned to the
+    common archive.
+
+    :param manifest: Manifest entries of the archive
+    :param partitions: List of (partition name, images) tuples
+    :return: List of partition names by manifest entry, None for the common archive
+    """
+    names = {}
+    for name, images in partitions:
+        for image in images:
+            names.setdefault(Image.parse(str(image)), set()).add(name)
+
+    assignments = []
+    for entry in manifest:
+        found = set()
+        for tag in entry.get('RepoTags') or []:
+            try:
+                found.update(names.get(Image.parse(tag), ()))
+            except ValueError:
+                logging.debug('Invalid image tag %s in %s', tag, MANIFEST_FILENAME)
+        assignments.append(found.pop() if len(found) == 1 else None)
+    return assignments
+
+
+def assign_by_size(manifest, sizes, size_cap):
+    """Assign the images of an archive to partitions of at most a given size
+
+    An image larger than the size cap gets a partition of its own.
+
+    :param manifest: Manifest entries of the archive
+    :param sizes: Member sizes of the archive by name
+    :param size_cap: Maximum size of the members of a partition in bytes
+    :return: List of partition names by manifest entry
+    """
+    assignments = []
+    current = set()
+    current_size = 0
+    for entry in manifest:
+        files = set(_get_entry_files(entry))
+        added = sum(sizes.get(name, 0) for name in files - current)
+        if current and current_size + added > size_cap:
+            current = set()
+            current_size = 0
+            added = sum(sizes.get(name, 0) for name in files)
+        if not current:
+            partition = f'{len(set(assignments)) + 1:03d}'
+        current |= files
+        current_size += added
+        assignments.append(partition)
+    return assignments
+
+
+def split_archive(source, destination, assignments, hash_algorithms=(), mtime=None):
+    """Split an image archive into an archive per partition and a common archive
+
+    The config and layers of the images of a single partition are written to
+    the archive of the partition, the ones shared by several partitions and
+    the images of no partition to the common archive, so no member is
+    written twice. The common archive is loadable alone and its manifest
+    lists the images of no partition. The manifest of a partition archive
+    lists the images of the common archive too, so when the partition
+    archive is concatenated to the common archive with tar --concatenate
+    its manifest, extracted last by docker load, covers all images of the
+    concatenated archive.
+
+    :param source: Path of the image archive
+    :param destination: Path of the common archive, the partition archives
+        are written next to it as <stem>-<partition>.tar
+    :param assignments: List of partition names by manifest entry, None for
+        the common archive
+    :param hash_algorithms: Hash algorithms to calculate while the archives
+        are written, e.g. sha-256
+    :param mtime: Modification time of the written manifest members, the
+        time of the source manifest if not given
+    :return: Dictionary of archive paths by partition name, None for the common archive
+    """
+    manifest, _ = read_manifest(source)
+    stem, extension = os.path.splitext(destination)
+    paths = {None: destination}
+    paths.update({partition: f'{stem}-{partition}{extension}'
+                  for partition in assignments if partition is not None})
+
+    users = {}
+    for entry, partition in zip(manifest, assignments):
+        for name in _get_entry_files(entry):
+            users.setdefault(name, set()).add(partition)
+    owners = {name: partitions.pop() if len(partitions) == 1 else None
+              for name, partitions in users.items()}
+
+    files = {}
+    writers = {}
+    archives = {}
+    try:
+        for partition, path in paths.items():
+            files[partition] = open(path, 'wb')  # pylint: disable=consider-using-with
+            writers[partition] = hash_utils.HashingWriter(files[partition], hash_algorithms)
+            archives[partition] = tarfile.open(fileobj=writers[partition], mode='w|')
+
+        with tarfile.open(source) as archive:
+            for member in archive:
+                if member.name in _NORMALIZERS or member.name == OCI_LAYOUT_FILENAME:
+                    if member.name == MANIFEST_FILENAME and mtime is None:
+                        mtime = member.mtime
+                    continue
+                owner = owners.get(_get_member_key(member.name, owners))
+                archives[owner].addfile(member, archive.extractfile(member)
+                                        if member.isfile() else None)
+            repositories = _read_repositories(archive)
+
+        for partition, writer_archive in archives.items():
+            entries = [entry for entry, assigned in zip(manifest, assignments)
+                       if assigned is None or assigned == partition]
+            _add_json(writer_archive, MANIFEST_FILENAME, entries, mtime or 0)
+            _add_json(writer_archive, REPOSITORIES_FILENAME,
+                      _filter_repositories(repositories, entries), mtime or 0)
+            writer_archive.close()
+    finally:
+        for writer_archive in archives.values():
+            writer_archive.close()
+        for file in files.values():
+            file.close()
+
+    for partition, path in paths.items():
+        hash_utils.remember_digests(path, writers[partition].hexdigests())
+        logging.info('Wrote %s with %s images, %s bytes', os.path.basename(path),
+                     assignments.count(partition), writers[partition].size)
+    return paths
+
+
+def _get_entry_files(entry):
+    """Get the members of an archive referenced by a manifest entry"""
+    return [entry['Config'], *entry.get('Layers', [])]
+
+
+def _get_member_key(name, owners):
+    """Get the referenced member a member belongs to
+
+    The json and VERSION files of a legacy layer directory belong to the
+    layer.tar of the directory.
+    """
+    if name in owners:
+        return name
+    directory = name.split('/', 1)[0]
+    layer = f'{directory}/layer.tar'
+    return layer if layer in owners else name
+
+
+def _read_repositories(archive):
+    try:
+        return json.load(archive.extractfile(REPOSITORIES_FILENAME))
+    except KeyError:
+        return {}
+
+
+def _filter_repositories(repositories, entries):
+    tags = {tag for entry in entries for tag in entry.get('RepoTags') or []}
+    filtered = {}
+    for repository, repository_tags in repositories.items():
+        kept = {tag: layer for tag, layer in repository_tags.items()
+                if f'{repository}:{tag}' in tags}
+        if kept:
+            filtered[repository] = kept
+    return filtered
+
+
+def _add_json(archive, name, data, mtime):
+    content = json.dumps(data, sort_keys=True, separators=(',', ':')).encode()
+    info = tarfile.TarInfo(name)
+    info.size = len(content)
+    info.mtime = mtime
+    info.mode = 0o644
+    archive.addfile(info, io.BytesIO(content))
+
+
+def read_members(path):
+    """Read the layout of an image archive with the digest of each member
+
+    The raw bytes between the members, i.e. the tar headers, are kept so
+    that the archive can be rebuilt byte for byte from the member data.
+
+    :param path: Path of the image archive
+    :return: Tuple of list of member dictionaries and the bytes after the last member
+    """
+    members = []
+    position = 0
+    with open(path, 'rb') as file, tarfile.open(path) as archive:
+        for member in archive:
+            file.seek(position)
+            header = file.read(member.offset_data - position)
+            digest = _hash_range(file, member.offset_data, member.size) if member.size else None
+            members.append({'header': base64.b64encode(header).decode(),
+                            'name': member.name,
+                            'size': member.size,
+                            'sha256': digest})
+            position = member.offset_data + _padded(member.size)
+        file.seek(position)
+        trailer = file.read()
+    return members, trailer
+
+
+def get_layer_index(members, archive_digest=None):
+    """Create layer index of an image archive
+
+    :param members: Member dictionaries from read_members
+    :param archive_digest: SHA-256 digest of the whole archive
+    :return: Layer index dictionary
+    """
+    return {'version': LAYER_INDEX_VERSION,
+            'sha256': archive_digest,
+            'blobs': {member['sha256']: member['size'] for member in members
+                      if member['sha256']}}
+
+
+def write_layer_index(path, members, archive_digest=None):
+    """Write layer index of an image archive as JSON
+
+    :param path: Path of the layer index file
+    :param members: Member dictionaries from read_members
+    :param archive_digest: SHA-256 digest of the whole archive
+    """
+    with open(path, 'w', encoding='utf-8') as index_file:
+        json.dump(get_layer_index(members, archive_digest), index_file, indent=2, sort_keys=True)
+    logging.info('Wrote layer index %s', path)
+
+
+def read_layer_index(baseline):
+    """Read layer index of a baseline CSAR or layer index file
+
+    The Docker tar of a CSAR is read as a stream, it is not extracted.
+
+    :param baseline: Path of a CSAR or a layer index JSON file
+    :raises DockerArchiveError: Baseline without Docker tar or invalid index
+    :return: Layer index dictionary
+    """
+    if not zipfile.is_zipfile(baseline):
+        try:
+            with open(baseline, 'r', encoding='utf-8') as index_file:
+                index = json.load(index_file)
+        except ValueError as exc:
+            raise DockerArchiveError(f'Invalid layer index {baseline}: {exc}') from exc
+        if not isinstance(index, dict) or index.get('version') != LAYER_INDEX_VERSION:
+            raise DockerArchiveError(f'Unsupported layer index {baseline}')
+        return index
+
+    blobs = {}
+    with zipfile.ZipFile(baseline) as csar:
+        try:
+            stream = csar.open(CSAR_ARCHIVE_PATH)
+        except KeyError as exc:
+            raise DockerArchiveError(f'{baseline} does not contain {CSAR_ARCHIVE_PATH}') from exc
+        with stream, tarfile.open(fileobj=stream, mode='r|') as archive:
+            for member in archive:
+                if member.isfile() and member.size:
+                    digest = hashlib.sha256()
+                    source = archive.extractfile(member)
+                    for chunk in iter(lambda: source.read(_COPY_BUFFER_SIZE), b''):
+                        digest.update(chunk)
+                    blobs[digest.hexdigest()] = member.size
+    return {'version': LAYER_INDEX_VERSION, 'sha256': None, 'blobs': blobs}
+
+
+def write_delta(path, members, trailer, baseline_index, archive_digest):
+    """Write the member data missing from a baseline next to an image archive
+
+    Writes <path>.delta, a tar of the missing member data named by digest,
+    and <path>.delta.json, the manifest for rebuilding the archive.
+
+    :param path: Path of the image archive
+    :param members: Member dictionaries from read_members
+    :param trailer: Bytes after the last member from read_members
+    :param baseline_index: Layer index of the baseline
+    :param archive_digest: SHA-256 digest of the whole archive
+    :return: Tuple of paths of the delta tar and the delta manifest
+    """
+    baseline_blobs = baseline_index.get('blobs', {})
+    written = set()
+    delta_size = 0
+    with open(path, 'rb') as file, tarfile.open(path + DELTA_SUFFIX, 'w') as delta:
+        position = 0
+        for member in members:
+            position += len(base64.b64decode(member['header']))
+            digest = member['sha256']
+            member['source'] = 'baseline' if digest in baseline_blobs else 'delta'
+            if digest and digest not in baseline_blobs and digest not in written:
+                info = tarfile.TarInfo(f'blobs/sha256/{digest}')
+                info.size = member['size']
+                file.seek(position)
+                delta.addfile(info, _RangeReader(file, member['size']))
+                written.add(digest)
+                delta_size += member['size']
+            position += _padded(member['size'])
+
+    manifest = {'version': DELTA_VERSION,
+                'archive': os.path.basename(path),
+                'sha256': archive_digest,
+                'baseline_sha256': baseline_index.get('sha256'),
+                'members': members,
+                'trailer': base64.b64encode(trailer).decode()}
+    with open(path + DELTA_MANIFEST_SUFFIX, 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+
+    total_size = sum(member['size'] for member in members)
+    logging.info('Delta of %s has %s of %s bytes of member data, %s blobs from the baseline',
+                 os.path.basename(path), delta_size, total_size,
+                 len({member['sha256'] for member in members
+                      if member['source'] == 'baseline'}))
+    return path + DELTA_SUFFIX, path + DELTA_MANIFEST_SUFFIX
+
+
+def rebuild_archive(manifest, delta_path, baseline_path, destination):
+    """Rebuild an image archive from a baseline archive and a delta
+
+    :param manifest: Delta manifest dictionary
+    :param delta_path: Path of the delta tar
+    :param baseline_path: Path of the baseline image archive
+    :param destination: Path of the archive to write
+    :raises DockerArchiveError: Missing data or digest mismatch
+    """
+    if manifest.get('version') != DELTA_VERSION:
+        raise DockerArchiveError('Unsupported delta manifest')
+
+    baseline_members, _ = read_members(baseline_path)
+    sources = {'baseline': (baseline_path, _get_data_offsets(baseline_path, baseline_members)),
+               'delta': (delta_path, _get_delta_offsets(delta_path))}
+
+    archive_digest = hashlib.sha256()
+    with open(destination, 'wb') as output, open(baseline_path, 'rb') as baseline, \
+            open(delta_path, 'rb') as delta:
+        files = {'baseline': baseline, 'delta': delta}
+
+        def write(data):
+            archive_digest.update(data)
+            output.write(data)
+
+        for member in manifest['members']:
+            write(base64.b64decode(member['header']))
+            if not member['size']:
+                continue
+            offset = sources[member['source']][1].get(member['sha256'])
+            if offset is None:
+                raise DockerArchiveError(f'Data of {member["name"]} not found from '
+                                         f'the {member["source"]}')
+            file = files[member['source']]
+            file.seek(offset)
+            digest = hashlib.sha256()
+            remaining = member['size']
+            while remaining:
+                chunk = file.read(min(remaining, _COPY_BUFFER_SIZE))
+                if not chunk:
+                    raise DockerArchiveError(f'Data of {member["name"]} truncated')
+                digest.update(chunk)
+                write(chunk)
+                remaining -= len(chunk)
+            if digest.hexdigest() != member['sha256']:
+                raise DockerArchiveError(f'Digest mismatch in data of {member["name"]}')
+            write(bytes(_padded(member['size']) - member['size']))
+        write(base64.b64decode(manifest['trailer']))
+
+    if manifest.get('sha256') and archive_digest.hexdigest() != manifest['sha256']:
+        raise DockerArchiveError(f'Digest mismatch in rebuilt {manifest["archive"]}')
+    logging.info('Rebuilt %s, SHA-256 %s', destination, archive_digest.hexdigest())
+
+
+def rebuild_csar(baseline, delta, destination):
+    """Rebuild a full CSAR package from a baseline CSAR and a delta CSAR
+
+    The members of the delta CSAR are copied in order, the delta of the
+    Docker tar is replaced by the rebuilt Docker tar. The digest entries of
+    the delta files in the manifest (.mf) are replaced by the entry of the
+    rebuilt Docker tar. A signed manifest cannot be rebuilt.
+
+    :param baseline: Path of the baseline CSAR
+    :param delta: Path of the delta CSAR
+    :param destination: Path of the CSAR to write
+    :raises DockerArchiveError: Invalid delta or digest mismatch
+    """
+    delta_path = CSAR_ARCHIVE_PATH + DELTA_SUFFIX
+    manifest_path = CSAR_ARCHIVE_PATH + DELTA_MANIFEST_SUFFIX
+    with TemporaryDirectory(dir=os.path.dirname(os.path.abspath(destination))) as tempdir, \
+            zipfile.ZipFile(baseline) as baseline_csar, zipfile.ZipFile(delta) as delta_csar:
+        try:
+            manifest = json.loads(delta_csar.read(manifest_path))
+            baseline_csar.getinfo(CSAR_ARCHIVE_PATH)
+        except KeyError as exc:
+            raise DockerArchiveError(f'Not a delta of a CSAR with Docker tar: {exc}') from exc
+        baseline_tar = os.path.join(tempdir, 'baseline.tar')
+        delta_tar = os.path.join(tempdir, 'delta.tar')
+        rebuilt_tar = os.path.join(tempdir, 'docker.tar')
+        with baseline_csar.open(CSAR_ARCHIVE_PATH) as source, open(baseline_tar, 'wb') as target:
+            shutil.copyfileobj(source, target, _COPY_BUFFER_SIZE)
+        with delta_csar.open(delta_path) as source, open(delta_tar, 'wb') as target:
+            shutil.copyfileobj(source, target, _COPY_BUFFER_SIZE)
+        package_manifests = {}
+        for zinfo in delta_csar.infolist():
+            if '/' not in zinfo.filename and zinfo.filename.endswith('.mf'):
+                content = delta_csar.read(zinfo).decode('utf-8')
+                if CMS_SIGNATURE_MARKER in content:
+                    raise DockerArchiveError(f'{zinfo.filename} is signed, a signed delta '
+                                             f'CSAR cannot be rebuilt')
+                package_manifests[zinfo.filename] = content
+        rebuild_archive(manifest, delta_tar, baseline_tar, rebuilt_tar)
+
+        with zipfile.ZipFile(destination, 'w') as output:
+            for zinfo in delta_csar.infolist():
+                if zinfo.filename == manifest_path:
+                    continue
+                if zinfo.filename == delta_path:
+                    zinfo = _copy_zinfo(zinfo, CSAR_ARCHIVE_PATH)
+                    source = open(rebuilt_tar, 'rb')  # pylint: disable=consider-using-with
+                elif zinfo.filename in package_manifests:
+                    source = io.BytesIO(_rewrite_package_manifest(
+                        package_manifests[zinfo.filename], rebuilt_tar).encode('utf-8'))
+                else:
+                    source = delta_csar.open(zinfo)
+                with source, output.open(_copy_zinfo(zinfo), 'w', force_zip64=True) as target:
+                    shutil.copyfileobj(source, target, _COPY_BUFFER_SIZE)
+    logging.info('Rebuilt %s from %s and %s', destination, baseline, delta)
+
+
+def _rewrite_package_manifest(content, docker_tar):
+    """Replace the digest entries of the delta files in a CSAR manifest
+
+    An entry is a block of Source, Algorithm and Hash lines ended by an
+    empty line. The entry of the delta is changed to the rebuilt Docker tar
+    and its digest, the entry of the delta manifest is removed.
+
+    :param content: Manifest text
+    :param docker_tar: Path of the rebuilt Docker tar
+    :return: Manifest text
+    """
+    blocks = []
+    for block in re.split(r'^(?=Source:)', content, flags=re.MULTILINE):
+        source = block.partition('\n')[0][len('Source:'):].strip() \
+            if block.startswith('Source:') else None
+        if source == CSAR_ARCHIVE_PATH + DELTA_MANIFEST_SUFFIX:
+            # Content after the entry, e.g. other manifest sections, is kept
+            block = block.partition('\n\n')[2]
+        elif source == CSAR_ARCHIVE_PATH + DELTA_SUFFIX:
+            block = re.sub(r'^Source:.*$', f'Source: {CSAR_ARCHIVE_PATH}', block, count=1,
+                           flags=re.MULTILINE)
+            algorithm = re.search(r'^Algorithm:\s*(\S+)', block, flags=re.MULTILINE)
+            if algorithm:
+                block = re.sub(r'^Hash:.*$', f'Hash: {_hash_file(docker_tar, algorithm[1])}',
+                               block, count=1, flags=re.MULTILINE)
+        blocks.append(block)
+    return ''.join(blocks)
+
+
+def _hash_file(path, algorithm):
+    """Hash a file with a manifest algorithm name, e.g. SHA-512"""
+    digest = hashlib.new(algorithm.lower().replace('-', ''))
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(_COPY_BUFFER_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _copy_zinfo(zinfo, filename=None):
+    """Copy the attributes of a ZIP member for writing to another archive"""
+    copy = zipfile.ZipInfo(filename or zinfo.filename, zinfo.date_time)
+    copy.compress_type = zinfo.compress_type
+    copy.external_attr = zinfo.external_attr
+    copy.create_system = zinfo.create_system
+    return copy
+
+
+def _get_data_offsets(path, members):
+    """Get data offset of each member digest of an archive"""
+    offsets = {}
+    position = 0
+    for member in members:
+        position += len(base64.b64decode(member['header']))
+        if member['sha256']:
+            offsets.setdefault(member['sha256'], position)
+        position += _padded(member['size'])
+    logging.debug('Indexed %s blobs of %s', len(offsets), path)
+    return offsets
+
+
+def _get_delta_offsets(path):
+    """Get data offset of each blob of a delta tar"""
+    with tarfile.open(path) as delta:
+        return {os.path.basename(member.name): member.offset_data for member in delta
+                if member.isfile()}
+
+
+def _hash_range(file, offset, size):
+    file.seek(offset)
+    digest = hashlib.sha256()
+    remaining = size
+    while remaining:
+        chunk = file.read(min(remaining, _COPY_BUFFER_SIZE))
+        if not chunk:
+            break
+        digest.update(chunk)
+        remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def _padded(size):
+    return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+class _RangeReader:
+    """File object reading a number of bytes from the current position of a file"""
+
+    def __init__(self, file, size):
+        self.file = file
+        self.remaining = size
+
+    def read(self, size=-1):
+        """Read bytes up to the end of the range
+
+        :param size: Maximum number of bytes, all remaining if negative
+        :return: Bytes read
+        """
+        size = self.remaining if size < 0 else min(size, self.remaining)
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
@@ -15,6 +15,7 @@
 # ******************************************************************************
 '''Generate'''
 
+import hashlib
 import itertools
 import pathlib
 from functools import partial
@@ -24,19 +25,17 @@ import os
 import shutil
 import sys
 import tarfile
+import zipfile
 from itertools import filterfalse
 from multiprocessing import cpu_count
-from multiprocessing.pool import ThreadPool
-from subprocess import check_call, check_output, CalledProcessError
-from tempfile import TemporaryDirectory
+from subprocess import check_output, CalledProcessError
 from glob import glob
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 import re
-# pylint: disable=import-error
-import docker
 
-from yaml import load, safe_load, dump
-from . import utils
+from yaml import load, safe_load
+from . import utils, hash_utils, inventory, docker_archive, image_exporter
 from .cnf_values_file_exception import CnfValuesFileException
 
 try:
@@ -44,14 +43,23 @@ try:
 except ImportError:
     from yaml import Loader
 
-from .helm_template import HelmTemplate
+from .helm_template import HelmTemplate, render_once
 from .image import Image
+from .image_lock import ImageLock, ImageLockError
 from .utils import extract, PATH_TO_LICENSES
-from .crd_handler import extract_crds
-from .docker_api import DockerApi
+from .crd_handler import CrdIndex
+from .docker_api import DockerApi, DockerApiError
+from .oci_layout import ImageSources, OciLayoutError, INDEX_FILENAME
 
 _DOCKER_SAVE_FILENAME = 'docker.tar'
+# Images and charts missing eric-product-info.yaml keyed by chart tree digest
+# or CRD package digest
+_PRODUCT_INFO_IMAGES_CACHE = {}
 RELATIVE_PATH_TO_HELM_CHART = 'Definitions/OtherTemplates/'
+IMAGE_DISCOVERY_HELM_TEMPLATE = 'helm-template'
+IMAGE_DISCOVERY_VALUES = 'values'
+SPLIT_IMAGES_CHART = 'chart'
+SPLIT_IMAGES_SIZE = 'size'
 RELATIVE_PATH_TO_FILES = 'Files/'
 
 METADATA_KEYS_DEFAULT = {
@@ -102,24 +110,202 @@ def __build_helm_options(helm3, values, set_parameters, helm_debug, is_upgrade):
 
 
 def __get_images(args):
+    if getattr(args, 'images_lock', None):
+        images, _ = __get_locked_images(args)
+        return images
+    return __deduplicate_images(__collect_images(args, __get_archive_paths(args)))
+
+
+def __collect_images(args, archive_paths):
+    """Find the images of each chart
+
+    :param args: Command line arguments
+    :param archive_paths: Paths of the chart archives
+    :return: List of (archive path, images) tuples
+    """
+    if getattr(args, 'image_discovery', None) == IMAGE_DISCOVERY_VALUES:
+        return __collect_images_from_values(args, archive_paths)
+
     collected_images = []
     helm_template_images = None
 
-    for archive_path in __get_archive_paths(args):
+    for archive_path in archive_paths:
         if not args.helmfile and not args.disable_helm_template:
             helm_template_images = __get_helm_template_images(args, archive_path)
 
         if args.eric_product_info or utils.is_chart_in_list_product_info_charts(args, archive_path):
             product_info_info_images = \
                 __get_product_info_images(args, archive_path, helm_template_images)
-            collected_images.extend(product_info_info_images)
+            collected_images.append((archive_path, product_info_info_images))
 
         elif not args.disable_helm_template:
-            collected_images.extend(helm_template_images)
+            collected_images.append((archive_path, helm_template_images))
 
     return collected_images
 
 
+def get_images(args):
+    """Get images referenced by the Helm charts from command line arguments
+
+    :param args: Command line arguments
+    :return: List of images
+    """
+    return __get_images(args)
+
+
+def __collect_images_from_values(args, archive_paths):
+    """Get images of the charts without Helm
+
+    The images are collected from eric-product-info.yaml files and from
+    values.yaml of each chart merged with the --values files and --set values.
+
+    :param args: Command line arguments
+    :param archive_paths: Paths of the chart archives
+    :return: List of (archive path, images) tuples
+    """
+    overrides = {}
+    for values_file in args.values or []:
+        overrides = utils.deep_merge(overrides, utils.load_yaml_file(values_file) or {})
+    overrides = utils.deep_merge(overrides, utils.parse_set_values(args.set))
+
+    with ThreadPoolExecutor(max_workers=cpu_count()) as executor:
+        return list(zip(archive_paths, executor.map(
+            partial(__get_chart_images_from_values, overrides=overrides), archive_paths)))
+
+
+def __get_locked_images(args):
+    """Get images of the charts pinned to digests in the images lock file
+
+    :param args: Command line arguments
+    :return: Tuple of list of images and dictionary of digests by image
+    """
+    collected_images, digests = __get_locked_chart_images(args)
+    return __deduplicate_images(collected_images), digests
+
+
+def __get_locked_chart_images(args):
+    """Get images of each chart pinned to digests in the images lock file
+
+    Images are discovered and resolved only for the charts changed since the
+    lock file was written, which requires --refresh-lock if the lock file
+    already pins other versions of the charts. The lock file is written
+    after any changes.
+
+    :param args: Command line arguments
+    :return: Tuple of list of (archive path, images) tuples and dictionary of digests by image
+    """
+    archive_paths = __get_archive_paths(args)
+    chart_digests = {os.path.basename(path): hash_utils.sha256(path) for path in archive_paths}
+    options = __get_lock_options(args)
+
+    try:
+        lock = ImageLock.load(args.images_lock) if os.path.isfile(args.images_lock) \
+            else ImageLock()
+        changed = lock.get_changed_charts(chart_digests, options)
+        if lock.is_current(chart_digests, options):
+            logging.info('Images lock %s is up to date, skipping image discovery',
+                         args.images_lock)
+        elif lock.charts and not args.refresh_lock:
+            raise ImageLockError(f'Charts changed since {args.images_lock} was written: '
+                                 f'{", ".join(sorted(changed) or sorted(lock.charts))}. '
+                                 f'Use --refresh-lock to update it')
+        else:
+            logging.info('Updating images lock %s for %s', args.images_lock,
+                         ', '.join(sorted(changed)) or 'removed charts')
+            changed_paths = [path for path in archive_paths
+                             if os.path.basename(path) in changed]
+            changed_images = set()
+            for archive_path, images in __collect_images(args, changed_paths):
+                name = os.path.basename(archive_path)
+                lock.set_chart(name, chart_digests[name], images)
+                changed_images.update(images)
+            lock.retain_charts(chart_digests)
+            lock.options = options
+            if changed_images and getattr(args, 'offline', False):
+                raise ImageLockError('Images of the changed charts cannot be resolved with '
+                                     '--offline')
+            if changed_images:
+                lock.resolve(DockerApi(args.docker_config, args.timeout), changed_images)
+            lock.save(args.images_lock)
+    except (ImageLockError, OSError) as exc:
+        logging.error('Images lock failed: %s', exc)
+        sys.exit(1)
+
+    collected_images = [(path, lock.get_chart_images(os.path.basename(path)))
+                        for path in archive_paths]
+    return collected_images, lock.get_digests()
+
+
+def __get_lock_options(args):
+    """Get digest of the arguments affecting the images found from the charts
+
+    :param args: Command line arguments
+    :return: Hex digest
+    """
+    options = {
+        'image_discovery': getattr(args, 'image_discovery', None),
+        'helm3': args.helm3,
+        'helm_version': args.helm_version,
+        'is_upgrade': args.is_upgrade,
+        'set': args.set,
+        'values': [hash_utils.sha256(values_file) for values_file in args.values or []],
+        'disable_helm_template': args.disable_helm_template,
+        'eric_product_info': args.eric_product_info,
+        'eric_product_info_charts': args.eric_product_info_charts,
+    }
+    return hashlib.sha256(json.dumps(options, sort_keys=True).encode()).hexdigest()
+
+
+def __deduplicate_images(collected_images):
+    """Merge the images of the charts to a set of unique images
+
+    Images are compared by their normalized reference, e.g. docker.io/library/x
+    and x are the same image. The first spelling found is kept.
+
+    :param collected_images: List of (archive path, images) tuples
+    :return: List of unique images in the order they were found
+    """
+    sources = {}
+    spellings = {}
+    for archive_path, images in collected_images:
+        for image in images:
+            sources.setdefault(image, {})[os.path.basename(archive_path)] = None
+            spellings.setdefault(image, {})[str(image)] = None
+
+    for image, image_sources in sources.items():
+        if len(image_sources) > 1:
+            logging.info('Image %s found from %s', image, ', '.join(image_sources))
+        if len(spellings[image]) > 1:
+            logging.info('Image %s also referenced as %s', image,
+                         ', '.join(list(spellings[image])[1:]))
+
+    logging.info('Found %s unique images', len(sources))
+    return list(sources)
+
+
+def __get_chart_images_from_values(archive, overrides):
+    """Get images of a chart from eric-product-info.yaml and values
+
+    :param archive: Helm chart archive
+    :param overrides: Values merged on top of values.yaml of the chart
+    :return: List of images
+    """
+    archive_without_product_info_yaml = []
+    with extract(archive) as archive_directory:
+        images = set(__get_images_from_eric_product_info(archive_directory,
+                                                         archive_without_product_info_yaml))
+        values = safe_load(read_chart_values(archive_directory) or '') or {}
+
+    images.update(__parse_values_for_images(utils.deep_merge(values, overrides)))
+
+    if archive_without_product_info_yaml:
+        logging.warning('Charts in %s missing eric-product-info.yaml, their images are '
+                        'only found from values: %s', os.path.basename(archive),
+                        ', '.join(archive_without_product_info_yaml))
+    logging.info('Found %s images from %s without Helm', len(images), os.path.basename(archive))
+    return sorted(images, key=str)
+
+
 def __get_product_info_images(args, archive, helm_template_images):
     """
     Get images from eric-product-info.yaml file
@@ -191,6 +377,16 @@ def __get_helm_template_images(args, chart):
 
 
 def __validate_images_exist_in_registry(args, product_info_info_images):
+    local_images = __get_local_images(args, product_info_info_images)
+    product_info_info_images = [image for image in product_info_info_images
+                                if image not in local_images]
+    if not product_info_info_images:
+        return
+    if getattr(args, 'offline', False):
+        logging.error('Images not found from the local image layouts:\n%s',
+                      '\n'.join(map(str, product_info_info_images)))
+        sys.exit(1)
+
     docker_api = DockerApi(args.docker_config, args.timeout)
     product_info_info_images_as_str = map(str, product_info_info_images)
 
@@ -203,6 +399,26 @@ def __validate_images_exist_in_registry(args, product_info_info_images):
         sys.exit(1)
 
 
+def __get_local_images(args, images):
+    """Get the images found from the local image layouts of --oci-layout and --blob-cache
+
+    :param args: Command line arguments
+    :param images: Iterable of images
+    :return: Dictionary of manifest digests by image
+    """
+    try:
+        sources = ImageSources.from_args(args)
+    except OciLayoutError as exc:
+        logging.error('Failed to read the local image layouts: %s', exc)
+        sys.exit(1)
+    local_images = {}
+    for image in images:
+        found = sources.find(image)
+        if found is not None:
+            local_images[image] = found[1]['digest']
+    return local_images
+
+
 def __validate_helm_template_images_match_product_info_images(
         helm_template_images, product_info_info_images):
     not_in_helm_template = product_info_info_images.difference(helm_template_images)
@@ -222,8 +438,11 @@ def __template_helm_chart(chart, helm_command, helm_options):
     command = f'{helm_command} template {helm_options} {chart}'
 
     logging.info('Executing helm template: %s', command)
+    # Shared with the product report rendering the same chart
+    chart_digest = hash_utils.sha256(chart) if os.path.isfile(chart) else None
     try:
-        return check_output(command.split())
+        return render_once(chart_digest, helm_command, helm_options,
+                           lambda: check_output(command.split()))
     except CalledProcessError:
         logging.exception('Helm template command failed for chart %s', chart)
         sys.exit(1)
@@ -237,6 +456,23 @@ def __get_images_from_eric_product_info(archive_directory, archive_without_eric_
                                               missing eric-product-info.yaml
     :return: List of images
     """
+    # Identical subcharts and CRD packages in different charts are scanned once
+    tree_digest, _ = utils.get_chart_tree_digest(archive_directory)
+    if tree_digest in _PRODUCT_INFO_IMAGES_CACHE:
+        images, missing = _PRODUCT_INFO_IMAGES_CACHE[tree_digest]
+        logging.debug('Reusing images of identical chart for %s',
+                      os.path.basename(archive_directory))
+        archive_without_eric_product_info.extend(missing)
+        return list(images)
+
+    missing = []
+    images = __scan_images_from_eric_product_info(archive_directory, missing)
+    _PRODUCT_INFO_IMAGES_CACHE[tree_digest] = images, missing
+    archive_without_eric_product_info.extend(missing)
+    return list(images)
+
+
+def __scan_images_from_eric_product_info(archive_directory, archive_without_eric_product_info):
     images = []
     eric_product_info_file = os.path.join(archive_directory, 'eric-product-info.yaml')
 
@@ -256,10 +492,18 @@ def __get_images_from_eric_product_info(archive_directory, archive_without_eric_
             sub_chart, archive_without_eric_product_info))
 
     for crd_chart in glob(os.path.join(archive_directory, 'eric-crd/*.tgz')):
-        with extract(crd_chart) as crd_directory:
-            logging.debug('Found CRD Helm chart %s', os.path.basename(crd_chart))
-            images.extend(__get_images_from_eric_product_info(
-                crd_directory, archive_without_eric_product_info))
+        logging.debug('Found CRD Helm chart %s', os.path.basename(crd_chart))
+        # The same CRD package is extracted only once
+        crd_digest = hash_utils.sha256(crd_chart)
+        if crd_digest not in _PRODUCT_INFO_IMAGES_CACHE:
+            crd_missing = []
+            with extract(crd_chart) as crd_directory:
+                crd_images = __get_images_from_eric_product_info(crd_directory, crd_missing)
+            _PRODUCT_INFO_IMAGES_CACHE[crd_digest] = crd_images, crd_missing
+
+        crd_images, crd_missing = _PRODUCT_INFO_IMAGES_CACHE[crd_digest]
+        images.extend(crd_images)
+        archive_without_eric_product_info.extend(crd_missing)
 
     logging.debug('Archive %s has %s images', os.path.basename(archive_directory), len(images))
     return images
@@ -306,7 +550,12 @@ def __get_archive_paths(args):
     """
     archive_paths = []
     if args.helm_dir:
-        archive_paths.extend(glob(os.path.join(os.path.abspath(args.helm_dir), '*.tgz')))
+        helm_dir = os.path.abspath(args.helm_dir)
+        # Charts directly in the directory, as matched by glob *.tgz
+        archive_paths.extend(os.path.join(helm_dir, chart)
+                             for chart in inventory.get_helm_dir_charts(args.helm_dir)
+                             if os.sep not in chart and chart.endswith('.tgz')
+                             and not chart.startswith('.'))
     if args.helm:
         archive_paths.extend(args.helm)
     if args.helmfile:
@@ -318,6 +567,10 @@ def __handle_images_in_scalar_values(helm_chart, args):
     logging.info(
         'Helm template contains images in a scalar value, '
         'will parse the values file for the remaining images')
+    values = read_chart_values(helm_chart)
+    if values is not None:
+        return __parse_values_file_for_images(values)
+
     if args.helm3:
         command = f'helm3 show values {helm_chart}'
         if args.helm_version is not None:
@@ -334,6 +587,26 @@ def __handle_images_in_scalar_values(helm_chart, args):
     return __parse_values_file_for_images(values)
 
 
+def read_chart_values(helm_chart):
+    """Read values.yaml of a Helm chart, as output by helm show values
+
+    :param helm_chart: Helm chart archive or directory
+    :return: Contents of values.yaml, None if not found
+    """
+    if os.path.isdir(helm_chart):
+        values_path = os.path.join(helm_chart, 'values.yaml')
+        if not os.path.isfile(values_path):
+            return None
+        with open(values_path, 'rb') as values_file:
+            return values_file.read()
+
+    try:
+        return inventory.get_archive(helm_chart).read_values()
+    except (OSError, tarfile.TarError) as exc:
+        logging.debug('Could not read values.yaml from %s: %s', helm_chart, exc)
+    return None
+
+
 def __parse_values_file_for_images(values_file_contents):
     """
     This method will parse a values file which follows the ADP Helm Chart
@@ -389,7 +662,17 @@ def __parse_values_file_for_images(values_file_contents):
     :param values_file_contents: the contents of the values file from the integration helm chart
     :return: a list of Images
     """
-    data = load(values_file_contents, Loader=Loader)
+    return __parse_values_for_images(load(values_file_contents, Loader=Loader))
+
+
+def __parse_values_for_images(data):
+    """
+    Parse images from values of an integration helm chart,
+    see __parse_values_file_for_images
+
+    :param data: the values as dictionary
+    :return: a set of Images
+    """
     global_root = data.get('global')
 
     if global_root is None:
@@ -487,101 +770,239 @@ def __parse_images(images):
         stripped = image.strip()
         if not stripped:
             continue
-        split = stripped.split(':', 1)
-        if len(split) > 1:
-            parsed_image = Image(repo=split[0], tag=split[1])
-        else:
-            parsed_image = Image(repo=split[0])
+        try:
+            parsed_image = Image.parse(stripped)
+        except ValueError as exc:
+            logging.warning('Skipping image: %s', exc)
+            continue
         image_list.append(parsed_image)
         logging.info('Repo is: %s', parsed_image)
     return image_list
 
 
-def __pull_images_with_docker(images, pull_timeout):
-    logging.info('Pulling the images')
-    pool = ThreadPool(cpu_count())
-    pool.map(partial(__pull_image, pull_timeout=pull_timeout), images)
-    pool.close()
-    pool.join()
-    logging.info('Images pulled')
-
+def __collapse_tags(args, images, digests=None):
+    """Group the images pointing to the same manifest in the registry
 
-def __pull_image(image, pull_timeout):
-    client = docker.from_env(timeout=int(pull_timeout))
-    logging.info('Pulling %s', image)
-    client.images.pull(repository=image.repo, tag=image.tag)
-    client.close()
+    Images which cannot be resolved are kept in groups of their own.
 
+    :param args: Command line arguments
+    :param images: List of unique images
+    :param digests: Dictionary of manifest digests by image already resolved, optional
+    :return: List of image groups, tagged images first in each group
+    """
+    digests = dict(digests or {})
+    digests.update(__resolve_digests(args, [image for image in images if image not in digests]))
+    return __group_images(images, digests)
 
-def __save_images_to_tar(images, docker_save_filename):
-    logging.info('Saving images to tar')
 
-    list_of_images = ' '.join(map(str, images))
+def __resolve_digests(args, images):
+    """Resolve image tags to manifest digests
 
-    logging.debug('List of images: %s', list_of_images)
+    Tags are resolved from the local image layouts or, unless --offline is
+    given, with the Docker registry API.
 
-    # docker api cannot be used as the save() method doesn't support multiple images.
-    # https://github.com/docker/docker-py/issues/1149
+    :param args: Command line arguments
+    :param images: List of unique images
+    :return: Dictionary of manifest digests by image, None if not resolved
+    """
+    digests = {image: image.digest for image in images}
+    digests.update(__get_local_images(args, [image for image in images if not image.digest]))
+    unresolved = [image for image, digest in digests.items() if digest is None]
+    if not unresolved or getattr(args, 'offline', False):
+        return digests
     try:
-        docker_save_command = f'docker save -o {docker_save_filename} {list_of_images}'
-        output = check_output(docker_save_command.split())
-    except CalledProcessError as exc:
-        logging.error('Docker save command failed:\n%s', exc.stderr)
-        sys.exit(1)
+        docker_api = DockerApi(args.docker_config, args.timeout)
+    except (OSError, ValueError) as exc:
+        logging.warning('Not resolving image tags, could not read Docker configuration: %s', exc)
+        return digests
 
-    logging.debug('Docker save output: %s', output)
+    def resolve(image):
+        try:
+            return 'sha256:' + docker_api.get_manifest_hash(str(image))
+        except (DockerApiError, KeyError) as exc:
+            logging.debug('Could not resolve digest of %s: %s', image, exc)
+            return None
 
-    size = os.path.getsize(docker_save_filename)
-    logging.debug('Docker save size %s bytes', size)
+    with ThreadPoolExecutor(max_workers=cpu_count()) as executor:
+        digests.update(zip(unresolved, executor.map(resolve, unresolved)))
+    return digests
 
 
-def __write_images_to_file(images_file_path, images):
-    with open(images_file_path, 'w+', encoding='utf-8') as temp_images:
-        image_names = list(map(str, images))
-        dump({'images': [{'image': image} for image in image_names]}, temp_images)
+def __group_images(images, digests):
+    """Group the images by repository and manifest digest
 
+    :param images: List of unique images
+    :param digests: Dictionary of manifest digests by image
+    :return: List of image groups, tagged images first in each group
+    """
+    groups = {}
+    for image in images:
+        digest = digests.get(image)
+        key = (image.server, image.repository, digest) if digest else image
+        groups.setdefault(key, []).append(image)
 
-def __pull_images_with_agentk(args, images_file_path, image_path):
-    agentk_env = {'DOCKER_CONFIG': args.docker_config}
-    agentk_command = [
-        '/usr/bin/agent-k', 'export', '--no-scan-chart',
-        '--input', images_file_path, '--output', image_path]
+    for group in groups.values():
+        group.sort(key=lambda image: image.digest is not None)
+        if len(group) > 1:
+            logging.info('Images %s point to the same digest, pulling once',
+                         ', '.join(map(str, group)))
+    return list(groups.values())
 
-    if args.log == 'DEBUG':
-        agentk_command.extend(['--debug'])
 
-    logging.info('Fetching images with Agent-k')
-    try:
-        check_call(agentk_command, env=agentk_env)
-    except CalledProcessError as exc:
-        raise EnvironmentError('Agent-k command failed') from exc
-
-
-def create_docker_tar(directory, args):
+def create_docker_tar(directory, args, hash_algorithms=(), cache=None):
     """Create Docker tar
 
     :param directory: CSAR packaging directory
     :param args: Command line arguments
+    :param hash_algorithms: Hash algorithms to calculate while the tar is written
+    :param cache: BuildCache object reusing the images and the Docker tar of
+        the previous build, optional
     :raises EnvironmentError: Error if packaging failed
     :return: Path to the generated Docker tar
     """
     logging.debug('Helm Arg archives: %s', args.helm)
 
-    images = __get_images(args)
+    images, digests, chart_images = __get_export_images(args, cache)
     image_path = os.path.join(directory, 'Files/images', _DOCKER_SAVE_FILENAME)
 
-    if args.agentk:
-        with TemporaryDirectory() as tempdir:
-            images_file_path = os.path.join(tempdir, 'images.yaml')
-            __write_images_to_file(images_file_path, images)
-            __pull_images_with_agentk(args, images_file_path, image_path)
-    else:
-        __pull_images_with_docker(images, args.timeout)
-        __save_images_to_tar(images, image_path)
+    inputs = None
+    resolved = {}
+    if cache is not None:
+        # Unpinned tags may move in the registry, they are keyed by their current digests
+        resolved = __resolve_digests(args, [image for image in images if image not in digests])
+        unresolved = sorted(str(image) for image, digest in resolved.items() if digest is None)
+        if unresolved:
+            cache.skip('docker-tar', 'digests of unpinned images not resolved: ' +
+                       ', '.join(unresolved))
+            cache = None
+    if cache is not None:
+        inputs = {f'image {image}': digests.get(image) or resolved[image] for image in images}
+        inputs.update(__get_layout_inputs(args))
+        inputs.update({'image exporter': image_exporter.get_exporter_name(args),
+                       'argument collapse_tags': str(getattr(args, 'collapse_tags', False)),
+                       'source date epoch': str(utils.get_source_date_epoch(args))})
+        data = cache.get('docker-tar', inputs)
+        if data is not None:
+            cache.restore('docker-tar', _DOCKER_SAVE_FILENAME, image_path)
+            hash_utils.remember_digests(image_path, data['digests'])
+            __split_docker_tar(image_path, args, chart_images, hash_algorithms)
+            return image_path
+        hash_algorithms = {*hash_algorithms, 'sha-256'}
+
+    try:
+        exporter = image_exporter.get_exporter(args, hash_algorithms,
+                                               utils.get_source_date_epoch(args))
+        image_groups = None
+        if exporter.name == image_exporter.EXPORTER_DOCKER:
+            if digests:
+                image_groups = __group_images(images, digests)
+            elif getattr(args, 'collapse_tags', False):
+                image_groups = __collapse_tags(args, images, resolved)
+        exporter.run(images, image_path, digests, image_groups)
+    except image_exporter.ImageExportError as exc:
+        logging.error('Failed to export the images: %s', exc)
+        sys.exit(1)
 
+    if cache is not None:
+        hash_utils.sha256(image_path)
+        cache.put('docker-tar', inputs, data={'digests': hash_utils.get_digests(image_path)},
+                  files={_DOCKER_SAVE_FILENAME: image_path})
+    __split_docker_tar(image_path, args, chart_images, hash_algorithms)
     return image_path
 
 
+def __get_layout_inputs(args):
+    """Fingerprint the --oci-layout directories by the contents of their index.json
+
+    A layout populated again under the same path changes the fingerprint.
+
+    :param args: Command line arguments
+    :return: Dictionary of cache inputs
+    """
+    inputs = {}
+    for path in getattr(args, 'oci_layout', None) or []:
+        index_path = os.path.join(path, INDEX_FILENAME)
+        inputs[f'oci layout {path}'] = hash_utils.sha256(index_path) \
+            if os.path.isfile(index_path) else 'missing'
+    return inputs
+
+
+def __split_docker_tar(image_path, args, chart_images, hash_algorithms):
+    """Split the Docker tar into an archive per chart or per size cap
+
+    The Docker tar is replaced by the common archive of the shared layers.
+
+    :param image_path: Path of the Docker tar
+    :param args: Command line arguments
+    :param chart_images: List of (chart name, images) tuples
+    :param hash_algorithms: Hash algorithms to calculate while the archives are written
+    """
+    split_images = getattr(args, 'split_images', None)
+    if not split_images:
+        return
+
+    unsplit_path = image_path + '.unsplit'
+    os.replace(image_path, unsplit_path)
+    try:
+        manifest, sizes = docker_archive.read_manifest(unsplit_path)
+        if split_images == SPLIT_IMAGES_CHART:
+            assignments = docker_archive.assign_by_images(manifest, [
+                (re.sub(r'\.tgz$', '', name), images) for name, images in chart_images])
+        else:
+            assignments = docker_archive.assign_by_size(manifest, sizes,
+                                                        args.split_size * 1024 * 1024)
+        logging.info('Splitting %s by %s into %s archives', _DOCKER_SAVE_FILENAME,
+                     split_images, len(set(assignments) - {None}))
+        docker_archive.split_archive(unsplit_path, image_path, assignments, hash_algorithms,
+                                     utils.get_source_date_epoch(args))
+    except (docker_archive.DockerArchiveError, tarfile.TarError, ValueError) as exc:
+        logging.error('Failed to split %s: %s', _DOCKER_SAVE_FILENAME, exc)
+        sys.exit(1)
+    finally:
+        if os.path.exists(unsplit_path):
+            os.remove(unsplit_path)
+
+
+def __get_export_images(args, cache):
+    """Get the images to export, their pinned digests and the images of each chart
+
+    :param args: Command line arguments
+    :param cache: BuildCache object reusing the images of the previous build, optional
+    :return: Tuple of list of images, dictionary of digests by image and
+        list of (chart name, images) tuples
+    """
+    inputs = None
+    if cache is not None:
+        inputs = {f'chart {os.path.basename(path)}': hash_utils.sha256(path)
+                  for path in __get_archive_paths(args)}
+        inputs['arguments'] = __get_lock_options(args)
+        if getattr(args, 'images_lock', None) and os.path.isfile(args.images_lock):
+            inputs['images lock'] = hash_utils.sha256(args.images_lock)
+        data = cache.get('images', inputs)
+        if data is not None and 'charts' in data:
+            return ([Image.parse(image) for image in data['images']],
+                    {Image.parse(image): digest for image, digest in data['digests'].items()},
+                    [(name, [Image.parse(image) for image in images])
+                     for name, images in data['charts']])
+
+    digests = {}
+    if getattr(args, 'images_lock', None):
+        collected_images, digests = __get_locked_chart_images(args)
+    else:
+        collected_images = __collect_images(args, __get_archive_paths(args))
+    images = __deduplicate_images(collected_images)
+    chart_images = [(os.path.basename(path), list(chart_images))
+                    for path, chart_images in collected_images]
+
+    if cache is not None:
+        cache.put('images', inputs, data={
+            'images': list(map(str, images)),
+            'digests': {str(image): digest for image, digest in digests.items()},
+            'charts': [(name, list(map(str, chart_images)))
+                       for name, chart_images in chart_images]})
+    return images, digests, chart_images
+
+
 def create_source(directory, args):
     """Add the source files to CSAR directory
 
@@ -618,11 +1039,12 @@ def create_source(directory, args):
     add_helm_dir_to_chart_path(args, chart_path, helm_chart_dict)
 
     if args.extract_crds:
-        charts = __get_archive_paths(args)
-        for chart in charts:
-            with extract(chart) as helmdir:
-                extract_crds(pathlib.Path(helmdir),
-                             pathlib.Path(chart_path))
+        crds = CrdIndex()
+        crds.add_existing(chart_path)
+        for chart in __get_archive_paths(args):
+            if inventory.get_archive(chart).has_crds():
+                crds.add_archive(chart)
+        crds.write(chart_path)
 
     if args.scale_mapping is not None:
         os.link(os.path.abspath(args.scale_mapping),
@@ -654,7 +1076,7 @@ def add_definitions(args, definitions_path):
     """Add Definitions to chart path"""
     if args.definitions:
         if os.path.isdir(args.definitions):
-            definition_files = [filename for filename in os.listdir(args.definitions) if
+            definition_files = [filename for filename in sorted(os.listdir(args.definitions)) if
                                 os.path.isfile(os.path.join(args.definitions, filename))]
             for definition_file in definition_files:
                 shutil.copy(os.path.join(args.definitions, definition_file), definitions_path)
@@ -665,13 +1087,11 @@ def add_definitions(args, definitions_path):
 def add_helm_dir_to_chart_path(args, chart_path, helm_chart_dict):
     """Add Helm path to chart path"""
     if args.helm_dir:
-        for _, _, files in os.walk(args.helm_dir):
-            for filepath in files:
-                if '.tgz' in filepath:
-                    set_helm_chart_path_to_dict(os.path.join(args.helm_dir, filepath),
-                                                helm_chart_dict)
-                    os.link(os.path.abspath(os.path.join(args.helm_dir, filepath)),
-                            os.path.join(chart_path, filepath))
+        for filepath in inventory.get_helm_dir_charts(args.helm_dir):
+            set_helm_chart_path_to_dict(os.path.join(args.helm_dir, filepath),
+                                        helm_chart_dict)
+            os.link(os.path.abspath(os.path.join(args.helm_dir, filepath)),
+                    os.path.join(chart_path, os.path.basename(filepath)))
 
 
 def add_cnf_values_dir_to_chart_path(args, chart_path, helm_chart_dict):
@@ -720,7 +1140,7 @@ def get_values_cnf_dict(args):
     """Create dictionary of CNF values files."""
     values_cnf_dict = {}
     values_cnf_dir = args.values_cnf_dir
-    for file in os.listdir(values_cnf_dir):
+    for file in sorted(os.listdir(values_cnf_dir)):
         add_file_to_dictionary(file, values_cnf_dict, values_cnf_dir)
     return values_cnf_dict
 
@@ -745,15 +1165,55 @@ def create_docker_tar_link(directory, docker_file):
     return docker_save_path
 
 
+def create_delta(args, docker_file):
+    """Write the layer index of the Docker tar and replace it with a delta against a baseline
+
+    The images section and the VNFD checksums describe the full Docker tar,
+    which is rebuilt from the baseline and the delta before onboarding.
+
+    :param args: Command line arguments
+    :param docker_file: Docker tar in the CSAR packaging directory
+    """
+    members, trailer = docker_archive.read_members(docker_file)
+    archive_digest = hash_utils.sha256(docker_file)
+    if args.layer_index:
+        docker_archive.write_layer_index(args.layer_index, members, archive_digest)
+    if not args.delta_baseline:
+        return
+
+    logging.info('Writing delta of %s against %s', _DOCKER_SAVE_FILENAME, args.delta_baseline)
+    try:
+        baseline_index = docker_archive.read_layer_index(args.delta_baseline)
+    except (docker_archive.DockerArchiveError, zipfile.BadZipFile, tarfile.TarError) as exc:
+        logging.error('Failed to read layer index of %s: %s', args.delta_baseline, exc)
+        sys.exit(1)
+    docker_archive.write_delta(docker_file, members, trailer, baseline_index, archive_digest)
+    os.remove(docker_file)
+
+
 def create_images_section(directory, docker_file):
     """Create images section in CSAR packaging directory
 
+    The images of the archives split from the Docker tar are listed too.
+
     :param directory: CSAR packaging directory
     :param docker_file: Docker tar filename
     """
     __create_images_txt_file(directory, docker_file)
 
 
+def get_image_archives(docker_file):
+    """Get the Docker tar and the archives split from it
+
+    :param docker_file: Docker tar filename
+    :return: List of paths, the Docker tar first
+    """
+    directory, filename = os.path.split(docker_file)
+    stem, extension = os.path.splitext(filename)
+    return [docker_file] + [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+                            if name.startswith(f'{stem}-') and name.endswith(extension)]
+
+
 def empty_images_section(directory):
     """Create empty images section in CSAR packaging directory
 
@@ -777,13 +1237,60 @@ def create_path(directory, arg_to_check, path_in_source):
     return ''
 
 
-def __create_images_txt_file(directory, docker_file):
+def verify_docker_tar_images(docker_file, images):
+    """Verify that a pre-packaged Docker tar contains exactly the given images
+
+    :param docker_file: Docker tar filename
+    :param images: Images referenced by the Helm charts
+    """
+    logging.info('Verifying images in %s', docker_file)
+    tar_images = set(read_docker_tar_images(docker_file))
+    chart_images = set(map(str, images))
+
+    missing = chart_images - tar_images
+    extra = tar_images - chart_images
+
+    if missing:
+        logging.error('Images not found from %s:\n%s',
+                      docker_file, '\n'.join(sorted(missing)))
+    if extra:
+        logging.error('Images in %s not referenced by the Helm charts:\n%s',
+                      docker_file, '\n'.join(sorted(extra)))
+    if missing or extra:
+        sys.exit(1)
+
+    logging.info('All %s images found in %s', len(chart_images), docker_file)
+
+
+def read_docker_tar_images(docker_file):
+    """Read image tags from the manifest.json of a Docker tar
+
+    Only the tar headers are scanned, the image layers are not extracted.
+
+    :param docker_file: Docker tar filename
+    :raises FileNotFoundError: Docker tar does not contain manifest.json
+    :return: List of image tags
+    """
     with tarfile.open(docker_file, encoding='utf-8') as tar:
-        manifest = tar.extractfile('manifest.json')
-        if manifest is None:
-            raise FileNotFoundError('manifest.json')
-        data = json.loads(manifest.read())
-        images = itertools.chain.from_iterable([image['RepoTags'] for image in data])
+        for member in tar:
+            if member.name == 'manifest.json':
+                data = json.loads(tar.extractfile(member).read())
+                return list(itertools.chain.from_iterable(
+                    image.get('RepoTags') or [] for image in data))
+    raise FileNotFoundError('manifest.json')
+
+
+def __create_images_txt_file(directory, docker_file):
+    images = []
+    archives = get_image_archives(docker_file)
+    for archive in archives:
+        try:
+            images.extend(read_docker_tar_images(archive))
+        except FileNotFoundError:
+            if len(archives) == 1:
+                raise
+            # The common archive of a split Docker tar may hold only shared layers
+            logging.debug('No images in %s', archive)
     with open(os.path.join(directory, 'Files/images.txt'), 'w', encoding='utf-8') as entry1:
         entry1.write('\n'.join(images))
 
@@ -825,10 +1332,14 @@ def create_manifest_file(directory, args):
     with open(args.values_csar, encoding='utf-8') as source:
         values_csar_dict = safe_load(source)
 
+    mtime = utils.get_source_date_epoch(args)
+    release_date_time = datetime.now() if mtime is None else \
+        datetime.fromtimestamp(mtime, timezone.utc).replace(tzinfo=None)
+
     manifest_content = 'metadata:\n'
     for metadata_key in METADATA_KEYS_FULL:
         if metadata_key == 'vnf_release_date_time':
-            manifest_content += f'{metadata_key}: {datetime.now().isoformat()}\n'
+            manifest_content += f'{metadata_key}: {release_date_time.isoformat()}\n'
         elif metadata_key in values_csar_dict:
             manifest_content += f'{metadata_key}: {values_csar_dict[metadata_key]}\n'
 
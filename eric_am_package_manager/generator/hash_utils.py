@@ -15,8 +15,13 @@
 # ******************************************************************************
 """Hash utilities"""
 
+import os
 import hashlib
 
+# Digests of files keyed by inode, size and modification time, so that
+# hard links of a file, e.g. charts linked to the CSAR directory, share digests
+_DIGEST_CACHE = {}
+
 
 def sha224(file_path):
     """Hash with SHA-224
@@ -61,14 +66,77 @@ def sha512(file_path):
 def hash_file(file_path, hash_sha):
     """Hash file with given hash function
 
+    Digests already calculated for the same file content are reused.
+
     :param file_path: File to hash
     :param hash_sha: HASH function
     :return: Generated hash
     """
+    digests = _DIGEST_CACHE.setdefault(_get_file_key(file_path), {})
+    if hash_sha.name in digests:
+        return digests[hash_sha.name]
+
     with open(file_path, 'rb') as file:
         for chunk in iter(lambda: file.read(4096), b''):
             hash_sha.update(chunk)
-    return hash_sha.hexdigest()
+    digests[hash_sha.name] = hash_sha.hexdigest()
+    return digests[hash_sha.name]
+
+
+def remember_digests(file_path, digests):
+    """Store digests calculated while the file was written
+
+    :param file_path: Path of the written file
+    :param digests: Dictionary of hashlib algorithm names and hex digests
+    """
+    _DIGEST_CACHE.setdefault(_get_file_key(file_path), {}).update(digests)
+
+
+def get_digests(file_path):
+    """Get digests already calculated for a file
+
+    :param file_path: Path of the file
+    :return: Dictionary of hashlib algorithm names and hex digests
+    """
+    return dict(_DIGEST_CACHE.get(_get_file_key(file_path), {}))
+
+
+def _get_file_key(file_path):
+    stat = os.stat(file_path)
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class HashingWriter:
+    """Writable file object wrapper calculating digests of the written data"""
+
+    def __init__(self, file, algorithms):
+        """Object initialization
+
+        :param file: File object to write to
+        :param algorithms: Hash algorithms in HASH format, e.g. sha-256
+        """
+        self.file = file
+        self.hashes = {name: hashlib.new(name) for name in
+                       {algorithm.replace('-', '') for algorithm in algorithms}}
+        self.size = 0
+
+    def write(self, data):
+        """Write data to the file and update the digests
+
+        :param data: Bytes to write
+        :return: Number of bytes written
+        """
+        for hash_sha in self.hashes.values():
+            hash_sha.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def hexdigests(self):
+        """Get digests of the data written so far
+
+        :return: Dictionary of hashlib algorithm names and hex digests
+        """
+        return {name: hash_sha.hexdigest() for name, hash_sha in self.hashes.items()}
 
 
 # pylint: disable=unnecessary-lambda
@@ -15,18 +15,31 @@
 # ******************************************************************************
 '''Helm template class'''
 
+import re
 import logging
+import threading
+from concurrent.futures import Future
 # pylint: disable=import-error
 import yaml
 
 from .utils import collect_values_of_key_by_type
 
+SOURCE_PATTERN = re.compile(r'^# Source: (\S+)', re.MULTILINE)
+DOCUMENT_SEPARATOR_PATTERN = re.compile(r'^---(?:[ \t].*)?$', re.MULTILINE)
+
+# Futures of the output of helm template keyed by chart digest and command
+_RENDERED_CACHE = {}
+_RENDERED_CACHE_LOCK = threading.Lock()
+
 
 class HelmTemplate:
     """This class contains methods for retrieving information from the rendered chart."""
 
     def __init__(self, helm_template):
-        self.templates = self.__load_into_yaml(helm_template)
+        if isinstance(helm_template, list):
+            self.templates = helm_template
+        else:
+            self.templates = self.__load_into_yaml(helm_template)
 
     def get_images(self):
         """Get all images
@@ -68,3 +81,101 @@ class HelmTemplate:
             decoded_template = helm_template.replace('\t', ' ').rstrip()
 
         return yaml.load_all(decoded_template, Loader=yaml.SafeLoader)
+
+
+class HelmTemplateIndex:
+    """Rendered umbrella chart indexed by the chart each object is rendered from.
+
+    The chart of an object is taken from the "# Source: <chart>/charts/<sub>/templates/..."
+    header Helm writes above each rendered object.
+    """
+
+    def __init__(self, helm_template):
+        self.helm_template = helm_template
+        self.documents = None
+
+    def get_template(self, chart_path=''):
+        """Get rendered objects of a chart and its subcharts
+
+        The rendered output is parsed on the first call.
+
+        :param chart_path: Path of the chart relative to the umbrella chart,
+            e.g. charts/eric-cm-mediator, defaults to the umbrella chart
+        :return: HelmTemplate object
+        """
+        documents = self.documents
+        if documents is None:
+            documents = self.documents = self.__split_by_source(self.helm_template)
+
+        prefix = f'{chart_path}/' if chart_path else ''
+        return HelmTemplate([document for source, document in documents
+                             if source.startswith(prefix)])
+
+    @staticmethod
+    def __split_by_source(helm_template):
+        if isinstance(helm_template, bytes):
+            decoded_template = helm_template.decode('utf-8')
+        else:
+            decoded_template = helm_template.replace('\t', ' ').rstrip()
+
+        documents = []
+        for text in DOCUMENT_SEPARATOR_PATTERN.split(decoded_template):
+            document = yaml.safe_load(text)
+            if document is None:
+                continue
+
+            match = SOURCE_PATTERN.search(text)
+            # Strip the umbrella chart name from the source path
+            source = match.group(1).split('/', 1)[-1] if match else ''
+            documents.append((source, document))
+
+        logging.debug('Indexed %s rendered objects', len(documents))
+        return documents
+
+
+def render_once(chart_digest, helm_command, helm_options, render):
+    """Run helm template once per chart and command
+
+    A caller rendering a chart already being rendered, e.g. the product
+    report while the images are collected, waits for the output instead
+    of running helm template again.
+
+    :param chart_digest: SHA-256 digest of the Helm chart archive, the chart
+                         is always rendered if None
+    :param helm_command: Helm executable
+    :param helm_options: Options of the helm template command
+    :param render: Function running helm template
+    :return: Output of helm template
+    """
+    if not chart_digest:
+        return render()
+
+    key = _get_rendered_key(chart_digest, helm_command, helm_options)
+    with _RENDERED_CACHE_LOCK:
+        rendered = _RENDERED_CACHE.get(key)
+        owner = rendered is None
+        if owner:
+            rendered = _RENDERED_CACHE[key] = Future()
+
+    if owner:
+        try:
+            rendered.set_result(render())
+        except BaseException as exc:
+            with _RENDERED_CACHE_LOCK:
+                del _RENDERED_CACHE[key]
+            rendered.set_exception(exc)
+            raise
+    else:
+        logging.debug('Reusing Helm template of %s', chart_digest)
+    return rendered.result()
+
+
+def _get_rendered_key(chart_digest, helm_command, helm_options):
+    """Get cache key not depending on the order of the options"""
+    options = []
+    for token in helm_options.split():
+        if token.startswith('-') or not options:
+            options.append((token,))
+        else:
+            options[-1] += (token,)
+    return chart_digest, helm_command, tuple(sorted(options))
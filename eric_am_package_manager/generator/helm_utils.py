@@ -16,13 +16,24 @@
 """Helm chart classes for product report"""
 
 import os
+import copy
+import threading
 from subprocess import check_output, CalledProcessError
+from concurrent.futures import ThreadPoolExecutor, Future
 import logging
 
-from .utils import strip_version, load_yaml_file, indent, extract
+from .utils import strip_version, load_yaml_file, indent, extract, get_chart_tree_digest
 from .docker_api import DockerApi, DockerApiError
-from .helm_template import HelmTemplate
+from .helm_template import HelmTemplateIndex, render_once
 from .hash_utils import sha256
+from .image import Image
+
+# Number of images resolved from the registry concurrently
+IMAGE_WORKERS = 8
+
+# Parsed subcharts and CRD packages keyed by content, shared by all charts of the run
+_ANALYSIS_CACHE = {}
+_ANALYSIS_CACHE_LOCK = threading.Lock()
 
 
 class ProductInfo(dict):
@@ -137,8 +148,9 @@ class ImageData(ProductInfo):
         product_number = product_number.replace(' ', '')
         product_revision = labels.get('org.opencontainers.image.version', '')
 
-        image_path, image_tag = image_name.split(':')
-        image_basename = os.path.basename(image_path)
+        image = Image.parse(image_name)
+        image_tag = image.tag or ''
+        image_basename = image.name
 
         return cls(
             product_number=product_number,
@@ -181,13 +193,23 @@ class HelmChart:
             'docker_config': '',
             'helm_command': 'helm3',
             'helm_options': '',
-            'disable_helm_template': False
+            'disable_helm_template': False,
+            'image_workers': IMAGE_WORKERS
         }
 
         self.chart = None
         self.eric_product_info = None
         self.docker_api = None
         self.template = None
+        # Rendered umbrella chart shared by all subcharts and the path of this
+        # chart in it. Subcharts get the path of their parent before parsing.
+        self.template_index = None
+        self.template_path = ''
+        # Name of the chart in the parent Chart.yaml dependencies
+        self.alias = None
+        # Image URLs with their eric-product-info metadata, None for images
+        # found from the Helm template. Resolved after the whole tree is parsed.
+        self.image_refs = []
         self.images = []
         self.packages = []
 
@@ -198,15 +220,30 @@ class HelmChart:
         return str(self.data)
 
     def parse(self):
-        """"Parse Helm chart"""
-        self.docker_api = DockerApi(self.config['docker_config'])
-        self._parse_helm_template()
+        """"Parse Helm chart and its dependencies and resolve their images"""
+        self._parse_tree()
+        self._resolve_images()
+
+    def _parse_tree(self):
+        """Parse Helm chart and its dependencies without resolving images"""
+        if self.docker_api is None:
+            self.docker_api = DockerApi(self.config['docker_config'])
         self._parse_chart_metadata()
+        self._parse_helm_template()
         self._process_chart_metadata()
-        self._add_chart_images()
+        self._collect_chart_images()
         self._scan_crds()
         self._scan_dependencies()
 
+    def _walk(self):
+        """Iterate the chart and its dependencies depth first
+
+        :return: Iterator of HelmChart objects
+        """
+        yield self
+        for package in self.packages:
+            yield from package._walk()  # pylint: disable=protected-access
+
     def set_config(self, **kwargs):
         """Set configuration values"""
         self.config['docker_config'] = kwargs.get('docker_config', self.config['docker_config'])
@@ -214,6 +251,7 @@ class HelmChart:
         self.config['helm_options'] = kwargs.get('helm_options', self.config['helm_options'])
         self.config['disable_helm_template'] = kwargs.get(
             'disable_helm_template', self.config['disable_helm_template'])
+        self.config['image_workers'] = kwargs.get('image_workers', self.config['image_workers'])
 
     def get_components(self):
         """Return all Helm charts and Docker images
@@ -239,7 +277,7 @@ class HelmChart:
 
         :return: List of error messages
         """
-        errors = {self.data.path: self.errors} if self.errors else {}
+        errors = {self.data.path: self._format_messages(self.errors)} if self.errors else {}
 
         for package in self.packages:
             errors.update(package.get_errors())
@@ -251,13 +289,24 @@ class HelmChart:
 
         :return: List of warning messages
         """
-        warnings = {self.data.path: self.warnings} if self.warnings else {}
+        warnings = {self.data.path: self._format_messages(self.warnings)} if self.warnings else {}
 
         for package in self.packages:
             warnings.update(package.get_warnings())
 
         return warnings
 
+    def _format_messages(self, messages):
+        """Format messages depending on the location of the chart
+
+        Such messages are kept as functions of the chart data, so that the
+        copies of an identical chart report their own path.
+
+        :param messages: List of messages or functions taking HelmData object
+        :return: List of messages
+        """
+        return [message(self.data) if callable(message) else message for message in messages]
+
     def _get_annotations(self):
         """Get annotations from Helm template
 
@@ -269,8 +318,9 @@ class HelmChart:
                                  'Option --disable-helm-template '
                                  'enabled.')
 
-        if self.template:
-            return self.template.get_annotations_by_object_kind('ConfigMap')
+        template = self._get_template()
+        if template:
+            return template.get_annotations_by_object_kind('ConfigMap')
         return {}
 
     def _get_images_from_helm_template(self):
@@ -284,25 +334,135 @@ class HelmChart:
                                  '--disable-helm-template enabled.')
 
             return []
-        if self.template:
-            return self.template.get_images()
+        template = self._get_template()
+        if template:
+            return template.get_images()
         return []
 
+    def _get_template(self):
+        """Get rendered objects of this chart from the rendered umbrella chart
+
+        :return: HelmTemplate object, None if the chart is not rendered
+        """
+        if self.template is None and self.template_index is not None:
+            self.template = self.template_index.get_template(self.template_path)
+        return self.template
+
     def _parse_helm_template(self):
-        """Parse Helm template YAML"""
+        """Parse Helm template YAML
+
+        Only the umbrella chart is rendered, subcharts get their objects
+        from the rendered umbrella chart.
+        """
+        self.template = None
         if self.config['disable_helm_template']:
-            self.template = None
+            self.template_index = None
+            return
+
+        if self.template_index is not None and os.path.isdir(self.helmdir):
+            self.template_path = self._get_template_path(self.template_path)
             return
 
+        self.template_path = ''
         try:
             helm_command = self.config['helm_command']
             helm_options = self.config['helm_options']
-            helm_output = check_output(
-                f'{helm_command} template {helm_options} {self.helmdir}'.split())
-            self.template = HelmTemplate(helm_output)
+            helm_output = render_once(
+                self.data['sha256sum'], helm_command, helm_options,
+                lambda: check_output(f'{helm_command} template {helm_options} {self.helmdir}'.split()))
+            self.template_index = HelmTemplateIndex(helm_output)
         except CalledProcessError:
-            self.errors.append(f'Cannot get Helm template for: {self.data.path}')
-            self.template = None
+            self.errors.append(lambda data: f'Cannot get Helm template for: {data.path}')
+            self.template_index = None
+
+    def _get_template_path(self, parent_path):
+        """Get path of the chart in the rendered umbrella chart
+
+        :param parent_path: Path of the parent chart
+        :return: Path of the chart, e.g. charts/eric-cm-mediator
+        """
+        return '/'.join(filter(None, [
+            parent_path, 'charts',
+            self.alias or self.chart.get('name') or os.path.basename(self.helmdir)]))
+
+    def _get_cache_key(self, archive_digest=None):
+        """Get key of the analysis of a subchart or CRD package
+
+        The key of an unpacked subchart does not cover its templates and
+        values. They only affect the analysis through the Helm template,
+        which is not used for the images of charts with eric-product-info.yaml
+        nor for the metadata of subcharts not included in the report.
+
+        :param archive_digest: Digest of the CRD package archive
+        :return: Key, None if the analysis cannot be reused
+        """
+        # Aliases of a chart are rendered separately
+        config = (tuple(sorted(self.config.items())), self.include_helm,
+                  self.template_index is not None, self.alias)
+        if archive_digest is not None:
+            return 'package', archive_digest, config
+
+        if not os.path.isdir(self.helmdir):
+            return None
+
+        tree_digest, all_product_info = get_chart_tree_digest(self.helmdir)
+        # Images of charts without eric-product-info.yaml come from Helm
+        # template, which depends on the values of the umbrella chart
+        if not all_product_info and not self.config['disable_helm_template']:
+            return None
+        return 'chart', tree_digest, config
+
+    def _parse_memoized(self, key, parse):
+        """Parse the chart once per run for identical content
+
+        :param key: Key from _get_cache_key, the chart is always parsed if None
+        :param parse: Function parsing the chart
+        :return: This chart if parsed, else a copy of the identical chart
+        """
+        if key is None:
+            parse()
+            return self
+
+        with _ANALYSIS_CACHE_LOCK:
+            parsed = _ANALYSIS_CACHE.get(key)
+            owner = parsed is None
+            if owner:
+                parsed = _ANALYSIS_CACHE[key] = Future()
+
+        if owner:
+            try:
+                parse()
+            except BaseException as exc:
+                with _ANALYSIS_CACHE_LOCK:
+                    del _ANALYSIS_CACHE[key]
+                parsed.set_exception(exc)
+                raise
+            # Copied before the images of this chart are resolved
+            parsed.set_result(self._copy_for(self.data.path))
+            return self
+
+        logging.debug('Reusing analysis of identical chart for %s', self.data.path)
+        return parsed.result()._copy_for(self.data.path)
+
+    def _copy_for(self, path):
+        """Copy parsed chart and its dependencies to another location
+
+        The rendered objects are shared, they are not used after parsing.
+
+        :param path: Full logical path of the copy
+        :return: HelmChart object with unresolved images
+        """
+        chart = copy.copy(self)
+        chart.data = copy.copy(self.data)
+        chart.data.path = path
+        chart.data['package'] = os.path.basename(path)
+        chart.errors = list(self.errors)
+        chart.warnings = list(self.warnings)
+        chart.image_refs = list(self.image_refs)
+        chart.images = []
+        chart.packages = [package._copy_for(path + package.data.path[len(self.data.path):])
+                          for package in self.packages]
+        return chart
 
     def _parse_chart_metadata(self):
         """Parse Helm chart metadata as dictionary"""
@@ -335,8 +495,8 @@ class HelmChart:
         self.data['product_version'] = product_version
 
         if not self.data.is_valid() and self.include_helm:
-            self.errors.append(f'Chart metadata not valid on:\n'
-                               f'{indent(repr(self.data))}')
+            self.errors.append(lambda data: f'Chart metadata not valid on:\n'
+                                            f'{indent(repr(data))}')
 
         logging.debug('%s added', self.data)
 
@@ -351,15 +511,22 @@ class HelmChart:
         for crd_package in sorted(os.listdir(crd_dir)):
             helm_sha256 = sha256(os.path.join(crd_dir, crd_package))
 
-            with extract(os.path.join(crd_dir, crd_package)) as helm:
-                crd = HelmChart(helm,
-                                f'{self.data.path}/eric-crd/{crd_package}',
-                                helm_sha256,
-                                include_helm=True)
-                crd.set_config(**self.config)
-                crd.parse()
-                self.packages.append(crd)
-                logging.info('Found CRD %s from %s, sha256: %s', crd, self, helm_sha256)
+            crd = HelmChart(os.path.join(crd_dir, crd_package),
+                            f'{self.data.path}/eric-crd/{crd_package}',
+                            helm_sha256,
+                            include_helm=True)
+            crd.set_config(**self.config)
+            crd.docker_api = self.docker_api
+            # pylint: disable=protected-access
+            crd = crd._parse_memoized(crd._get_cache_key(helm_sha256), crd._parse_archive)
+            self.packages.append(crd)
+            logging.info('Found CRD %s from %s, sha256: %s', crd, self, helm_sha256)
+
+    def _parse_archive(self):
+        """Parse Helm chart archive and its dependencies without resolving images"""
+        with extract(self.helmdir) as helmdir:
+            self.helmdir = helmdir
+            self._parse_tree()
 
     def _scan_dependencies(self):
         """Add dependent Helm charts"""
@@ -371,13 +538,37 @@ class HelmChart:
 
         for dependency in sorted(os.listdir(charts_dir)):
             chart_path = os.path.join(charts_dir, dependency)
-            helm = HelmChart(chart_path,
-                             f'{self.data.path}/charts/{dependency}',
-                             include_helm=False)
-            helm.set_config(**self.config)
-            helm.parse()
-            self.packages.append(helm)
-            logging.debug('Found dependency %s from %s', helm, self)
+            # A chart used under several aliases is rendered once per alias
+            for alias in self._get_dependency_aliases(chart_path):
+                helm = HelmChart(chart_path,
+                                 f'{self.data.path}/charts/{alias or dependency}',
+                                 include_helm=False)
+                helm.set_config(**self.config)
+                helm.docker_api = self.docker_api
+                helm.alias = alias
+                if self.template_index is not None:
+                    helm.template_index = self.template_index
+                    helm.template_path = self.template_path
+                # pylint: disable=protected-access
+                helm = helm._parse_memoized(helm._get_cache_key(), helm._parse_tree)
+                self.packages.append(helm)
+                logging.debug('Found dependency %s from %s', helm, self)
+
+    def _get_dependency_aliases(self, chart_path):
+        """Get aliases of a dependency in Chart.yaml
+
+        :param chart_path: Path of the dependency in the charts directory
+        :return: List of aliases, None for the dependency used without an alias
+        """
+        dependencies = (self.chart or {}).get('dependencies') or []
+        if not os.path.isdir(chart_path) or not any(dependency.get('alias')
+                                                    for dependency in dependencies):
+            return [None]
+
+        name = load_yaml_file(os.path.join(chart_path, 'Chart.yaml')).get('name')
+        aliases = [dependency.get('alias') for dependency in dependencies
+                   if dependency.get('name') == name]
+        return list(dict.fromkeys(aliases)) or [None]
 
     def _add_image(self, image_metadata):
         """Add an image to images list
@@ -393,16 +584,60 @@ class HelmChart:
         self.images.append(image_metadata)
         logging.debug('%s added from %s', image_metadata, self.data)
 
-    def _add_images_from_eric_product_info(self):
-        """Add images from eric-product-info
+    def _collect_chart_images(self):
+        """Collect URLs of dependent Docker images"""
+        if self.eric_product_info:  # get images through eric_product_info.yaml
+            for _, image_metadata in self.eric_product_info.get('images', {}).items():
+                self.image_refs.append((ImageData.get_image_url(image_metadata),
+                                        image_metadata))
+        else:  # Get images through Helm template
+            self.image_refs.extend((image_url, None)
+                                   for image_url in self._get_images_from_helm_template())
+
+    def _resolve_images(self):
+        """Resolve images of the whole chart tree
+
+        Manifest hashes and labels of the unique images are fetched
+        concurrently, then added to the charts in the order they were found.
         """
-        for _, image_metadata in self.eric_product_info.get('images', {}).items():
-            image_url = ImageData.get_image_url(image_metadata)
+        charts = list(self._walk())
+        # References of the same image are fetched once with the first spelling
+        image_urls = {}
+        for chart in charts:
+            for image_url, _ in chart.image_refs:
+                image_urls.setdefault(_get_image(image_url), image_url)
+
+        with ThreadPoolExecutor(max_workers=self.config['image_workers']) as executor:
+            resolved = dict(zip(image_urls,
+                                executor.map(self._fetch_image, image_urls.values())))
+
+        for chart in charts:
+            chart._add_chart_images(resolved)  # pylint: disable=protected-access
+
+    def _fetch_image(self, image_url):
+        """Fetch manifest hash and labels of an image
+
+        Errors are returned instead of raised so that they can be reported
+        on each chart using the image.
+
+        :param image_url: Docker image URL
+        :return: Dictionary of (value, exception) tuples
+        """
+        logging.debug('Resolving image %s', image_url)
+        return {'sha256sum': _call(self.docker_api.get_manifest_hash, image_url),
+                'labels': _call(self.docker_api.get_labels, image_url)}
+
+    def _add_images_from_eric_product_info(self, resolved):
+        """Add images from eric-product-info
 
+        :param resolved: Fetched image data by image
+        """
+        for image_url, image_metadata in self.image_refs:
+            fetched = resolved[_get_image(image_url)]
             try:
-                sha256sum = self.docker_api.get_manifest_hash(image_url)
+                sha256sum = _result(fetched['sha256sum'])
                 eric_info_data = ImageData.from_product_info(image_metadata, sha256sum)
-                labels = self.docker_api.get_labels(image_url)
+                labels = _result(fetched['labels'])
                 labels_data = ImageData.from_labels(image_url, labels, sha256sum)
             except DockerApiError as exc:
                 self.errors.append(str(exc))
@@ -429,23 +664,63 @@ class HelmChart:
             else:
                 self._add_image(eric_info_data)
 
-    def _add_images_from_helm_template(self):
+    def _add_images_from_helm_template(self, resolved):
         """Add images from Helm template
-        """
-        images = self._get_images_from_helm_template()
 
-        for image_url in images:
+        :param resolved: Fetched image data by image
+        """
+        for image_url, _ in self.image_refs:
+            fetched = resolved[_get_image(image_url)]
             try:
-                labels = self.docker_api.get_labels(image_url)
-                sha256sum = self.docker_api.get_manifest_hash(image_url)
+                labels = _result(fetched['labels'])
+                sha256sum = _result(fetched['sha256sum'])
                 labels_data = ImageData.from_labels(image_url, labels, sha256sum)
                 self._add_image(labels_data)
             except DockerApiError as exc:
                 self.errors.append(f'Could not add {image_url}: {str(exc)}')
 
-    def _add_chart_images(self):
-        """Add dependent Docker images to chart data"""
+    def _add_chart_images(self, resolved):
+        """Add dependent Docker images to chart data
+
+        :param resolved: Fetched image data by image
+        """
         if self.eric_product_info:  # get images through eric_product_info.yaml
-            self._add_images_from_eric_product_info()
+            self._add_images_from_eric_product_info(resolved)
         else:  # Get images through Helm template
-            self._add_images_from_helm_template()
+            self._add_images_from_helm_template(resolved)
+
+
+def _get_image(image_url):
+    """Get the image of a URL for finding fetched image data
+
+    :param image_url: Docker image URL
+    :return: Image object, the URL itself if it cannot be parsed
+    """
+    try:
+        return Image.parse(image_url)
+    except ValueError:
+        return image_url
+
+
+def _call(function, *args):
+    """Call a function catching the exception
+
+    :return: Tuple of return value and exception
+    """
+    try:
+        return function(*args), None
+    except Exception as exc:  # pylint: disable=broad-except
+        return None, exc
+
+
+def _result(outcome):
+    """Get return value of a function called with _call
+
+    :param outcome: Tuple of return value and exception
+    :raises Exception: Exception raised by the function
+    :return: Return value of the function
+    """
+    value, exc = outcome
+    if exc is not None:
+        raise exc
+    return value
@@ -15,22 +15,160 @@
 # ******************************************************************************
 '''Docker image classes'''
 
+import re
+
+DEFAULT_REGISTRY = 'docker.io'
+DEFAULT_PATH = 'library'
+DEFAULT_TAG = 'latest'
+# Registry names of Docker Hub normalized to DEFAULT_REGISTRY
+DOCKER_HUB_REGISTRIES = ('docker.io', 'index.docker.io', 'registry-1.docker.io')
+
+# [<registry>[:<port>]/][<path>/]<name>[:<tag>][@<digest>]
+REFERENCE_PATTERN = re.compile(r'(?P<repo>[^:@]+(?::[0-9]+/[^:@]+)?)'
+                               r'(?::(?P<tag>[^:@/]+))?'
+                               r'(?:@(?P<digest>[A-Za-z0-9_+.-]+:[0-9A-Fa-f]+))?')
+
 
 class Image:
     """Holds information about a docker image.
-        repo is mandatory, tag is optional"""
+        repo is mandatory, tag is optional
+
+    Images are immutable and interned, creating an image with the same
+    repo, tag and digest returns the same object. Images are equal when
+    their normalized references are equal, e.g. nginx and
+    docker.io/library/nginx:latest.
+    """
+
+    __slots__ = ('repo', 'tag', 'digest', 'registry', 'port', 'path', 'name',
+                 'reference', 'canonical', '_hash')
+
+    _interned = {}
+    _parsed = {}
+
+    def __new__(cls, repo, tag=DEFAULT_TAG, digest=None):
+        key = repo, tag, digest
+        image = cls._interned.get(key)
+        if image is None:
+            image = cls._interned.setdefault(key, cls._create(repo, tag, digest))
+        return image
+
+    @classmethod
+    def _create(cls, repo, tag, digest):
+        image = object.__new__(cls)
+        registry, port, path, name = cls.split_repo(repo)
+        reference = repo
+        canonical = f'{registry}:{port}' if port else registry
+        canonical = '/'.join(filter(None, (canonical, path, name)))
+        if tag:
+            reference += ':' + tag
+            canonical += ':' + tag
+        if digest:
+            reference += '@' + digest
+            canonical += '@' + digest
+
+        for attribute, value in (('repo', repo), ('tag', tag), ('digest', digest),
+                                 ('registry', registry), ('port', port), ('path', path),
+                                 ('name', name), ('reference', reference),
+                                 ('canonical', canonical), ('_hash', hash(canonical))):
+            object.__setattr__(image, attribute, value)
+        return image
+
+    @classmethod
+    def parse(cls, reference):
+        """Parse image reference
+
+        :param reference: Image reference, e.g. host:5000/path/name:tag@sha256:<hex>
+        :raises ValueError: Invalid image reference
+        :return: Image object, tag is latest if neither tag nor digest is given
+
+        >>> Image.parse('host:5000/path/name:1.0.0').tag
+        '1.0.0'
+        >>> Image.parse('nginx') == Image.parse('docker.io/library/nginx:latest')
+        True
+        """
+        image = cls._parsed.get(reference)
+        if image is not None:
+            return image
+
+        match = REFERENCE_PATTERN.fullmatch(reference)
+        if not match:
+            raise ValueError(f'Invalid image reference {reference}')
+
+        repo, tag, digest = match.group('repo', 'tag', 'digest')
+        if tag is None and digest is None:
+            tag = DEFAULT_TAG
+        return cls._parsed.setdefault(reference, cls(repo, tag, digest))
+
+    @staticmethod
+    def split_repo(repo):
+        """Split repository to normalized components
+
+        :param repo: Repository part of an image reference
+        :return: Tuple of registry, port, path and name
+
+        >>> Image.split_repo('armdocker.rnd.ericsson.se/proj/sub/name')
+        ('armdocker.rnd.ericsson.se', None, 'proj/sub', 'name')
+        >>> Image.split_repo('localhost:5000/name')
+        ('localhost', 5000, '', 'name')
+        >>> Image.split_repo('nginx')
+        ('docker.io', None, 'library', 'nginx')
+        """
+        components = repo.split('/')
+        first = components[0]
+        if len(components) > 1 and ('.' in first or ':' in first or first == 'localhost'):
+            registry = components.pop(0)
+        else:
+            registry = DEFAULT_REGISTRY
+
+        port = None
+        if ':' in registry:
+            registry, port = registry.split(':', 1)
+            port = int(port)
+
+        registry = registry.lower()
+        if registry in DOCKER_HUB_REGISTRIES:
+            registry = DEFAULT_REGISTRY
+            if len(components) == 1:
+                components.insert(0, DEFAULT_PATH)
+
+        return registry, port, '/'.join(components[:-1]), components[-1]
+
+    @property
+    def server(self):
+        """Registry host with port"""
+        return f'{self.registry}:{self.port}' if self.port else self.registry
+
+    @property
+    def repository(self):
+        """Repository path in the registry"""
+        return '/'.join(filter(None, (self.path, self.name)))
+
+    @property
+    def version(self):
+        """Digest or tag to pull the image with"""
+        return self.digest or self.tag
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __reduce__(self):
+        return type(self), (self.repo, self.tag, self.digest)
 
-    def __init__(self, repo, tag='latest'):
-        self.repo = repo
-        self.tag = tag
+    def __repr__(self):
+        return f'{type(self).__name__}({self.reference!r})'
 
     def __str__(self):
-        return self.repo + ":" + self.tag
+        return self.reference
 
     def __hash__(self):
-        return hash(self.__str__())
+        return self._hash
 
     def __eq__(self, other):
+        if self is other:
+            return True
         if isinstance(other, Image):
-            return self.__str__() == other.__str__()
+            return self._hash == other._hash and self.canonical == other.canonical
         return False
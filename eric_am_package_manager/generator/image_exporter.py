@@ -0,0 +1,682 @@
+# ******************************************************************************
+# COPYRIGHT Ericsson 2024
+#
+#
+#
+# The copyright to the computer program(s) herein is the property of
+#
+# Ericsson Inc. The programs may be used and/or copied only with written
+#
+# permission from Ericsson Inc. or in accordance with the terms and
+#
+# conditions stipulated in the agreement/contract under which the
+#
+# program(s) have been supplied.
+# ******************************************************************************
+"""Exporters writing container images to an image archive in the docker save format"""
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import hashlib
+import logging
+import tarfile
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing import cpu_count
+from subprocess import check_call, CalledProcessError, Popen, PIPE
+from tempfile import TemporaryDirectory
+
+# pylint: disable=import-error
+import docker
+from yaml import dump
+
+from . import hash_utils, docker_archive
+from .docker_api import DockerApi, DockerApiError
+from .oci_layout import ImageSources, OciLayoutError, MANIFEST_MEDIA_TYPE, DEFAULT_PLATFORM, \
+    is_index, select_platform_manifest
+
+EXPORTER_DOCKER = 'docker'
+EXPORTER_AGENTK = 'agent-k'
+EXPORTER_REGISTRY = 'registry'
+EXPORTER_OCI_LAYOUT = 'oci-layout'
+
+_COPY_BUFFER_SIZE = 1024 * 1024
+_EXPORTERS = {}
+
+
+class ImageExportError(Exception):
+    """Image export error"""
+
+
+class ExportProgress:
+    """Progress events and byte counters of an image export
+
+    Every exporter reports the same events, so that the logs and the
+    summary of different exporters can be compared for the same images.
+    """
+
+    def __init__(self, exporter, total):
+        """Object initialization
+
+        :param exporter: Name of the exporter
+        :param total: Number of images to export
+        """
+        self.exporter = exporter
+        self.total = total
+        self.images = 0
+        self.bytes_fetched = 0
+        self.bytes_local = 0
+        self.bytes_written = 0
+        self.started = time.monotonic()
+        self.seconds = None
+        self._lock = threading.Lock()
+        logging.info('Export [%s]: exporting %s images', exporter, total)
+
+    def image_done(self, image, size=0, local_size=0):
+        """Record an image fetched from its source
+
+        :param image: Image object
+        :param size: Number of bytes fetched for the image, 0 if not known
+        :param local_size: Number of bytes read from the local image layouts
+        """
+        with self._lock:
+            self.images += 1
+            self.bytes_fetched += size
+            self.bytes_local += local_size
+            count = self.images
+        logging.info('Export [%s]: %s/%s %s, %s bytes fetched, %s bytes local', self.exporter,
+                     count, self.total, image, size, local_size)
+
+    def finish(self, bytes_written):
+        """Record the end of the export
+
+        :param bytes_written: Size of the written archive
+        :return: Summary dictionary
+        """
+        self.bytes_written = bytes_written
+        self.seconds = time.monotonic() - self.started
+        rate = bytes_written / self.seconds / 1024 / 1024 if self.seconds else 0
+        logging.info('Export [%s]: %s images, %s bytes fetched, %s bytes local, %s bytes written '
+                     'in %.1f s (%.1f MB/s)', self.exporter, self.images, self.bytes_fetched,
+                     self.bytes_local, bytes_written, self.seconds, rate)
+        return self.get_summary()
+
+    def get_summary(self):
+        """Get the counters of the export
+
+        :return: Summary dictionary
+        """
+        return {'exporter': self.exporter, 'images': self.images,
+                'bytes_fetched': self.bytes_fetched, 'bytes_local': self.bytes_local,
+                'bytes_written': self.bytes_written,
+                'seconds': self.seconds}
+
+
+def register(name):
+    """Class decorator registering an exporter
+
+    :param name: Name of the exporter selected with --image-exporter
+    """
+    def decorator(cls):
+        cls.name = name
+        _EXPORTERS[name] = cls
+        return cls
+    return decorator
+
+
+def get_exporter_names():
+    """Get the names of the registered exporters"""
+    return list(_EXPORTERS)
+
+
+def get_exporter_name(args):
+    """Get the name of the exporter selected by the command line arguments
+
+    :param args: Command line arguments
+    :return: Exporter name, agent-k with --agentk, docker by default
+    """
+    name = getattr(args, 'image_exporter', None)
+    if name:
+        return name
+    return EXPORTER_AGENTK if getattr(args, 'agentk', False) else EXPORTER_DOCKER
+
+
+def get_exporter(args, hash_algorithms=(), mtime=None):
+    """Create the exporter selected by the command line arguments
+
+    :param args: Command line arguments
+    :param hash_algorithms: Hash algorithms to calculate while the archive is written
+    :param mtime: Modification time of a reproducible archive, optional
+    :return: ImageExporter object
+    """
+    return _EXPORTERS[get_exporter_name(args)](args, hash_algorithms, mtime)
+
+
+class ImageExporter(ABC):
+    """Base class of the image exporters
+
+    An exporter writes the images to an image archive loadable with docker
+    load. Archives of exporters which are not deterministic are rewritten
+    with docker_archive.normalize_archive for reproducible builds.
+
+    The images found from the local image layouts of --oci-layout and
+    --blob-cache are read from them instead of the source of the exporter.
+    With --offline all images must be found from the local image layouts.
+    """
+
+    name = None
+    deterministic = False
+    # Exporters reading the local image layouts themselves
+    reads_sources = False
+
+    def __init__(self, args, hash_algorithms=(), mtime=None):
+        """Object initialization
+
+        :param args: Command line arguments
+        :param hash_algorithms: Hash algorithms to calculate while the archive is written
+        :param mtime: Modification time of a reproducible archive, optional
+        """
+        self.args = args
+        self.hash_algorithms = hash_algorithms
+        self.mtime = mtime
+        self.workers = getattr(args, 'export_workers', None) or cpu_count()
+        self.offline = getattr(args, 'offline', False)
+        self.progress = None
+        try:
+            self.sources = ImageSources.from_args(args)
+        except OciLayoutError as exc:
+            raise ImageExportError(str(exc)) from exc
+
+    def run(self, images, filename, digests=None, image_groups=None):
+        """Export the images to an archive
+
+        :param images: List of unique images
+        :param filename: Path of the archive to write
+        :param digests: Dictionary of pinned manifest digests by image, optional
+        :param image_groups: List of image groups pointing to the same manifest, optional
+        :return: Summary dictionary of the export progress
+        """
+        images = sorted(images, key=str) if self.mtime is not None else list(images)
+        self.progress = ExportProgress(self.name, len(images))
+        digests = digests or {}
+        image_groups = image_groups or [[image] for image in images]
+        local = {image for image in images if self.sources.find(image, digests.get(image))}
+        if self.offline and len(local) < len(images):
+            raise ImageExportError('Images not found from the local image layouts:\n' + '\n'.join(
+                str(image) for image in images if image not in local))
+
+        if self.mtime is None or self.deterministic:
+            self._export(images, filename, self.hash_algorithms, digests, image_groups, local)
+        else:
+            saved_filename = filename + '.save'
+            self._export(images, saved_filename, (), digests, image_groups, local)
+            logging.info('Writing reproducible Docker tar')
+            with open(filename, 'wb') as tar_file:
+                writer = hash_utils.HashingWriter(tar_file, self.hash_algorithms)
+                docker_archive.normalize_archive(saved_filename, writer, self.mtime)
+            hash_utils.remember_digests(filename, writer.hexdigests())
+            os.remove(saved_filename)
+        return self.progress.finish(os.path.getsize(filename))
+
+    def _export(self, images, filename, hash_algorithms, digests, image_groups, local):
+        """Export the local images with OciLayoutExporter and the others with this exporter"""
+        if self.reads_sources or not local:
+            self.export(images, filename, hash_algorithms, digests, image_groups)
+            return
+        logging.info('Reading %s of %s images from the local image layouts', len(local),
+                     len(images))
+        local_exporter = OciLayoutExporter(self.args, (), self.mtime)
+        local_exporter.sources = self.sources
+        local_exporter.progress = self.progress
+        local_images = [image for image in images if image in local]
+        if len(local_images) == len(images):
+            local_exporter.export(local_images, filename, hash_algorithms, digests, [])
+            return
+
+        remote_images = [image for image in images if image not in local]
+        remote_groups = [[image for image in group if image not in local]
+                         for group in image_groups]
+        with TemporaryDirectory(dir=os.path.dirname(os.path.abspath(filename))) as tempdir:
+            local_filename = os.path.join(tempdir, 'local.tar')
+            remote_filename = os.path.join(tempdir, 'remote.tar')
+            local_exporter.export(local_images, local_filename, (), digests, [])
+            self.export(remote_images, remote_filename, (), digests,
+                        [group for group in remote_groups if group])
+            with open(filename, 'wb') as tar_file:
+                writer = hash_utils.HashingWriter(tar_file, hash_algorithms)
+                try:
+                    docker_archive.merge_archives([local_filename, remote_filename], writer,
+                                                  self.mtime)
+                except docker_archive.DockerArchiveError as exc:
+                    raise ImageExportError(f'Failed to merge the local images: {exc}') from exc
+        hash_utils.remember_digests(filename, writer.hexdigests())
+
+    @abstractmethod
+    def export(self, images, filename, hash_algorithms, digests, image_groups):
+        """Write the images to an archive
+
+        The digests of the archive are remembered with hash_utils.remember_digests.
+
+        :param images: List of unique images
+        :param filename: Path of the archive to write
+        :param hash_algorithms: Hash algorithms to calculate while the archive is written
+        :param digests: Dictionary of pinned manifest digests by image
+        :param image_groups: List of image groups pointing to the same manifest
+        """
+
+
+@register(EXPORTER_DOCKER)
+class DockerExporter(ImageExporter):
+    """Pulls the images with the Docker daemon and saves them with docker save"""
+
+    def export(self, images, filename, hash_algorithms, digests, image_groups):
+        self.pull_images(image_groups, digests)
+        self.save_images(images, filename, hash_algorithms)
+
+    def pull_images(self, image_groups, digests):
+        """Pull the image groups concurrently
+
+        :param image_groups: List of image groups pointing to the same manifest
+        :param digests: Dictionary of pinned manifest digests by image
+        """
+        logging.info('Pulling the images')
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(lambda images: self.pull_image(images, digests), image_groups))
+        logging.info('Images pulled')
+
+    def pull_image(self, images, digests=None):
+        """Pull the first image of a group and tag it as the other images
+
+        :param images: List of images pointing to the same manifest
+        :param digests: Dictionary of pinned manifest digests by image, the
+            images are pulled by digest and tagged if given
+        """
+        client = docker.from_env(timeout=int(self.args.timeout))
+        image = images[0]
+        digest = None if image.digest else (digests or {}).get(image)
+        logging.info('Pulling %s%s', image, f' by digest {digest}' if digest else '')
+        pulled = client.images.pull(repository=image.repo, tag=digest or image.version)
+        for other in images if digest else images[1:]:
+            # Digest references are found from the repository digests of the pulled image
+            if not other.digest:
+                logging.info('Tagging %s as %s', image, other)
+                pulled.tag(other.repo, other.tag)
+        client.close()
+        size = pulled.attrs.get('Size')
+        for other in images:
+            self.progress.image_done(other, size if other is image and isinstance(size, int) else 0)
+
+    def save_images(self, images, filename, hash_algorithms):
+        """Stream the output of docker save to the tar file
+
+        The digests of the tar file are calculated while it is written, so
+        the checksums of the VNFD need not read it back. The tar file is
+        still staged in the CSAR directory, where the CSAR writer and the
+        manifest digests read it. With
+        --save-workers disjoint sets of the images are saved concurrently to
+        temporary tar files, which are merged into the tar file.
+
+        :param images: Images to save
+        :param filename: Path of the tar file to write
+        :param hash_algorithms: Hash algorithms to calculate, e.g. sha-256
+        """
+        logging.info('Saving images to tar')
+        list_of_images = list(map(str, images))
+        logging.debug('List of images: %s', ' '.join(list_of_images))
+
+        workers = max(1, min(getattr(self.args, 'save_workers', 1), len(list_of_images)))
+        with open(filename, 'wb') as tar_file:
+            writer = hash_utils.HashingWriter(tar_file, hash_algorithms)
+            if workers > 1:
+                self._save_concurrently(list_of_images, writer, workers,
+                                        os.path.dirname(os.path.abspath(filename)))
+            else:
+                self.docker_save(list_of_images, writer)
+
+        hash_utils.remember_digests(filename, writer.hexdigests())
+        logging.debug('Docker save size %s bytes', writer.size)
+
+    def _save_concurrently(self, list_of_images, output, workers, directory):
+        with TemporaryDirectory(dir=directory) as tempdir:
+            subsets = [list_of_images[index::workers] for index in range(workers)]
+            subset_filenames = [os.path.join(tempdir, f'save-{index}.tar')
+                                for index in range(workers)]
+            logging.info('Saving images with %s concurrent docker save commands', workers)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(self._save_subset, subsets, subset_filenames))
+            try:
+                docker_archive.merge_archives(subset_filenames, output, self.mtime)
+            except docker_archive.DockerArchiveError as exc:
+                logging.error('Failed to merge the saved images: %s', exc)
+                sys.exit(1)
+
+    def _save_subset(self, list_of_images, filename):
+        with open(filename, 'wb') as tar_file:
+            self.docker_save(list_of_images, tar_file)
+
+    @staticmethod
+    def docker_save(list_of_images, output):
+        """Run docker save for the images
+
+        :param list_of_images: Image references
+        :param output: Binary file object to write the tar to
+        """
+        # docker api cannot be used as the save() method doesn't support multiple images.
+        # https://github.com/docker/docker-py/issues/1149
+        # stderr goes to a file, an undrained pipe would block docker save when full
+        with tempfile.TemporaryFile() as stderr:
+            with Popen(['docker', 'save', *list_of_images], stdout=PIPE, stderr=stderr) as process:
+                shutil.copyfileobj(process.stdout, output, _COPY_BUFFER_SIZE)
+            if process.returncode != 0:
+                stderr.seek(0)
+                logging.error('Docker save command failed:\n%s',
+                              stderr.read().decode(errors='replace'))
+                sys.exit(1)
+
+
+@register(EXPORTER_AGENTK)
+class AgentkExporter(ImageExporter):
+    """Exports the images with Agent K"""
+
+    def export(self, images, filename, hash_algorithms, digests, image_groups):
+        with TemporaryDirectory() as tempdir:
+            images_file_path = os.path.join(tempdir, 'images.yaml')
+            with open(images_file_path, 'w+', encoding='utf-8') as temp_images:
+                dump({'images': [{'image': str(image)} for image in images]}, temp_images)
+
+            agentk_command = [
+                '/usr/bin/agent-k', 'export', '--no-scan-chart',
+                '--input', images_file_path, '--output', filename]
+            if self.args.log == 'DEBUG':
+                agentk_command.extend(['--debug'])
+
+            logging.info('Fetching images with Agent-k')
+            try:
+                check_call(agentk_command, env={'DOCKER_CONFIG': self.args.docker_config})
+            except CalledProcessError as exc:
+                raise EnvironmentError('Agent-k command failed') from exc
+
+        # Agent K reports no progress of its own
+        for image in images:
+            self.progress.image_done(image)
+
+
+class BlobExporter(ImageExporter):
+    """Base class of the exporters writing the manifests and blobs of the images
+
+    The archive contains the blobs of the images once under blobs/sha256
+    with manifest.json for docker load and index.json and oci-layout for
+    OCI tools. The digest of each blob is verified while it is written.
+
+    Manifests and blobs found from the local image layouts are streamed to
+    the archive from their files, only the rest are fetched from the source
+    of the exporter.
+    """
+
+    deterministic = True
+    reads_sources = True
+
+    def __init__(self, args, hash_algorithms=(), mtime=None):
+        super().__init__(args, hash_algorithms, mtime)
+        self._blobs = {}
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def get_manifest(self, image, digest):
+        """Get the manifest of an image
+
+        :param image: Image object
+        :param digest: Pinned manifest digest, optional
+        :raises ImageExportError: Image not found
+        :return: Manifest bytes
+        """
+
+    @abstractmethod
+    def fetch_blob(self, image, descriptor, directory):
+        """Make a blob of an image available as a file
+
+        :param image: Image object
+        :param descriptor: Blob descriptor of the manifest
+        :param directory: Directory for downloaded blobs
+        :return: Tuple of the path of the blob file and the number of bytes fetched
+        """
+
+    def export(self, images, filename, hash_algorithms, digests, image_groups):
+        with TemporaryDirectory(dir=os.path.dirname(os.path.abspath(filename))) as tempdir:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                fetched = list(executor.map(
+                    lambda image: self._fetch_image(image, digests.get(image), tempdir), images))
+            with open(filename, 'wb') as tar_file:
+                writer = hash_utils.HashingWriter(tar_file, hash_algorithms)
+                self._write_archive(writer, fetched)
+        hash_utils.remember_digests(filename, writer.hexdigests())
+
+    def _fetch_image(self, image, digest, directory):
+        found = self.sources.find(image, digest)
+        if found is not None:
+            layout, descriptor = found
+            content = layout.read_blob(descriptor['digest'])
+        else:
+            content = self.get_manifest(image, digest)
+        try:
+            manifest = json.loads(content)
+            media_type = manifest.get('mediaType', MANIFEST_MEDIA_TYPE)
+            if is_index(manifest):
+                platform = select_platform_manifest(manifest)
+                if platform is None:
+                    raise ImageExportError(f'No {DEFAULT_PLATFORM["os"]}/'
+                                           f'{DEFAULT_PLATFORM["architecture"]} manifest in the '
+                                           f'index of {image}')
+                content = self.get_manifest(image, platform['digest'])
+                manifest = json.loads(content)
+                media_type = manifest.get('mediaType', platform.get('mediaType',
+                                                                    MANIFEST_MEDIA_TYPE))
+            descriptors = [manifest['config'], *manifest['layers']]
+        except (ValueError, KeyError, TypeError) as exc:
+            raise ImageExportError(f'Invalid manifest of {image}: {exc}') from exc
+
+        size = 0
+        local_size = 0
+        paths = {}
+        for descriptor in descriptors:
+            paths[descriptor['digest']], blob_size, blob_local_size = self._get_blob(
+                image, descriptor, directory)
+            size += blob_size
+            local_size += blob_local_size
+        if found is None and self.sources.cache is not None:
+            self.sources.cache.add_image(image, content, media_type)
+        self.progress.image_done(image, size, local_size)
+        return image, content, media_type, descriptors, paths
+
+    def _get_blob(self, image, descriptor, directory):
+        """Fetch a blob once for all images, local blobs are not fetched"""
+        with self._lock:
+            future = self._blobs.get(descriptor['digest'])
+            owner = future is None
+            if owner:
+                future = self._blobs[descriptor['digest']] = Future()
+        if not owner:
+            return future.result(), 0, 0
+        try:
+            path = self.sources.find_blob(descriptor['digest'])
+            if path is not None:
+                size, local_size = 0, descriptor.get('size', 0)
+            else:
+                (path, size), local_size = self.fetch_blob(image, descriptor, directory), 0
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        future.set_result(path)
+        return path, size, local_size
+
+    def _write_archive(self, output, fetched):
+        manifest = {}
+        index = []
+        written = set()
+        mtime = self.mtime or 0
+        with tarfile.open(fileobj=output, mode='w|', format=tarfile.PAX_FORMAT) as archive:
+            for image, content, media_type, descriptors, paths in fetched:
+                manifest_digest = 'sha256:' + hashlib.sha256(content).hexdigest()
+                if manifest_digest not in written:
+                    written.add(manifest_digest)
+                    _add_member(archive, _get_blob_name(manifest_digest), io.BytesIO(content),
+                                len(content), mtime)
+                for descriptor in descriptors:
+                    if descriptor['digest'] not in written:
+                        written.add(descriptor['digest'])
+                        _add_blob(archive, descriptor, paths[descriptor['digest']], mtime)
+
+                entry = manifest.setdefault(manifest_digest, {
+                    'Config': _get_blob_name(descriptors[0]['digest']),
+                    'RepoTags': [],
+                    'Layers': [_get_blob_name(descriptor['digest'])
+                               for descriptor in descriptors[1:]]})
+                annotations = {'io.containerd.image.name': image.canonical}
+                if image.tag:
+                    entry['RepoTags'].append(f'{image.repo}:{image.tag}')
+                    annotations['org.opencontainers.image.ref.name'] = image.tag
+                index.append({'mediaType': media_type, 'digest': manifest_digest,
+                              'size': len(content), 'annotations': annotations})
+
+            for name, data in ((docker_archive.MANIFEST_FILENAME, list(manifest.values())),
+                               (docker_archive.INDEX_FILENAME,
+                                {'schemaVersion': 2, 'manifests': index}),
+                               (docker_archive.OCI_LAYOUT_FILENAME,
+                                {'imageLayoutVersion': '1.0.0'})):
+                content = json.dumps(data, separators=(',', ':')).encode()
+                _add_member(archive, name, io.BytesIO(content), len(content), mtime)
+
+
+@register(EXPORTER_REGISTRY)
+class RegistryExporter(BlobExporter):
+    """Downloads the manifests and blobs of the images from the registries
+    with the credentials of --docker-config
+
+    With --blob-cache the downloaded blobs are verified and kept in the blob
+    cache and the manifests are named in its index.json, so that the next
+    runs read the images from the cache.
+    """
+
+    def __init__(self, args, hash_algorithms=(), mtime=None):
+        super().__init__(args, hash_algorithms, mtime)
+        self.docker_api = DockerApi(args.docker_config, args.timeout)
+
+    def get_manifest(self, image, digest):
+        reference = f'{image.repo}@{digest}' if digest else str(image)
+        try:
+            return self.docker_api.get_manifest_content(reference)
+        except (DockerApiError, KeyError) as exc:
+            raise ImageExportError(f'Failed to get manifest of {image}: {exc}') from exc
+
+    def fetch_blob(self, image, descriptor, directory):
+        if self.sources.cache is not None:
+            return self._fetch_cached_blob(image, descriptor)
+        path = os.path.join(directory, descriptor['digest'].replace(':', '-'))
+        try:
+            with open(path, 'wb') as blob:
+                size = self.docker_api.download_blob(str(image), descriptor['digest'], blob)
+        except (DockerApiError, KeyError) as exc:
+            raise ImageExportError(f'Failed to download {descriptor["digest"]} of {image}: '
+                                   f'{exc}') from exc
+        return path, size
+
+    def _fetch_cached_blob(self, image, descriptor):
+        """Download a blob to the blob cache, verifying its digest before it is added"""
+        digest = descriptor['digest']
+        path = self.sources.cache.get_blob_path(digest)
+        algorithm, encoded = digest.split(':', 1)
+        file_descriptor, partial_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                                         suffix='.partial')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as blob:
+                writer = _VerifyingWriter(blob, hashlib.new(algorithm))
+                size = self.docker_api.download_blob(str(image), digest, writer)
+            if writer.digest.hexdigest() != encoded:
+                raise ImageExportError(f'Digest mismatch in blob {digest} of {image}')
+            os.replace(partial_path, path)
+        except (DockerApiError, KeyError) as exc:
+            raise ImageExportError(f'Failed to download {digest} of {image}: {exc}') from exc
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+        return path, size
+
+
+@register(EXPORTER_OCI_LAYOUT)
+class OciLayoutExporter(BlobExporter):
+    """Reads the images only from the local image layouts of --oci-layout and --blob-cache"""
+
+    def get_manifest(self, image, digest):
+        raise ImageExportError(f'Image {image} not found from the OCI image layouts')
+
+    def fetch_blob(self, image, descriptor, directory):
+        raise ImageExportError(f'Blob {descriptor["digest"]} of {image} missing from the OCI '
+                               f'image layouts')
+
+
+def _get_blob_name(digest):
+    algorithm, encoded = digest.split(':', 1)
+    return f'blobs/{algorithm}/{encoded}'
+
+
+def _add_blob(archive, descriptor, path, mtime):
+    """Add a blob file to the archive verifying its digest and size"""
+    algorithm, encoded = descriptor['digest'].split(':', 1)
+    size = os.path.getsize(path)
+    if 'size' in descriptor and descriptor['size'] != size:
+        raise ImageExportError(f'Size of blob {descriptor["digest"]} is {size}, '
+                               f'expected {descriptor["size"]}')
+    with open(path, 'rb') as blob:
+        reader = _VerifyingReader(blob, hashlib.new(algorithm))
+        _add_member(archive, _get_blob_name(descriptor['digest']), reader, size, mtime)
+    if reader.digest.hexdigest() != encoded:
+        raise ImageExportError(f'Digest mismatch in blob {descriptor["digest"]}')
+
+
+def _add_member(archive, name, fileobj, size, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = mtime
+    info.mode = 0o644
+    archive.addfile(info, fileobj)
+
+
+class _VerifyingReader:
+    """File object calculating the digest of the data read"""
+
+    def __init__(self, file, digest):
+        self.file = file
+        self.digest = digest
+
+    def read(self, size=-1):
+        """Read bytes and update the digest
+
+        :param size: Maximum number of bytes, all if negative
+        :return: Bytes read
+        """
+        data = self.file.read(size)
+        self.digest.update(data)
+        return data
+
+
+class _VerifyingWriter:
+    """File object calculating the digest of the data written"""
+
+    def __init__(self, file, digest):
+        self.file = file
+        self.digest = digest
+
+    def write(self, data):
+        """Write bytes and update the digest
+
+        :param data: Bytes to write
+        :return: Number of bytes written
+        """
+        self.digest.update(data)
+        return self.file.write(data)
@@ -0,0 +1,195 @@
+# ******************************************************************************
+# COPYRIGHT Ericsson 2024
+#
+#
+#
+# The copyright to the computer program(s) herein is the property of
+#
+# Ericsson Inc. The programs may be used and/or copied only with written
+#
+# permission from Ericsson Inc. or in accordance with the terms and
+#
+# conditions stipulated in the agreement/contract under which the
+#
+# program(s) have been supplied.
+# ******************************************************************************
+"""Image lock file pinning the images of the charts to digests"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from yaml import safe_load, safe_dump, YAMLError
+
+from .docker_api import DockerApiError
+from .image import Image
+
+LOCK_VERSION = 1
+RESOLVE_WORKERS = 8
+
+
+class ImageLockError(Exception):
+    """Image lock file error"""
+
+
+class ImageLock:
+    """Images of each chart and the digest, size and platform of each image
+
+    Example of the lock file::
+
+        version: 1
+        options: <digest of the arguments affecting image discovery>
+        charts:
+          eric-chart-1.0.0.tgz:
+            sha256: <digest of the chart archive>
+            images:
+            - registry.example.com/proj/image:1.0.0
+        images:
+          registry.example.com/proj/image:1.0.0:
+            digest: sha256:<manifest digest>
+            size: <size of the config and layers in bytes>
+            platform: linux/amd64
+    """
+
+    def __init__(self, options=None, charts=None, images=None):
+        """Object initialization
+
+        :param options: Digest of the arguments affecting image discovery
+        :param charts: Dictionary of chart digest and image references by chart name
+        :param images: Dictionary of digest, size and platform by image reference
+        """
+        self.options = options
+        self.charts = charts or {}
+        self.images = images or {}
+
+    @classmethod
+    def load(cls, path):
+        """Load lock file
+
+        :param path: Path of the lock file
+        :raises ImageLockError: Invalid lock file
+        :return: ImageLock object
+        """
+        try:
+            with open(path, 'r', encoding='utf-8') as lock_file:
+                data = safe_load(lock_file) or {}
+        except YAMLError as exc:
+            raise ImageLockError(f'Invalid images lock file {path}: {exc}') from exc
+
+        if not isinstance(data, dict) or data.get('version') != LOCK_VERSION:
+            raise ImageLockError(f'Unsupported images lock file {path}, '
+                                 f'expected version {LOCK_VERSION}')
+        return cls(data.get('options'), data.get('charts'), data.get('images'))
+
+    def save(self, path):
+        """Write lock file
+
+        :param path: Path of the lock file
+        """
+        data = {'version': LOCK_VERSION,
+                'options': self.options,
+                'charts': self.charts,
+                'images': self.images}
+        with open(path, 'w', encoding='utf-8') as lock_file:
+            safe_dump(data, lock_file, sort_keys=True)
+        logging.info('Wrote images lock %s', path)
+
+    def get_changed_charts(self, chart_digests, options):
+        """Get charts which are not locked with the same digest and options
+
+        :param chart_digests: Dictionary of SHA256 digest by chart name
+        :param options: Digest of the arguments affecting image discovery
+        :return: Set of chart names
+        """
+        if options != self.options:
+            return set(chart_digests)
+        return {name for name, digest in chart_digests.items()
+                if self.charts.get(name, {}).get('sha256') != digest}
+
+    def is_current(self, chart_digests, options):
+        """Check if the lock file pins exactly the given charts
+
+        :param chart_digests: Dictionary of SHA256 digest by chart name
+        :param options: Digest of the arguments affecting image discovery
+        :return: True if no chart was added, changed or removed
+        """
+        return set(self.charts) == set(chart_digests) and \
+            not self.get_changed_charts(chart_digests, options)
+
+    def set_chart(self, name, digest, images):
+        """Set the images of a chart
+
+        :param name: Chart name
+        :param digest: SHA256 digest of the chart archive
+        :param images: Images of the chart
+        """
+        self.charts[name] = {'sha256': digest,
+                             'images': sorted({str(image) for image in images})}
+
+    def retain_charts(self, names):
+        """Remove the charts not in names and the images no longer used
+
+        :param names: Names of the charts to keep
+        """
+        self.charts = {name: chart for name, chart in self.charts.items() if name in names}
+        used = {reference for chart in self.charts.values() for reference in chart['images']}
+        self.images = {reference: image for reference, image in self.images.items()
+                       if reference in used}
+
+    def get_chart_images(self, name):
+        """Get images of a chart
+
+        :param name: Chart name
+        :return: List of Image objects
+        """
+        return [Image.parse(reference) for reference in self.charts[name]['images']]
+
+    def get_digests(self):
+        """Get pinned digests
+
+        :return: Dictionary of manifest digest by Image object
+        """
+        return {Image.parse(reference): image['digest']
+                for reference, image in self.images.items()}
+
+    def resolve(self, docker_api, images, workers=RESOLVE_WORKERS):
+        """Pin images to their current digests in the registry
+
+        :param docker_api: DockerApi object
+        :param images: Images to resolve
+        :param workers: Number of concurrent registry requests
+        :raises ImageLockError: Failed to resolve some of the images
+        """
+        references = sorted({str(image) for image in images})
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda reference: _resolve(docker_api, reference),
+                                        references))
+
+        errors = []
+        for reference, (image, error) in zip(references, results):
+            if error is not None:
+                errors.append(f'{reference}: {error}')
+            else:
+                self.images[reference] = image
+        if errors:
+            raise ImageLockError('Could not resolve images:\n' + '\n'.join(errors))
+
+
+def _resolve(docker_api, reference):
+    """Get digest, size and platform of an image from the registry
+
+    :param docker_api: DockerApi object
+    :param reference: Image reference
+    :return: Tuple of image dictionary and error message
+    """
+    try:
+        manifest = docker_api.get_image_manifest(reference)
+        digest = Image.parse(reference).digest or \
+            'sha256:' + docker_api.get_manifest_hash(reference)
+        size = manifest['config']['size'] + sum(layer['size'] for layer in manifest['layers'])
+        config = docker_api.get_blob(reference)
+    except (DockerApiError, KeyError, TypeError, ValueError) as exc:
+        return None, str(exc)
+
+    platform = '/'.join(filter(None, (config.get('os'), config.get('architecture'),
+                                      config.get('variant'))))
+    return {'digest': digest, 'size': size, 'platform': platform}, None
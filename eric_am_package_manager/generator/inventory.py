@@ -0,0 +1,181 @@
+# ******************************************************************************
+# COPYRIGHT Ericsson 2024
+#
+#
+#
+# The copyright to the computer program(s) herein is the property of
+#
+# Ericsson Inc. The programs may be used and/or copied only with written
+#
+# permission from Ericsson Inc. or in accordance with the terms and
+#
+# conditions stipulated in the agreement/contract under which the
+#
+# program(s) have been supplied.
+# ******************************************************************************
+"""Inventory of the input Helm chart archives"""
+
+import os
+import re
+import logging
+import tarfile
+import threading
+
+# Path of a file in the eric-crd directory of a chart or its unpacked subcharts
+CRD_MEMBER_PATTERN = re.compile(r'[^/]+/(?:charts/[^/]+/)*eric-crd/[^/]+')
+# Members whose contents are kept while the member headers are read
+CAPTURED_MEMBER_PATTERN = re.compile(r'[^/]+/values\.yaml|(?:.*/)?helmfile\.yaml')
+CAPTURE_SIZE_LIMIT = 1024 * 1024
+
+# Archive indexes keyed by inode, size and modification time of the archive
+_ARCHIVES = {}
+_HELM_DIRS = {}
+_LOCK = threading.Lock()
+
+
+class ArchiveIndex:
+    """Member index of a Helm chart archive
+
+    The archive is decompressed as a stream. The member headers are read
+    only up to the first member answering a question and the stream is
+    closed, so cached indexes do not keep files open. Later questions
+    reopen the stream and skip the members already seen. The contents of
+    the small members looked for by the questions, e.g. values.yaml, are
+    kept when the stream passes them.
+    """
+
+    def __init__(self, path):
+        """Object initialization
+
+        :param path: Path of the archive
+        """
+        self.path = path
+        self.members = []
+        self.complete = False
+        self._contents = {}
+        self._tar = None
+        self._lock = threading.Lock()
+
+    def find(self, predicate):
+        """Find the first member matching a predicate
+
+        :param predicate: Function taking a TarInfo object
+        :return: TarInfo object, None if not found
+        """
+        with self._lock:
+            return self._find(predicate)
+
+    def get_members(self):
+        """Get all members of the archive
+
+        :return: List of TarInfo objects
+        """
+        with self._lock:
+            self._find(lambda member: False)
+            return list(self.members)
+
+    def read(self, predicate):
+        """Read the contents of the first file member matching a predicate
+
+        :param predicate: Function taking a TarInfo object
+        :return: Tuple of member name and contents, None if not found
+        """
+        with self._lock:
+            member = self._find(lambda member: member.isfile() and predicate(member), read=True)
+            if member is None:
+                return None
+            if member.name not in self._contents:
+                # Passed earlier without keeping the contents
+                with tarfile.open(self.path, 'r:*') as tar:
+                    self._contents[member.name] = tar.extractfile(member.name).read()
+            return member.name, self._contents[member.name]
+
+    def _find(self, predicate, read=False):
+        for member in self.members:
+            if predicate(member):
+                return member
+        try:
+            while not self.complete:
+                member = self._next()
+                if member is not None and predicate(member):
+                    if read and member.name not in self._contents:
+                        self._contents[member.name] = self._tar.extractfile(member).read()
+                    return member
+            return None
+        finally:
+            self._close()
+
+    def _next(self):
+        """Read the next member header from the stream
+
+        :return: TarInfo object, None at the end of the archive
+        """
+        if self._tar is None:
+            self._tar = tarfile.open(self.path, 'r|*')  # pylint: disable=consider-using-with
+            for _ in self.members:
+                self._tar.next()
+        member = self._tar.next()
+        if member is None:
+            self.complete = True
+            return None
+        self.members.append(member)
+        if member.isfile() and member.size <= CAPTURE_SIZE_LIMIT and \
+                CAPTURED_MEMBER_PATTERN.fullmatch(member.name):
+            self._contents[member.name] = self._tar.extractfile(member).read()
+        return member
+
+    def _close(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+
+    def has_helmfile(self):
+        """Check if the archive contains helmfile.yaml"""
+        return self.find(lambda member: member.isfile() and
+                         member.name.split('/')[-1] == 'helmfile.yaml') is not None
+
+    def has_crds(self):
+        """Check if the chart or its unpacked subcharts contain CRD packages"""
+        return self.find(lambda member: member.isfile() and
+                         CRD_MEMBER_PATTERN.fullmatch(member.name) is not None) is not None
+
+    def read_values(self):
+        """Read values.yaml of the chart itself
+
+        :return: Contents of values.yaml, None if not found
+        """
+        found = self.read(lambda member: re.fullmatch(r'[^/]+/values\.yaml', member.name))
+        return found[1] if found else None
+
+
+def get_archive(path):
+    """Get the cached index of an archive
+
+    :param path: Path of the archive
+    :return: ArchiveIndex object
+    """
+    stat = os.stat(path)
+    key = stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+    with _LOCK:
+        if key not in _ARCHIVES:
+            _ARCHIVES[key] = ArchiveIndex(path)
+        return _ARCHIVES[key]
+
+
+def get_helm_dir_charts(helm_dir):
+    """List the Helm chart archives of a directory and its subdirectories once
+
+    :param helm_dir: Directory of Helm charts
+    :return: List of paths relative to helm_dir of the files with .tgz in the name
+    """
+    key = os.path.abspath(helm_dir)
+    with _LOCK:
+        if key not in _HELM_DIRS:
+            charts = []
+            for root, dirs, files in os.walk(helm_dir):
+                dirs.sort()
+                charts.extend(os.path.relpath(os.path.join(root, filename), helm_dir)
+                              for filename in sorted(files) if '.tgz' in filename)
+            logging.debug('Found %s Helm charts from %s', len(charts), helm_dir)
+            _HELM_DIRS[key] = charts
+        return list(_HELM_DIRS[key])
@@ -0,0 +1,270 @@
+# ******************************************************************************
+# COPYRIGHT Ericsson 2024
+#
+#
+#
+# The copyright to the computer program(s) herein is the property of
+#
+# Ericsson Inc. The programs may be used and/or copied only with written
+#
+# permission from Ericsson Inc. or in accordance with the terms and
+#
+# conditions stipulated in the agreement/contract under which the
+#
+# program(s) have been supplied.
+# ******************************************************************************
+"""Image layout directories in the OCI image-layout format"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+
+from .image import Image
+
+OCI_LAYOUT_FILENAME = 'oci-layout'
+INDEX_FILENAME = 'index.json'
+# Annotations naming the image of a manifest in index.json
+IMAGE_NAME_ANNOTATIONS = ('io.containerd.image.name', 'org.opencontainers.image.ref.name')
+INDEX_MEDIA_TYPES = ('application/vnd.oci.image.index.v1+json',
+                     'application/vnd.docker.distribution.manifest.list.v2+json')
+MANIFEST_MEDIA_TYPE = 'application/vnd.oci.image.manifest.v1+json'
+DEFAULT_PLATFORM = {'os': 'linux', 'architecture': 'amd64'}
+
+
+class OciLayoutError(Exception):
+    """OCI image layout error"""
+
+
+class OciLayout:
+    """Image layout directory
+
+    Images are found by the image name annotations of the manifests of
+    index.json or by manifest digest. Image indexes are resolved to the
+    manifest of DEFAULT_PLATFORM.
+    """
+
+    def __init__(self, path):
+        """Object initialization
+
+        :param path: Path of the image layout directory
+        :raises OciLayoutError: Not an image layout directory
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(os.path.join(path, OCI_LAYOUT_FILENAME), encoding='utf-8') as layout_file:
+                layout = json.load(layout_file)
+            with open(os.path.join(path, INDEX_FILENAME), encoding='utf-8') as index_file:
+                self.index = json.load(index_file)
+        except (OSError, ValueError) as exc:
+            raise OciLayoutError(f'{path} is not an OCI image layout: {exc}') from exc
+        if not isinstance(layout, dict) or 'imageLayoutVersion' not in layout:
+            raise OciLayoutError(f'{path} is not an OCI image layout: invalid {OCI_LAYOUT_FILENAME}')
+
+        self.names = {}
+        for descriptor in self.index.get('manifests') or []:
+            self._add_names(descriptor)
+        logging.debug('Found %s images from %s', len(self.names), path)
+
+    @classmethod
+    def create(cls, path):
+        """Open an image layout directory, creating an empty one if it does not exist
+
+        :param path: Path of the image layout directory
+        :raises OciLayoutError: Existing directory is not an image layout
+        :return: OciLayout object
+        """
+        os.makedirs(os.path.join(path, 'blobs', 'sha256'), exist_ok=True)
+        if not os.path.exists(os.path.join(path, OCI_LAYOUT_FILENAME)):
+            _write_json(os.path.join(path, INDEX_FILENAME), {'schemaVersion': 2, 'manifests': []})
+            _write_json(os.path.join(path, OCI_LAYOUT_FILENAME), {'imageLayoutVersion': '1.0.0'})
+        return cls(path)
+
+    def _add_names(self, descriptor):
+        for annotation in IMAGE_NAME_ANNOTATIONS:
+            name = (descriptor.get('annotations') or {}).get(annotation, '')
+            # Tag only names do not identify the image
+            if '/' in name or ':' in name:
+                try:
+                    self.names[Image.parse(name)] = descriptor
+                except ValueError:
+                    logging.debug('Invalid image name %s in %s', name, self.path)
+
+    def find(self, image, digest=None):
+        """Find the manifest of an image
+
+        :param image: Image object
+        :param digest: Pinned manifest digest of the image, optional
+        :return: Manifest descriptor, None if not found
+        """
+        digest = image.digest or digest
+        descriptor = None
+        if digest:
+            descriptor = next((descriptor for descriptor in self.index.get('manifests') or []
+                               if descriptor.get('digest') == digest), None)
+        if descriptor is None and image.tag:
+            descriptor = self.names.get(Image(image.repo, image.tag))
+            if descriptor is not None and digest and descriptor.get('digest') != digest:
+                descriptor = None
+        if descriptor is not None and descriptor.get('mediaType') in INDEX_MEDIA_TYPES:
+            descriptor = self._resolve_index(descriptor)
+        if descriptor is not None and not self.has_blob(descriptor['digest']):
+            logging.debug('Manifest %s of %s missing from %s', descriptor['digest'], image,
+                          self.path)
+            return None
+        return descriptor
+
+    def _resolve_index(self, descriptor):
+        try:
+            index = json.loads(self.read_blob(descriptor['digest']))
+        except (OSError, ValueError):
+            return None
+        return select_platform_manifest(index)
+
+    def get_blob_path(self, digest):
+        """Get path of a blob
+
+        :param digest: Digest of the blob, e.g. sha256:<hex>
+        :return: Path of the blob file
+        """
+        algorithm, encoded = digest.split(':', 1)
+        return os.path.join(self.path, 'blobs', algorithm, encoded)
+
+    def has_blob(self, digest):
+        """Check if the layout contains a blob
+
+        :param digest: Digest of the blob
+        """
+        return os.path.isfile(self.get_blob_path(digest))
+
+    def get_manifest_blobs(self, descriptor):
+        """Get the config and layer descriptors of a manifest
+
+        :param descriptor: Manifest descriptor
+        :return: List of blob descriptors, None if the manifest is invalid
+        """
+        try:
+            manifest = json.loads(self.read_blob(descriptor['digest']))
+            return [manifest['config'], *manifest['layers']]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def add_image(self, image, content, media_type):
+        """Add the manifest of an image and name it in index.json
+
+        :param image: Image object
+        :param content: Manifest bytes
+        :param media_type: Media type of the manifest
+        """
+        descriptor = {'mediaType': media_type,
+                      'digest': 'sha256:' + hashlib.sha256(content).hexdigest(),
+                      'size': len(content),
+                      'annotations': {'io.containerd.image.name': image.canonical}}
+        with self._lock:
+            if self.names.get(image) == descriptor:
+                return
+            if not self.has_blob(descriptor['digest']):
+                with open(self.get_blob_path(descriptor['digest']), 'wb') as blob:
+                    blob.write(content)
+            manifests = [manifest for manifest in self.index.get('manifests') or []
+                         if (manifest.get('annotations') or {}).get('io.containerd.image.name')
+                         != image.canonical]
+            self.index['manifests'] = manifests + [descriptor]
+            self._add_names(descriptor)
+            _write_json(os.path.join(self.path, INDEX_FILENAME), self.index)
+
+    def read_blob(self, digest):
+        """Read the contents of a blob
+
+        :param digest: Digest of the blob
+        :return: Blob bytes
+        """
+        with open(self.get_blob_path(digest), 'rb') as blob:
+            return blob.read()
+
+
+class ImageSources:
+    """Image layout directories tried before fetching images over the network
+
+    The blob cache is an image layout directory the images fetched over the
+    network are added to, so that later runs find them locally.
+    """
+
+    def __init__(self, layouts, cache=None):
+        """Object initialization
+
+        :param layouts: List of OciLayout objects
+        :param cache: OciLayout object of the blob cache, optional
+        """
+        self.layouts = list(layouts) + ([cache] if cache is not None else [])
+        self.cache = cache
+
+    @classmethod
+    def from_args(cls, args):
+        """Create the image sources of the command line arguments
+
+        :param args: Command line arguments
+        :raises OciLayoutError: Invalid image layout directory
+        :return: ImageSources object
+        """
+        layouts = [OciLayout(path) for path in getattr(args, 'oci_layout', None) or []]
+        blob_cache = getattr(args, 'blob_cache', None)
+        return cls(layouts, OciLayout.create(blob_cache) if blob_cache else None)
+
+    def find(self, image, digest=None):
+        """Find the manifest of an image with all of its blobs
+
+        :param image: Image object
+        :param digest: Pinned manifest digest of the image, optional
+        :return: Tuple of OciLayout object and manifest descriptor, None if not found
+        """
+        for layout in self.layouts:
+            descriptor = layout.find(image, digest)
+            if descriptor is None:
+                continue
+            blobs = layout.get_manifest_blobs(descriptor)
+            if blobs is not None and all(self.find_blob(blob['digest']) for blob in blobs):
+                return layout, descriptor
+        return None
+
+    def find_blob(self, digest):
+        """Find a blob from the image layouts
+
+        :param digest: Digest of the blob
+        :return: Path of the blob file, None if not found
+        """
+        for layout in self.layouts:
+            if layout.has_blob(digest):
+                return layout.get_blob_path(digest)
+        return None
+
+
+def is_index(manifest):
+    """Check if a parsed manifest is an image index
+
+    :param manifest: Manifest dictionary
+    """
+    return manifest.get('mediaType') in INDEX_MEDIA_TYPES or \
+        ('manifests' in manifest and 'layers' not in manifest)
+
+
+def select_platform_manifest(index):
+    """Select the manifest of DEFAULT_PLATFORM from an image index
+
+    :param index: Image index dictionary
+    :return: Manifest descriptor, None if not found
+    """
+    for manifest in index.get('manifests') or []:
+        platform = manifest.get('platform') or {}
+        if all(platform.get(key) == value for key, value in DEFAULT_PLATFORM.items()):
+            return manifest
+    return None
+
+
+def _write_json(path, data):
+    """Write a JSON file atomically"""
+    with open(path + '.tmp', 'w', encoding='utf-8') as json_file:
+        json.dump(data, json_file, indent=2)
+    os.replace(path + '.tmp', path)
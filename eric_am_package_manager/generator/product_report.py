@@ -20,6 +20,7 @@ import logging
 import os
 import re
 from zipfile import ZipFile, BadZipFile, LargeZipFile
+from concurrent.futures import ThreadPoolExecutor
 import tempfile
 
 from ruamel.yaml import YAML
@@ -28,6 +29,7 @@ from ruamel.yaml import YAML
 
 from .utils import extract, indent, load_yaml_file
 from .helm_utils import ImageData, HelmData, HelmChart
+from .docker_api import DockerApi
 from .hash_utils import sha256
 
 logging.getLogger('urllib3').setLevel(logging.WARNING)
@@ -144,23 +146,25 @@ def verify_unique_product_numbers(components, archive_type):
     return valid
 
 
-def verify_all_images_in_report(args, images):
+def verify_all_images_in_report(args, images, csar_images=None):
     """Verify contents of product report matches with the downloaded images
 
     :param args: Command line arguments
     :param images: List of images in product report
+    :param csar_images: Contents of images.txt, read from the CSAR if not given
     :return: False if product report images do not match to downloaded
     """
     if args.no_images:
         logging.debug('Skipping image list validation')
         return True
 
-    try:
-        with ZipFile(args.name + '.csar', 'r') as csar:
-            csar_images = csar.read('Files/images.txt').decode('utf-8')
-    except (OSError, BadZipFile, LargeZipFile) as exc:
-        logging.error('Failed to extract images.txt from CSAR: %s', exc)
-        return False
+    if csar_images is None:
+        try:
+            with ZipFile(args.name + '.csar', 'r') as csar:
+                csar_images = csar.read('Files/images.txt').decode('utf-8')
+        except (OSError, BadZipFile, LargeZipFile) as exc:
+            logging.error('Failed to extract images.txt from CSAR: %s', exc)
+            return False
 
     downloaded = set(csar_images.splitlines())
     report = {i['image'] for i in images}
@@ -236,13 +240,48 @@ def check_for_warnings(warnings):
                         message)
 
 
-def create_product_report(args, helms):
+def process_helm_chart(helm, config, docker_api=None):
+    """Parse a Helm chart for product report
+
+    :param helm: Path to the Helm chart file
+    :param config: HelmChart configuration values
+    :param docker_api: DockerApi object shared by the charts of the report
+    :return: Tuple of packages, images, errors and warnings of the chart
+    """
+    helm_sha256 = sha256(helm)
+
+    logging.info('Processing Helm chart %s, sha256: %s',
+                 os.path.basename(helm),
+                 helm_sha256)
+
+    with extract(helm) as helmdir:
+        helm = HelmChart(helmdir, os.path.basename(helm),
+                         helm_sha256, include_helm=True)
+        helm.set_config(**config)
+        helm.docker_api = docker_api
+        helm.parse()
+        packages, images = helm.get_components()
+        return packages, images, helm.get_errors(), helm.get_warnings()
+
+
+def create_product_report(args, helms, csar_images=None):
     """Create product report YAML file
 
     :param args: Command line arguments
     :param helms: List of Helm files
+    :param csar_images: Contents of images.txt, read from the CSAR if not given
     :raises ProductReportError: Error in product report validation
     """
+    write_product_report(args, collect_product_report(args, helms), csar_images)
+
+
+def collect_product_report(args, helms):
+    """Collect components of Helm charts for product report
+
+    :param args: Command line arguments
+    :param helms: List of Helm files
+    :return: Tuple of output dictionary, errors and warnings
+    """
     output = {
         'includes': {
             'images': [],
@@ -264,28 +303,37 @@ def create_product_report(args, helms):
     if args.helm_debug:
         helm_options += ' --debug'
 
-    for helm in helms:
-        helm_sha256 = sha256(helm)
-
-        logging.info('Processing Helm chart %s, sha256: %s',
-                     os.path.basename(helm),
-                     helm_sha256)
-
-        with extract(helm) as helmdir:
-            helm = HelmChart(helmdir, os.path.basename(helm),
-                             helm_sha256, include_helm=True)
-            helm.set_config(docker_config=args.docker_config,
-                            helm_command=helm_command,
-                            helm_options=helm_options,
-                            disable_helm_template=args.disable_helm_template)
-            helm.parse()
-            packages, images = helm.get_components()
+    config = {'docker_config': args.docker_config,
+              'helm_command': helm_command,
+              'helm_options': helm_options,
+              'disable_helm_template': args.disable_helm_template}
+
+    # Images shared by the charts are fetched once
+    docker_api = DockerApi(args.docker_config) if helms else None
+
+    # Charts are processed in parallel, results are merged in the given order
+    with ThreadPoolExecutor(max_workers=getattr(args, 'jobs', 1)) as executor:
+        results = executor.map(lambda helm: process_helm_chart(helm, config, docker_api), helms)
+
+        for packages, images, helm_errors, helm_warnings in results:
             output['includes']['packages'].extend(packages)
             output['includes']['images'].extend(images)
 
-            errors.update(helm.get_errors())
-            warnings.update(helm.get_warnings())
+            errors.update(helm_errors)
+            warnings.update(helm_warnings)
+
+    return output, errors, warnings
+
 
+def write_product_report(args, report, csar_images=None):
+    """Write and validate product report YAML file
+
+    :param args: Command line arguments
+    :param report: Tuple of output dictionary, errors and warnings
+    :param csar_images: Contents of images.txt, read from the CSAR if not given
+    :raises ProductReportError: Error in product report validation
+    """
+    output, errors, warnings = report
     remove_duplicates(output['includes'], archive_type="helm")
 
     try:
@@ -304,7 +352,8 @@ def create_product_report(args, helms):
             not verify_unique_product_numbers(output['includes'], archive_type="helm"),
             not verify_all_components_valid(output['includes']),
             not verify_all_images_in_report(args,
-                                            output['includes']['images']),
+                                            output['includes']['images'],
+                                            csar_images),
             not verify_unique_images(output['includes']['images']))):
         raise ProductReportError('Product report validation failed')
 
@@ -413,3 +462,56 @@ def csar_product_report(args):
                 logging.info("Started Helm Chart product report.")
                 create_product_report(args,
                                       [os.path.join(tempdir, h) for h in archives])
+
+
+def directory_product_report(args, directory):
+    """Create product report from CSAR packaging directory
+
+    Used by generate instead of extracting the charts from the written CSAR.
+    The charts are hard links of the input charts, so their digests and
+    templates calculated during generate are reused.
+
+    :param args: Command line arguments
+    :param directory: CSAR packaging directory
+    """
+    write_directory_product_report(args, directory,
+                                   collect_directory_product_report(args, directory))
+
+
+def write_directory_product_report(args, directory, report):
+    """Write and validate product report against images of CSAR packaging directory
+
+    :param args: Command line arguments
+    :param directory: CSAR packaging directory
+    :param report: Result of collect_directory_product_report
+    """
+    if report is None:
+        return
+
+    with open(os.path.join(directory, 'Files', 'images.txt'), 'r', encoding='utf-8') as file:
+        csar_images = file.read()
+    write_product_report(args, report, csar_images)
+
+
+def collect_directory_product_report(args, directory):
+    """Collect product report from the charts of CSAR packaging directory
+
+    Does not need the images of the CSAR, so generate runs this while the
+    images are exported. The Helmfile product report is written here.
+
+    :param args: Command line arguments
+    :param directory: CSAR packaging directory
+    :return: Collected Helm chart product report, None if not requested
+    """
+    charts_dir = os.path.join(directory, 'Definitions', 'OtherTemplates')
+    archives = sorted(os.path.join(root, filename)
+                      for root, _, filenames in os.walk(charts_dir)
+                      for filename in filenames if filename.endswith('tgz'))
+
+    if args.helmfile:
+        logging.info("Started Helmfile product report.")
+        create_helmfile_product_report(args, archives)
+    if args.helm:
+        logging.info("Started Helm Chart product report.")
+        return collect_product_report(args, archives)
+    return None
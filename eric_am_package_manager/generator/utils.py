@@ -23,12 +23,16 @@ import tarfile
 import tempfile
 import textwrap
 import argparse
+import hashlib
 from contextlib import contextmanager
 import yaml
 
 from eric_am_package_manager.generator.cnf_values_file_exception import CnfValuesFileException
+from eric_am_package_manager.generator.hash_utils import sha256
 
 PATH_TO_LICENSES = 'Files/Licenses'
+# Timestamp of reproducible builds without SOURCE_DATE_EPOCH, the earliest zip timestamp
+DEFAULT_SOURCE_DATE_EPOCH = 315532800
 
 
 # pylint: disable=too-few-public-methods
@@ -83,6 +87,19 @@ def valid_file(fname):
         'accessible for the user.')
 
 
+def positive_int(value):
+    """
+    Argparse argument type to verify that the argument is a positive integer
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number > 0:
+        return number
+    raise argparse.ArgumentTypeError(f'The value [{value}] provided is not a positive integer.')
+
+
 def get_general_licenses_path(args):
     """
     Get License path, if not define returns empty
@@ -92,6 +109,19 @@ def get_general_licenses_path(args):
     return ''
 
 
+def get_source_date_epoch(args):
+    """Get the timestamp of the files of a reproducible build
+
+    :param args: Command line arguments
+    :return: Seconds since the epoch from --source-date-epoch or SOURCE_DATE_EPOCH,
+        1980-01-01 if not given, None if the build is not reproducible
+    """
+    if not getattr(args, 'reproducible', False):
+        return None
+    epoch = getattr(args, 'source_date_epoch', None)
+    return DEFAULT_SOURCE_DATE_EPOCH if epoch is None else epoch
+
+
 def valid_path(fname):
     """
     Argparse argument type to verify that the argument is a valid path
@@ -169,6 +199,101 @@ def extract(tar_file):
             shutil.rmtree(temp_file)
 
 
+def get_chart_tree_digest(helmdir):
+    """Get digest of the metadata of an extracted Helm chart and its subcharts
+
+    Covers Chart.yaml and eric-product-info.yaml of the chart and its unpacked
+    subcharts, and the packaged subcharts and CRD packages, so that identical
+    copies of a chart in different archives have the same digest. Templates
+    and values files of the unpacked charts are not covered.
+
+    :param helmdir: Helm chart directory
+    :return: Tuple of hex digest and True if all the charts have eric-product-info.yaml
+    """
+    digest = hashlib.sha256()
+    all_product_info = _update_chart_tree_digest(digest, helmdir)
+    return digest.hexdigest(), all_product_info
+
+
+def _update_chart_tree_digest(digest, helmdir):
+    digest.update(os.path.basename(helmdir).encode() + b'\0')
+    all_product_info = os.path.isfile(os.path.join(helmdir, 'eric-product-info.yaml'))
+
+    for filename in ('Chart.yaml', 'eric-product-info.yaml'):
+        path = os.path.join(helmdir, filename)
+        if os.path.isfile(path):
+            with open(path, 'rb') as file:
+                digest.update(filename.encode() + b'\0' + file.read() + b'\0')
+
+    for subdir in ('eric-crd', 'charts'):
+        directory = os.path.join(helmdir, subdir)
+        if not os.path.isdir(directory):
+            continue
+
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if os.path.isdir(path):
+                all_product_info &= _update_chart_tree_digest(digest, path)
+            else:
+                digest.update(f'{subdir}/{name}\0{sha256(path)}\0'.encode())
+
+    return all_product_info
+
+
+def deep_merge(base, override):
+    """Merge values like Helm merges values files
+
+    Dictionaries are merged recursively, other values of the override replace
+    the ones of the base. The arguments are not modified.
+
+    :param base: Values dictionary
+    :param override: Values dictionary taking precedence
+    :return: Merged values dictionary
+    """
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = deep_merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def parse_set_values(set_parameters):
+    """Parse values given with --set as Helm does for simple keys
+
+    e.g. ['global.registry.url=registry.example.com,tags.enabled=true']
+
+    :param set_parameters: List of comma separated key=value strings
+    :return: Values dictionary
+    """
+    values = {}
+    for parameter in set_parameters or []:
+        for assignment in re.split(r'(?<!\\),', parameter):
+            if not assignment:
+                continue
+            key, _, value = assignment.partition('=')
+            *parents, name = [part.replace('\\.', '.')
+                              for part in re.split(r'(?<!\\)\.', key)]
+            node = values
+            for parent in parents:
+                if not isinstance(node.get(parent), dict):
+                    node[parent] = {}
+                node = node[parent]
+            node[name] = _parse_set_value(value.replace('\\,', ','))
+    return values
+
+
+def _parse_set_value(value):
+    if value in ('true', 'false'):
+        return value == 'true'
+    if value == 'null':
+        return None
+    if re.fullmatch(r'-?[1-9][0-9]*|0', value):
+        return int(value)
+    return value
+
+
 def indent(text, bullet='-'):
     """
     Indents the given text
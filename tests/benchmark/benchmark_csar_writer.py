@@ -0,0 +1,80 @@
+# ******************************************************************************
+# COPYRIGHT Ericsson 2024
+#
+#
+#
+# The copyright to the computer program(s) herein is the property of
+#
+# Ericsson Inc. The programs may be used and/or copied only with written
+#
+# permission from Ericsson Inc. or in accordance with the terms and
+#
+# conditions stipulated in the agreement/contract under which the
+#
+# program(s) have been supplied.
+# ******************************************************************************
+"""Benchmark of parallel and single threaded deflate of a CSAR member
+
+Usage: python -m tests.benchmark.benchmark_csar_writer [--size MB] [--threads N] [--file PATH]
+"""
+
+import os
+import sys
+import time
+import zipfile
+import argparse
+import tempfile
+from multiprocessing import cpu_count
+
+from eric_am_package_manager.generator import csar_writer
+
+
+def create_sample(path, size):
+    """Create a file which compresses roughly like a Docker image layer"""
+    block = os.urandom(64 * 1024) + bytes(range(256)) * 256
+    with open(path, 'wb') as sample:
+        for _ in range(size // len(block) + 1):
+            sample.write(block)
+        sample.truncate(size)
+
+
+def run(source, destination, threads, level):
+    zip_class = type('ZipFile', (csar_writer.CsarZipFile,),
+                     {'policy': csar_writer.CompressionPolicy(compresslevel=level,
+                                                              threads=threads)})
+    start = time.monotonic()
+    with zip_class(destination, 'w', zipfile.ZIP_DEFLATED) as csar:
+        csar.write(source, 'Files/images/docker.tar')
+    duration = time.monotonic() - start
+
+    with zipfile.ZipFile(destination) as csar:
+        if csar.testzip() is not None:
+            raise RuntimeError('CRC check failed')
+        info = csar.getinfo('Files/images/docker.tar')
+    return duration, info.file_size, info.compress_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=512, help='Size of generated sample in MB')
+    parser.add_argument('--threads', type=int, default=cpu_count())
+    parser.add_argument('--level', type=int, default=None)
+    parser.add_argument('--file', help='Existing file to compress instead of a sample')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        source = args.file
+        if not source:
+            source = os.path.join(tempdir, 'docker.tar')
+            create_sample(source, args.size * 1024 * 1024)
+
+        for threads in (1, args.threads):
+            duration, size, compressed = run(source, os.path.join(tempdir, 'test.csar'),
+                                             threads, args.level)
+            print(f'threads={threads:<3} {duration:8.2f} s '
+                  f'{size / duration / 1024 / 1024:8.1f} MB/s '
+                  f'ratio={compressed / size:.3f}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
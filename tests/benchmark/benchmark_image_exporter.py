@@ -0,0 +1,65 @@
+# ******************************************************************************
+# COPYRIGHT Ericsson 2024
+#
+#
+#
+# The copyright to the computer program(s) herein is the property of
+#
+# Ericsson Inc. The programs may be used and/or copied only with written
+#
+# permission from Ericsson Inc. or in accordance with the terms and
+#
+# conditions stipulated in the agreement/contract under which the
+#
+# program(s) have been supplied.
+# ******************************************************************************
+"""Benchmark of the image exporters on the same images
+
+Usage: python -m tests.benchmark.benchmark_image_exporter --images IMAGE [IMAGE ...]
+           [--exporters NAME [NAME ...]] [--docker-config PATH] [--oci-layout PATH ...]
+           [--workers N]
+"""
+
+import os
+import sys
+import argparse
+import logging
+import tempfile
+
+from eric_am_package_manager.generator import image_exporter
+from eric_am_package_manager.generator.image import Image
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--images', nargs='+', required=True, help='Images to export')
+    parser.add_argument('--exporters', nargs='+', default=image_exporter.get_exporter_names(),
+                        choices=image_exporter.get_exporter_names())
+    parser.add_argument('--docker-config', default='/root/.docker')
+    parser.add_argument('--oci-layout', nargs='*')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--timeout', type=int, default=600)
+    options = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level='WARNING')
+
+    images = [Image.parse(image) for image in options.images]
+    print(f'{"exporter":<12} {"images":>6} {"fetched MB":>11} {"written MB":>11} '
+          f'{"seconds":>8} {"MB/s":>7}')
+    for name in options.exporters:
+        args = argparse.Namespace(image_exporter=name, docker_config=options.docker_config,
+                                  oci_layout=options.oci_layout, export_workers=options.workers,
+                                  timeout=options.timeout, log='WARNING', save_workers=1)
+        with tempfile.TemporaryDirectory(dir='.') as tempdir:
+            try:
+                summary = image_exporter.get_exporter(args).run(
+                    images, os.path.join(tempdir, 'docker.tar'))
+            except (image_exporter.ImageExportError, EnvironmentError) as exc:
+                print(f'{name:<12} failed: {exc}', file=sys.stderr)
+                continue
+        print(f'{name:<12} {summary["images"]:>6} {summary["bytes_fetched"] / 2 ** 20:>11.1f} '
+              f'{summary["bytes_written"] / 2 ** 20:>11.1f} {summary["seconds"]:>8.1f} '
+              f'{summary["bytes_written"] / 2 ** 20 / max(summary["seconds"], 1e-6):>7.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -14,13 +14,17 @@
 # program(s) have been supplied.
 # ******************************************************************************
 import os
+import sys
+import hashlib
 import tempfile
+from unittest.mock import patch
 
 import pytest
 import argparse
 import tarfile
 
 from eric_am_package_manager.cli import __main__
+from eric_am_package_manager.cli import product_report as product_report_cli
 from eric_am_package_manager.generator import utils, generate
 from eric_am_package_manager.generator.cnf_values_file_exception import CnfValuesFileException
 
@@ -530,4 +534,37 @@ def test_is_archive_helmfile_positive(tmp_path_factory):
     args = __main__.parse_args(['generate', '--helmfile', str(tgz_filename), '--name', 'name',
                                 '--sol-version', SOL_VERSION])
     result = __main__.is_valid_helmfile(args)
-    assert result
\ No newline at end of file
+    assert result
+
+
+def test_add_split_image_artifacts(tmp_path):
+    for name, content in (('docker.tar', b'common'), ('docker-chart-1.0.0.tar', b'chart')):
+        (tmp_path / name).write_bytes(content)
+    artifacts = {'software_images': {'file': 'Files/images/docker.tar',
+                                     'properties': {'checksum': {'algorithm': 'sha-256',
+                                                                 'hash': 'common'}}}}
+
+    __main__.add_split_image_artifacts(artifacts, str(tmp_path / 'docker.tar'))
+
+    assert artifacts['software_images']['properties']['checksum']['hash'] == 'common'
+    artifact = artifacts['software_images_chart-1.0.0']
+    assert artifact['file'] == 'Files/images/docker-chart-1.0.0.tar'
+    assert artifact['properties']['checksum']['hash'] == \
+        hashlib.sha256(b'chart').hexdigest()
+
+
+@pytest.mark.parametrize('flag', ['--compress-threads', '--save-workers', '--export-workers'])
+def test_check_arguments_workers_not_positive(default_args, flag, capsys):
+    with pytest.raises(SystemExit):
+        __main__.parse_args(default_args + [flag, '0'])
+    _, err = capsys.readouterr()
+    assert f"argument {flag}: The value [0] provided is not a positive integer" in err
+
+
+def test_product_report_jobs_not_positive(capsys):
+    with patch.object(sys, 'argv', ['product-report', 'helm', '--helm-chart-file', VNFD,
+                                    '--jobs', '-1']):
+        with pytest.raises(SystemExit):
+            product_report_cli.main()
+    _, err = capsys.readouterr()
+    assert "argument --jobs: The value [-1] provided is not a positive integer" in err
@@ -0,0 +1,123 @@
+# ******************************************************************************
+# COPYRIGHT Ericsson 2024
+#
+#
+#
+# The copyright to the computer program(s) herein is the property of
+#
+# Ericsson Inc. The programs may be used and/or copied only with written
+#
+# permission from Ericsson Inc. or in accordance with the terms and
+#
+# conditions stipulated in the agreement/contract under which the
+#
+# program(s) have been supplied.
+# ******************************************************************************
+"""Unit tests for CSAR writer"""
+
+import os
+import types
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from eric_am_package_manager.generator import csar_writer
+
+
+def write_csar(tmp_path, policy, files):
+    for name, content in files.items():
+        (tmp_path / name).write_bytes(content)
+
+    module = types.SimpleNamespace(zipfile=zipfile)
+    destination = tmp_path / 'test.csar'
+    with csar_writer.csar_zip_policy(module, policy):
+        with module.zipfile.ZipFile(destination, 'w', module.zipfile.ZIP_DEFLATED) as csar:
+            for name in files:
+                csar.write(tmp_path / name, name)
+    assert module.zipfile is zipfile
+
+    with zipfile.ZipFile(destination) as csar:
+        for name, content in files.items():
+            assert csar.read(name) == content
+        return {info.filename: info.compress_type for info in csar.infolist()}
+
+
+def test_deflate_all_members_by_default(tmp_path):
+    types_by_name = write_csar(tmp_path, csar_writer.CompressionPolicy(),
+                               {'chart.tgz': b'a' * 1000, 'TOSCA.yaml': b'b' * 1000})
+    assert set(types_by_name.values()) == {zipfile.ZIP_DEFLATED}
+
+
+def test_store_by_extension_and_size(tmp_path):
+    policy = csar_writer.CompressionPolicy(store_extensions=['.TGZ'], store_size=2000)
+    types_by_name = write_csar(tmp_path, policy, {'chart.tgz': b'a' * 1000,
+                                                  'docker.tar': b'c' * 3000,
+                                                  'TOSCA.yaml': b'b' * 1000})
+    assert types_by_name == {'chart.tgz': zipfile.ZIP_STORED,
+                             'docker.tar': zipfile.ZIP_STORED,
+                             'TOSCA.yaml': zipfile.ZIP_DEFLATED}
+
+
+def test_store_incompressible_members_when_auto(tmp_path):
+    policy = csar_writer.CompressionPolicy(compression=csar_writer.COMPRESSION_AUTO)
+    types_by_name = write_csar(tmp_path, policy, {'random.bin': os.urandom(600 * 1024),
+                                                  'TOSCA.yaml': b'b' * 600 * 1024})
+    assert types_by_name == {'random.bin': zipfile.ZIP_STORED,
+                             'TOSCA.yaml': zipfile.ZIP_DEFLATED}
+
+
+def test_parallel_compressor_creates_single_deflate_stream():
+    data = b''.join(str(i).encode() * (i % 7 + 1) for i in range(20000))
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        compressor = csar_writer.ParallelCompressor(executor, 4, block_size=4096)
+        compressed = b''.join(compressor.compress(data[i:i + 3000])
+                              for i in range(0, len(data), 3000))
+        compressed += compressor.flush()
+    assert zlib.decompress(compressed, -zlib.MAX_WBITS) == data
+
+
+def test_write_parallel_member_readable_by_zipfile(tmp_path):
+    content = os.urandom(1024) * 3000
+    (tmp_path / 'docker.tar').write_bytes(content)
+    zip_class = type('ZipFile', (csar_writer.CsarZipFile,),
+                     {'policy': csar_writer.CompressionPolicy(threads=4)})
+    with zip_class(tmp_path / 'test.csar', 'w') as csar:
+        csar.write_parallel(tmp_path / 'docker.tar', 'Files/images/docker.tar')
+
+    with zipfile.ZipFile(tmp_path / 'test.csar') as csar:
+        assert csar.testzip() is None
+        info = csar.getinfo('Files/images/docker.tar')
+        assert info.compress_type == zipfile.ZIP_DEFLATED
+        assert info.compress_size < info.file_size
+        assert csar.read('Files/images/docker.tar') == content
+
+
+def write_reproducible_csar(source, destination):
+    module = types.SimpleNamespace(zipfile=zipfile, os=os)
+    with csar_writer.csar_zip_policy(module, csar_writer.CompressionPolicy(mtime=0)):
+        with module.zipfile.ZipFile(destination, 'w', module.zipfile.ZIP_DEFLATED) as csar:
+            for root, _, files in module.os.walk(source):
+                for name in files:
+                    csar.write(os.path.join(root, name),
+                               os.path.relpath(os.path.join(root, name), source))
+            csar.writestr('TOSCA-Metadata/TOSCA.meta', 'Entry-Definitions: TOSCA.yaml\n')
+    assert module.os is os
+    return destination.read_bytes()
+
+
+def test_reproducible_csar(tmp_path):
+    for build, names in (('first', ['b.yaml', 'a.tgz']), ('second', ['a.tgz', 'b.yaml'])):
+        for mode, name in enumerate(names):
+            path = tmp_path / build / 'Definitions' / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(name.encode())
+            os.chmod(path, 0o600 + mode * 0o40)
+            os.utime(path, (1000000000 * (mode + 1),) * 2)
+
+    first = write_reproducible_csar(tmp_path / 'first', tmp_path / 'first.csar')
+    assert first == write_reproducible_csar(tmp_path / 'second', tmp_path / 'second.csar')
+    with zipfile.ZipFile(tmp_path / 'first.csar') as csar:
+        assert csar.namelist() == ['Definitions/a.tgz', 'Definitions/b.yaml',
+                                   'TOSCA-Metadata/TOSCA.meta']
+        assert {info.date_time for info in csar.infolist()} == {(1980, 1, 1, 0, 0, 0)}
+        assert {info.external_attr >> 16 for info in csar.infolist()} == {0o100644}
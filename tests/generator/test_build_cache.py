@@ -0,0 +1,96 @@
+# ******************************************************************************
+# COPYRIGHT Ericsson 2024
+#
+#
+#
+# The copyright to the computer program(s) herein is the property of
+#
+# Ericsson Inc. The programs may be used and/or copied only with written
+#
+# permission from Ericsson Inc. or in accordance with the terms and
+#
+# conditions stipulated in the agreement/contract under which the
+#
+# program(s) have been supplied.
+# ******************************************************************************
+import argparse
+import os
+from unittest.mock import patch
+
+from eric_am_package_manager.generator import build_cache, generate, hash_utils, image_exporter
+from eric_am_package_manager.generator.docker_api import DockerApiError
+from eric_am_package_manager.generator.image import Image
+
+
+def test_stage_reused_with_same_inputs(tmp_path, caplog):
+    caplog.set_level('INFO')
+    cache = build_cache.BuildCache(str(tmp_path / 'cache'), explain=True)
+    output = tmp_path / 'output.txt'
+    output.write_text('output')
+
+    assert cache.get('stage', {'a': '1'}) is None
+    cache.put('stage', {'a': '1'}, data={'x': 1}, files={'output.txt': str(output)})
+    assert cache.get('stage', {'a': '2', 'b': '1'}) is None
+    assert cache.get('stage', {'a': '1'}) == {'x': 1}
+
+    cache.restore('stage', 'output.txt', str(tmp_path / 'restored.txt'))
+    assert (tmp_path / 'restored.txt').read_text() == 'output'
+    assert 'Build cache: Stage stage rerun: no previous build' in caplog.text
+    assert 'Build cache: Stage stage rerun: a changed, b added' in caplog.text
+    assert 'Build cache: Stage stage reused: inputs unchanged' in caplog.text
+
+
+def test_docker_tar_reused(tmp_path):
+    chart = tmp_path / 'chart-1.0.0.tgz'
+    chart.write_bytes(b'chart')
+    args = argparse.Namespace(helm=[str(chart)], helm_dir=None, helmfile=None, agentk=False,
+                              helm3=True, helm_version=None, is_upgrade=False, set=None,
+                              values=None, disable_helm_template=False, eric_product_info=False,
+                              eric_product_info_charts=None, timeout=1, docker_config='')
+    cache = build_cache.BuildCache(str(tmp_path / 'cache'))
+
+    def save(images, path, algorithms):
+        with open(path, 'w', encoding='utf-8') as tar:
+            tar.write(' '.join(map(str, images)))
+
+    images = [Image.parse('host/proj/x:1.0')]
+    with patch.object(generate, '__collect_images',
+                      return_value=[(str(chart), images)]) as get_images, \
+            patch('eric_am_package_manager.generator.generate.DockerApi') as docker_api, \
+            patch.object(image_exporter.DockerExporter, 'pull_images') as pull, \
+            patch.object(image_exporter.DockerExporter, 'save_images', side_effect=save) \
+            as save_images:
+        docker_api.return_value.get_manifest_hash.return_value = 'a' * 64
+        for build in ('first', 'second'):
+            os.makedirs(tmp_path / build / 'Files/images')
+            docker_file = generate.create_docker_tar(str(tmp_path / build), args, (), cache)
+        assert get_images.call_count == pull.call_count == save_images.call_count == 1
+
+        # The tag moved in the registry
+        docker_api.return_value.get_manifest_hash.return_value = 'b' * 64
+        os.makedirs(tmp_path / 'moved' / 'Files/images')
+        generate.create_docker_tar(str(tmp_path / 'moved'), args, (), cache)
+        assert save_images.call_count == 2
+
+        # Unresolved tags are never reused
+        docker_api.return_value.get_manifest_hash.side_effect = DockerApiError(404, 'not found')
+        for build in ('unresolved', 'unresolved-again'):
+            os.makedirs(tmp_path / build / 'Files/images')
+            generate.create_docker_tar(str(tmp_path / build), args, (), cache)
+        assert save_images.call_count == 4
+
+    with open(docker_file, encoding='utf-8') as tar:
+        assert tar.read() == 'host/proj/x:1.0'
+    assert 'sha256' in hash_utils.get_digests(docker_file)
+
+
+def test_layout_inputs_follow_index(tmp_path):
+    layout = tmp_path / 'layout'
+    layout.mkdir()
+    (layout / 'index.json').write_text('{"manifests": []}')
+    args = argparse.Namespace(oci_layout=[str(layout)])
+    inputs = generate.__get_layout_inputs(args)
+
+    (layout / 'index.json').write_text('{"manifests": [{"digest": "sha256:1"}]}')
+    assert generate.__get_layout_inputs(args) != inputs
+    assert generate.__get_layout_inputs(argparse.Namespace(oci_layout=None)) == {}
@@ -0,0 +1,250 @@
+# ******************************************************************************
+# COPYRIGHT Ericsson 2024
+#
+#
+#
+# The copyright to the computer program(s) herein is the property of
+#
+# Ericsson Inc. The programs may be used and/or copied only with written
+#
+# permission from Ericsson Inc. or in accordance with the terms and
+#
+# conditions stipulated in the agreement/contract under which the
+#
+# program(s) have been supplied.
+# ******************************************************************************
+import io
+import hashlib
+import json
+import tarfile
+import zipfile
+
+import pytest
+
+from eric_am_package_manager.generator import docker_archive, hash_utils
+
+
+def create_archive(path, members, mtime, tar_format=tarfile.DEFAULT_FORMAT):
+    with tarfile.open(path, 'w', format=tar_format) as tar:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = mtime
+            info.uid = 1000
+            tar.addfile(info, io.BytesIO(data))
+
+
+def test_normalize_archive_deterministic(tmp_path):
+    manifest = [{'Config': 'a.json', 'RepoTags': ['x:1'], 'Layers': ['l1/layer.tar']},
+                {'Config': 'b.json', 'RepoTags': ['y:1', 'y:0'], 'Layers': ['l1/layer.tar']}]
+    members = [('a.json', b'{}'), ('b.json', b'{}'), ('l1/layer.tar', b'layer'),
+               ('manifest.json', json.dumps(manifest).encode()),
+               ('repositories', b'{"y": {"1": "b"}, "x": {"1": "a"}}')]
+    create_archive(tmp_path / 'first.tar', members, 1000)
+    manifest.reverse()
+    members[3] = ('manifest.json', json.dumps(manifest).encode())
+    create_archive(tmp_path / 'second.tar', list(reversed(members)), 2000)
+
+    outputs = []
+    for name in ('first.tar', 'second.tar'):
+        output = io.BytesIO()
+        docker_archive.normalize_archive(tmp_path / name, output, 0)
+        outputs.append(output.getvalue())
+
+    assert outputs[0] == outputs[1]
+    with tarfile.open(fileobj=io.BytesIO(outputs[0])) as tar:
+        assert tar.getnames() == sorted(name for name, _ in members)
+        assert {(member.mtime, member.uid, member.mode) for member in tar} == {(0, 0, 0o644)}
+        assert [image['RepoTags'] for image in json.load(tar.extractfile('manifest.json'))] == \
+            [['x:1'], ['y:0', 'y:1']]
+
+
+def test_delta_rebuild_round_trip(tmp_path):
+    long_name = 'l3' * 60 + '/layer.tar'
+    create_archive(tmp_path / 'baseline.tar', [('l1/layer.tar', b'one' * 1000),
+                                               ('l2/layer.tar', b'two' * 1000),
+                                               ('manifest.json', b'[]')], 1000)
+    create_archive(tmp_path / 'docker.tar', [('l1/layer.tar', b'one' * 1000),
+                                             (long_name, b'three' * 1000),
+                                             ('manifest.json', b'[{}]')], 2000, tarfile.PAX_FORMAT)
+    with zipfile.ZipFile(tmp_path / 'baseline.csar', 'w') as csar:
+        csar.write(tmp_path / 'baseline.tar', docker_archive.CSAR_ARCHIVE_PATH)
+
+    members, trailer = docker_archive.read_members(tmp_path / 'docker.tar')
+    archive_digest = hashlib.sha256((tmp_path / 'docker.tar').read_bytes()).hexdigest()
+    index = docker_archive.read_layer_index(str(tmp_path / 'baseline.csar'))
+    delta, manifest = docker_archive.write_delta(str(tmp_path / 'docker.tar'), members, trailer,
+                                                 index, archive_digest)
+
+    with tarfile.open(delta) as tar:
+        assert tar.getnames() == [
+            'blobs/sha256/' + hashlib.sha256(data).hexdigest()
+            for data in (b'three' * 1000, b'[{}]')]
+    with zipfile.ZipFile(tmp_path / 'delta.csar', 'w') as csar:
+        csar.writestr('TOSCA-Metadata/TOSCA.meta', 'meta')
+        csar.write(delta, docker_archive.CSAR_ARCHIVE_PATH + docker_archive.DELTA_SUFFIX)
+        csar.write(manifest, docker_archive.CSAR_ARCHIVE_PATH +
+                   docker_archive.DELTA_MANIFEST_SUFFIX)
+
+    docker_archive.rebuild_csar(tmp_path / 'baseline.csar', tmp_path / 'delta.csar',
+                                tmp_path / 'full.csar')
+
+    with zipfile.ZipFile(tmp_path / 'full.csar') as csar:
+        assert csar.namelist() == ['TOSCA-Metadata/TOSCA.meta', docker_archive.CSAR_ARCHIVE_PATH]
+        assert csar.read(docker_archive.CSAR_ARCHIVE_PATH) == \
+            (tmp_path / 'docker.tar').read_bytes()
+
+    with open(manifest, encoding='utf-8') as manifest_file:
+        data = json.load(manifest_file)
+    data['sha256'] = '0' * 64
+    with pytest.raises(docker_archive.DockerArchiveError, match='Digest mismatch'):
+        docker_archive.rebuild_archive(data, delta, tmp_path / 'baseline.tar',
+                                       tmp_path / 'rebuilt.tar')
+
+
+def test_split_archive_shared_layers_once(tmp_path):
+    manifest = [{'Config': 'a.json', 'RepoTags': ['x:1'], 'Layers': ['l1/layer.tar', 'l2/layer.tar']},
+                {'Config': 'b.json', 'RepoTags': ['y:1'], 'Layers': ['l1/layer.tar', 'l3/layer.tar']},
+                {'Config': 'c.json', 'RepoTags': ['z:1'], 'Layers': ['l4/layer.tar']}]
+    repositories = {'x': {'1': 'l2'}, 'y': {'1': 'l3'}, 'z': {'1': 'l4'}}
+    members = [('a.json', b'{}'), ('b.json', b'{}'), ('c.json', b'{}'),
+               ('l1/json', b'{}'), ('l1/layer.tar', b'1' * 600), ('l2/layer.tar', b'2'),
+               ('l3/layer.tar', b'3'), ('l4/layer.tar', b'4' * 600),
+               ('manifest.json', json.dumps(manifest).encode()),
+               ('repositories', json.dumps(repositories).encode())]
+    create_archive(tmp_path / 'source.tar', members, 1000)
+
+    read, sizes = docker_archive.read_manifest(tmp_path / 'source.tar')
+    assignments = docker_archive.assign_by_images(read, [('first', ['docker.io/library/x:1', 'z:1']),
+                                                         ('second', ['y:1'])])
+    assert assignments == ['first', 'second', 'first']
+    assert docker_archive.assign_by_size(read, sizes, 1000) == ['001', '001', '002']
+
+    paths = docker_archive.split_archive(str(tmp_path / 'source.tar'),
+                                         str(tmp_path / 'docker.tar'), assignments, ['sha-256'])
+
+    assert paths == {None: str(tmp_path / 'docker.tar'),
+                     'first': str(tmp_path / 'docker-first.tar'),
+                     'second': str(tmp_path / 'docker-second.tar')}
+    contents = {}
+    for partition, path in paths.items():
+        with tarfile.open(path) as tar:
+            contents[partition] = {member.name: tar.extractfile(member).read() for member in tar}
+        assert hash_utils.get_digests(path)['sha256'] == \
+            hashlib.sha256(open(path, 'rb').read()).hexdigest()
+    assert sorted(contents[None]) == ['l1/json', 'l1/layer.tar', 'manifest.json', 'repositories']
+    assert json.loads(contents[None]['manifest.json']) == []
+    assert sorted(contents['first']) == ['a.json', 'c.json', 'l2/layer.tar', 'l4/layer.tar',
+                                         'manifest.json', 'repositories']
+    assert json.loads(contents['first']['manifest.json']) == [manifest[0], manifest[2]]
+    assert json.loads(contents['second']['repositories']) == {'y': {'1': 'l3'}}
+
+
+def load_concatenated(paths):
+    """Read archives concatenated with tar --concatenate as docker load extracts them"""
+    data = b''
+    for path in paths:
+        content = open(path, 'rb').read()
+        # tar --concatenate drops the end-of-archive blocks of the archive appended to
+        with tarfile.open(path) as tar:
+            end = max((member.offset_data + -(-member.size // 512) * 512 for member in tar),
+                      default=0)
+        data += content[:end] if path != paths[-1] else content
+    files = {}
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        for member in tar:
+            files[member.name] = tar.extractfile(member).read()
+    manifest = json.loads(files['manifest.json'])
+    missing = [name for entry in manifest for name in [entry['Config'], *entry['Layers']]
+               if name not in files]
+    return sorted(tag for entry in manifest for tag in entry['RepoTags']), missing
+
+
+def test_split_archive_concatenated_with_common(tmp_path):
+    manifest = [{'Config': 'a.json', 'RepoTags': ['x:1'], 'Layers': ['l1/layer.tar', 'l2/layer.tar']},
+                {'Config': 'b.json', 'RepoTags': ['y:1'], 'Layers': ['l1/layer.tar', 'l3/layer.tar']},
+                {'Config': 'c.json', 'RepoTags': ['z:1'], 'Layers': ['l4/layer.tar']}]
+    create_archive(tmp_path / 'source.tar', [
+        ('a.json', b'{}'), ('b.json', b'{}'), ('c.json', b'{}'), ('l1/layer.tar', b'1'),
+        ('l2/layer.tar', b'2'), ('l3/layer.tar', b'3'), ('l4/layer.tar', b'4'),
+        ('manifest.json', json.dumps(manifest).encode())], 1000)
+
+    # z:1 is found from both charts and written to the common archive
+    paths = docker_archive.split_archive(str(tmp_path / 'source.tar'), str(tmp_path / 'docker.tar'),
+                                         ['first', 'second', None])
+
+    assert load_concatenated([paths[None]]) == (['z:1'], [])
+    assert load_concatenated([paths[None], paths['first']]) == (['x:1', 'z:1'], [])
+    assert load_concatenated([paths[None], paths['second']]) == (['y:1', 'z:1'], [])
+
+
+def test_merge_archives(tmp_path):
+    first = [{'Config': 'a.json', 'RepoTags': ['x:1'], 'Layers': ['l1/layer.tar']},
+             {'Config': 'b.json', 'RepoTags': ['y:1'], 'Layers': ['l1/layer.tar', 'l2/layer.tar']}]
+    second = [{'Config': 'b.json', 'RepoTags': ['y:2'], 'Layers': ['l1/layer.tar', 'l2/layer.tar']}]
+    create_archive(tmp_path / 'first.tar', [
+        ('a.json', b'{}'), ('b.json', b'{}'), ('l1/layer.tar', b'1'), ('l2/layer.tar', b'2'),
+        ('manifest.json', json.dumps(first).encode()),
+        ('repositories', b'{"x": {"1": "l1"}, "y": {"1": "l2"}}')], 1000)
+    create_archive(tmp_path / 'second.tar', [
+        ('b.json', b'{}'), ('l1/layer.tar', b'1'), ('l2/layer.tar', b'2'),
+        ('manifest.json', json.dumps(second).encode()), ('repositories', b'{"y": {"2": "l2"}}')],
+        1000)
+
+    output = io.BytesIO()
+    docker_archive.merge_archives([tmp_path / 'first.tar', tmp_path / 'second.tar'], output)
+
+    with tarfile.open(fileobj=io.BytesIO(output.getvalue())) as tar:
+        assert tar.getnames() == ['a.json', 'b.json', 'l1/layer.tar', 'l2/layer.tar',
+                                  'manifest.json', 'repositories']
+        assert [image['RepoTags'] for image in json.load(tar.extractfile('manifest.json'))] == \
+            [['x:1'], ['y:1', 'y:2']]
+        assert json.load(tar.extractfile('repositories')) == \
+            {'x': {'1': 'l1'}, 'y': {'1': 'l2', '2': 'l2'}}
+
+    create_archive(tmp_path / 'second.tar', [('l1/layer.tar', b'other')], 1000)
+    with pytest.raises(docker_archive.DockerArchiveError, match='l1/layer.tar'):
+        docker_archive.merge_archives([tmp_path / 'first.tar', tmp_path / 'second.tar'],
+                                      io.BytesIO())
+
+
+def test_rebuild_csar_rewrites_manifest_digests(tmp_path):
+    create_archive(tmp_path / 'baseline.tar', [('l1/layer.tar', b'one' * 1000),
+                                               ('manifest.json', b'[]')], 1000)
+    create_archive(tmp_path / 'docker.tar', [('l1/layer.tar', b'one' * 1000),
+                                             ('l2/layer.tar', b'two' * 1000),
+                                             ('manifest.json', b'[{}]')], 2000)
+    with zipfile.ZipFile(tmp_path / 'baseline.csar', 'w') as csar:
+        csar.write(tmp_path / 'baseline.tar', docker_archive.CSAR_ARCHIVE_PATH)
+    members, trailer = docker_archive.read_members(tmp_path / 'docker.tar')
+    delta, delta_manifest = docker_archive.write_delta(
+        str(tmp_path / 'docker.tar'), members, trailer,
+        docker_archive.read_layer_index(str(tmp_path / 'baseline.csar')),
+        hashlib.sha256((tmp_path / 'docker.tar').read_bytes()).hexdigest())
+
+    def entry(source, data):
+        return f'Source: {source}\nAlgorithm: SHA-512\nHash: {hashlib.sha512(data).hexdigest()}\n\n'
+
+    files = {'Definitions/vnfd.yaml': b'vnfd',
+             docker_archive.CSAR_ARCHIVE_PATH + docker_archive.DELTA_SUFFIX: open(delta, 'rb').read(),
+             docker_archive.CSAR_ARCHIVE_PATH + docker_archive.DELTA_MANIFEST_SUFFIX:
+                 open(delta_manifest, 'rb').read()}
+    package_manifest = 'metadata:\nvnf_product_name: x\n\n' + ''.join(
+        entry(name, data) for name, data in files.items())
+    for name, content in (('delta.csar', package_manifest),
+                          ('signed.csar', package_manifest + '-----BEGIN CMS-----\nx\n')):
+        with zipfile.ZipFile(tmp_path / name, 'w') as csar:
+            csar.writestr('vnfd.mf', content)
+            for member, data in files.items():
+                csar.writestr(member, data)
+
+    docker_archive.rebuild_csar(tmp_path / 'baseline.csar', tmp_path / 'delta.csar',
+                                tmp_path / 'full.csar')
+
+    with zipfile.ZipFile(tmp_path / 'full.csar') as csar:
+        assert csar.read('vnfd.mf').decode() == 'metadata:\nvnf_product_name: x\n\n' + entry(
+            'Definitions/vnfd.yaml', b'vnfd') + entry(docker_archive.CSAR_ARCHIVE_PATH,
+                                                      (tmp_path / 'docker.tar').read_bytes())
+    with pytest.raises(docker_archive.DockerArchiveError, match='signed'):
+        docker_archive.rebuild_csar(tmp_path / 'baseline.csar', tmp_path / 'signed.csar',
+                                    tmp_path / 'other.csar')
@@ -14,14 +14,20 @@
 # program(s) have been supplied.
 # ******************************************************************************
 import argparse
+import io
+import json
 import os
+import shutil
+import tarfile
+import pytest
+from unittest.mock import patch
 from yaml import safe_load
 from tempfile import TemporaryDirectory
 from pathlib import Path
 
-from eric_am_package_manager.generator import generate
+from eric_am_package_manager.generator import generate, utils, image_exporter
 from eric_am_package_manager.generator.image import Image
-from eric_am_package_manager.generator.crd_handler import extract_crds
+from eric_am_package_manager.generator.crd_handler import CrdIndex, extract_crds
 ROOT_DIR = os.path.abspath(os.path.join((os.path.abspath(__file__)), os.pardir))
 RESOURCES = os.path.abspath(os.path.join(ROOT_DIR, os.pardir, 'resources'))
 images = ["armdocker.rnd.ericsson.se/proj-orchestration-so/api-gateway:1.0.0-31",
@@ -122,6 +128,40 @@ def test_images_from_values_file():
     assert all(elem in expected_images for elem in image_list)
 
 
+@pytest.mark.parametrize('values_file', ['values.yaml', 'values_no_global.yaml',
+                                         'values_no_image_credentials.yaml',
+                                         'values_no_name.yaml', 'values_no_tag.yaml'])
+def test_images_from_values_file_in_chart_archive(values_file, tmp_path):
+    chart = tmp_path / 'eric-app-1.0.0.tgz'
+    with tarfile.open(chart, 'w:gz') as tar:
+        tar.add(os.path.join(RESOURCES, 'values_csar.yaml'), 'eric-app/charts/sub/values.yaml')
+        tar.add(os.path.join(RESOURCES, values_file), 'eric-app/values.yaml')
+    args = argparse.Namespace(helm3=True, helm_version=None)
+
+    with open(os.path.join(RESOURCES, values_file), "r") as values:
+        expected = generate.__parse_values_file_for_images(values.read())
+    with patch('eric_am_package_manager.generator.generate.check_output') as check_output:
+        image_list = generate.__handle_images_in_scalar_values(str(chart), args)
+
+    check_output.assert_not_called()
+    assert image_list == expected
+
+
+def test_values_file_missing_from_chart_archive(tmp_path):
+    chart = tmp_path / 'eric-app-1.0.0.tgz'
+    with tarfile.open(chart, 'w:gz') as tar:
+        tar.add(os.path.join(RESOURCES, 'values.yaml'), 'eric-app/charts/sub/values.yaml')
+    args = argparse.Namespace(helm3=True, helm_version=None)
+
+    with patch('eric_am_package_manager.generator.generate.check_output') as check_output:
+        with open(os.path.join(RESOURCES, 'values.yaml'), 'rb') as values:
+            check_output.return_value = values.read()
+        image_list = generate.__handle_images_in_scalar_values(str(chart), args)
+
+    check_output.assert_called_once_with(['helm3', 'show', 'values', str(chart)])
+    assert len(image_list) == len(expected_images)
+
+
 def test_images_from_values_file_no_global():
     with open(os.path.join(RESOURCES, "values_no_global.yaml"), "r") as values:
         image_list = generate.__parse_values_file_for_images(values.read())
@@ -248,6 +288,72 @@ def test_extract_crds():
                 actual_list(outdir)) == sorted(expected_list(outdir))
 
 
+def test_extract_crds_newest_numeric_version():
+    with TemporaryDirectory() as helmdir:
+        with TemporaryDirectory() as outdir:
+            generate_directory_structure(
+                {
+                    "eric-crd": {
+                        "crd1-1.9.0.tgz": None,
+                        "crd10-1.0.0.tgz": None
+                    },
+                    "charts": {
+                        "subchart": {
+                            "eric-crd": {
+                                "crd1-1.10.0.tgz": None
+                            }
+                        }
+                    }
+                },
+                Path(helmdir)
+            )
+            extract_crds(Path(helmdir), Path(outdir))
+            assert sorted(os.listdir(outdir)) == ['crd1-1.10.0.tgz', 'crd10-1.0.0.tgz']
+
+
+def test_crds_from_chart_archives(tmp_path):
+    charts = []
+    for chart, crds in (('a', ['crd1-1.9.0.tgz', 'crd2-2.0.0.tgz']),
+                        ('b', ['crd1-1.10.0.tgz', 'crd2-1.0.0.tgz'])):
+        charts.append(tmp_path / f'{chart}-1.0.0.tgz')
+        with tarfile.open(charts[-1], 'w:gz') as tar:
+            for name in crds:
+                info = tarfile.TarInfo(f'{chart}/charts/sub/eric-crd/{name}')
+                info.size = len(name)
+                tar.addfile(info, io.BytesIO(name.encode()))
+    outdir = tmp_path / 'out'
+    outdir.mkdir()
+
+    crds = CrdIndex()
+    for chart in charts:
+        crds.add_archive(str(chart))
+    crds.write(outdir)
+
+    assert sorted(os.listdir(outdir)) == ['crd1-1.10.0.tgz', 'crd2-2.0.0.tgz']
+    assert (outdir / 'crd1-1.10.0.tgz').read_bytes() == b'crd1-1.10.0.tgz'
+
+
+def test_crds_from_chart_archives_keep_newer_existing(tmp_path):
+    chart = tmp_path / 'a-1.0.0.tgz'
+    with tarfile.open(chart, 'w:gz') as tar:
+        for name in ('eric-sec-crd-1.9.0.tgz', 'crd3-1.0.0.tgz'):
+            info = tarfile.TarInfo(f'a/eric-crd/{name}')
+            info.size = len(name)
+            tar.addfile(info, io.BytesIO(name.encode()))
+    outdir = tmp_path / 'out'
+    outdir.mkdir()
+    (outdir / 'eric-sec-crd-2.0.0.tgz').write_bytes(b'newer')
+    (outdir / 'crd3-0.9.0.tgz').write_bytes(b'older')
+
+    crds = CrdIndex()
+    crds.add_existing(outdir)
+    crds.add_archive(str(chart))
+    crds.write(outdir)
+
+    assert sorted(os.listdir(outdir)) == ['crd3-1.0.0.tgz', 'eric-sec-crd-2.0.0.tgz']
+    assert (outdir / 'eric-sec-crd-2.0.0.tgz').read_bytes() == b'newer'
+
+
 def actual_list(outdir):
     return list(Path(outdir).rglob("*"))
 
@@ -256,3 +362,197 @@ def expected_list(outdir):
     return [Path(outdir, "crd1-1.0.0.tgz"),
             Path(outdir, "crd2-1.0.0.tgz"),
             Path(outdir, "subcrd-1.0.0.tgz")]
+
+
+def create_docker_tar(path, repo_tags):
+    manifest = json.dumps([{'Config': 'config.json', 'RepoTags': repo_tags,
+                            'Layers': ['layer/layer.tar']}]).encode()
+    with tarfile.open(path, 'w') as tar:
+        for name, content in (('layer/layer.tar', b'layer'), ('manifest.json', manifest)):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+
+
+def test_read_docker_tar_images():
+    with TemporaryDirectory() as tempdir:
+        docker_file = os.path.join(tempdir, 'docker.tar')
+        create_docker_tar(docker_file, images[:2])
+        assert generate.read_docker_tar_images(docker_file) == images[:2]
+
+
+def test_verify_docker_tar_images():
+    with TemporaryDirectory() as tempdir:
+        docker_file = os.path.join(tempdir, 'docker.tar')
+        create_docker_tar(docker_file, images[:2])
+        generate.verify_docker_tar_images(docker_file, generate.__parse_images(images[:2]))
+
+
+def test_verify_docker_tar_images_missing_and_extra():
+    with TemporaryDirectory() as tempdir:
+        docker_file = os.path.join(tempdir, 'docker.tar')
+        create_docker_tar(docker_file, images[:2])
+        with pytest.raises(SystemExit):
+            generate.verify_docker_tar_images(docker_file, generate.__parse_images(images[1:3]))
+
+
+def test_identical_subcharts_scanned_once(tmp_path):
+    source = os.path.join(RESOURCES, "helmdirs/eric-cloud-native-base")
+    generate._PRODUCT_INFO_IMAGES_CACHE.clear()
+
+    images = []
+    for name in ('eric-app-1', 'eric-app-2'):
+        shutil.copytree(source, tmp_path / name)
+        images.append(generate.__get_images_from_eric_product_info(str(tmp_path / name), []))
+
+    assert images[0] == images[1]
+    assert len(images[0]) == 4
+    # Each subchart once, and the umbrella charts differing by name
+    assert len(generate._PRODUCT_INFO_IMAGES_CACHE) == 4
+
+
+def test_images_from_values_without_helm(tmp_path):
+    chart = tmp_path / 'eric-cloud-native-base-1.50.0.tgz'
+    with tarfile.open(chart, 'w:gz') as tar:
+        tar.add(os.path.join(RESOURCES, 'helmdirs/eric-cloud-native-base'), 'eric-cloud-native-base')
+        tar.add(os.path.join(RESOURCES, 'values.yaml'), 'eric-cloud-native-base/values.yaml')
+    values_file = tmp_path / 'site_values.yaml'
+    values_file.write_text('global:\n  registry:\n    url: registry.example.com\n')
+    args = argparse.Namespace(image_discovery=generate.IMAGE_DISCOVERY_VALUES,
+                              helm_dir=None, helm=[str(chart)], helmfile=None,
+                              values=[str(values_file)],
+                              set=['eric-mesh-controller.images.pilot.tag=1.2.0-1'])
+
+    with patch('eric_am_package_manager.generator.generate.check_output') as check_output:
+        images = set(map(str, generate.get_images(args)))
+
+    check_output.assert_not_called()
+    assert 'armdocker.rnd.ericsson.se/proj-adp-eric-ctrl-bro-drop/eric-ctrl-bro:4.7.0-23' in images
+    assert 'registry.example.com/proj-adp-gs-service-mesh/eric-mesh-controller:1.2.0-1' in images
+    assert 'registry.example.com/proj-adp-gs-service-mesh/eric-mesh-proxy:1.1.0-130' in images
+    assert len(images) == 4 + len(expected_images)
+
+
+def test_parse_set_values():
+    assert utils.parse_set_values(['a.b=1,a.c=true', r'd\.e=x\,y']) == \
+        {'a': {'b': 1, 'c': True}, 'd.e': 'x,y'}
+    assert utils.deep_merge({'a': {'b': 1, 'c': 2}, 'd': 1}, {'a': {'c': 3}}) == \
+        {'a': {'b': 1, 'c': 3}, 'd': 1}
+
+
+def test_parse_image_references():
+    image_list = generate.__parse_images(['localhost:5000/proj/name:1.0.0',
+                                          'nginx',
+                                          'docker.io/library/nginx:latest',
+                                          'proj/name@sha256:0123abcd'])
+
+    assert [str(image) for image in image_list] == ['localhost:5000/proj/name:1.0.0',
+                                                    'nginx:latest',
+                                                    'docker.io/library/nginx:latest',
+                                                    'proj/name@sha256:0123abcd']
+    assert (image_list[0].server, image_list[0].repository, image_list[0].tag) == \
+        ('localhost:5000', 'proj/name', '1.0.0')
+    assert image_list[1] == image_list[2] and len(set(image_list)) == 3
+    assert image_list[3].version == 'sha256:0123abcd'
+    assert Image.parse('localhost:5000/proj/name:1.0.0') is image_list[0]
+    with pytest.raises(AttributeError):
+        image_list[0].tag = '2.0.0'
+
+
+def test_deduplicate_images(caplog):
+    caplog.set_level('INFO')
+    image_list = generate.__deduplicate_images([
+        ('/charts/a-1.0.0.tgz', generate.__parse_images(['nginx:1.0', 'proj/x:1.0'])),
+        ('/charts/b-1.0.0.tgz', generate.__parse_images(['docker.io/library/nginx:1.0']))])
+
+    assert list(map(str, image_list)) == ['nginx:1.0', 'proj/x:1.0']
+    assert 'Image nginx:1.0 found from a-1.0.0.tgz, b-1.0.0.tgz' in caplog.text
+    assert 'also referenced as docker.io/library/nginx:1.0' in caplog.text
+
+
+@patch('eric_am_package_manager.generator.generate.DockerApi')
+def test_collapse_tags_pulls_digest_once(docker_api):
+    digests = {'host/proj/x:1.0': 'a', 'host/proj/x:stable': 'a', 'host/proj/y:1.0': 'b'}
+    docker_api.return_value.get_manifest_hash.side_effect = digests.get
+    image_list = generate.__parse_images(['host/proj/x@sha256:a', *digests])
+
+    groups = generate.__collapse_tags(argparse.Namespace(docker_config='', timeout=1), image_list)
+    assert [list(map(str, group)) for group in groups] == \
+        [['host/proj/x:1.0', 'host/proj/x:stable', 'host/proj/x@sha256:a'], ['host/proj/y:1.0']]
+
+    exporter = image_exporter.DockerExporter(argparse.Namespace(timeout=1))
+    exporter.progress = image_exporter.ExportProgress(exporter.name, 3)
+    with patch('eric_am_package_manager.generator.image_exporter.docker') as docker:
+        exporter.pull_image(groups[0])
+    pull = docker.from_env.return_value.images.pull
+    pull.assert_called_once_with(repository='host/proj/x', tag='1.0')
+    pull.return_value.tag.assert_called_once_with('host/proj/x', 'stable')
+
+
+@patch('eric_am_package_manager.generator.generate.DockerApi')
+def test_images_lock(docker_api, tmp_path):
+    docker_api.return_value.get_image_manifest.return_value = \
+        {'config': {'size': 1}, 'layers': [{'size': 2}, {'size': 3}]}
+    docker_api.return_value.get_manifest_hash.return_value = '0123abcd'
+    docker_api.return_value.get_blob.return_value = {'os': 'linux', 'architecture': 'amd64'}
+    chart_images = {'a-1.0.0.tgz': ['host/proj/x:1.0'], 'b-1.0.0.tgz': ['host/proj/y:1.0']}
+    charts = []
+    for name in chart_images:
+        charts.append(tmp_path / name)
+        charts[-1].write_bytes(name.encode())
+    args = argparse.Namespace(images_lock=str(tmp_path / 'images.lock'), refresh_lock=False,
+                              helm=list(map(str, charts)), helm_dir=None, helmfile=None,
+                              helm3=True, helm_version=None, is_upgrade=False, set=None,
+                              values=None, disable_helm_template=False, eric_product_info=False,
+                              eric_product_info_charts=None, docker_config='', timeout=1)
+    collect = patch.object(generate, '__collect_images', side_effect=lambda _, paths: [
+        (path, generate.__parse_images(chart_images[os.path.basename(path)])) for path in paths])
+
+    with collect as collect_images:
+        images, digests = generate.__get_locked_images(args)
+        generate.__get_locked_images(args)
+    assert collect_images.call_count == 1
+    assert list(map(str, images)) == ['host/proj/x:1.0', 'host/proj/y:1.0']
+    assert digests[images[0]] == 'sha256:0123abcd'
+    lock = safe_load(Path(args.images_lock).read_text())
+    assert lock['images']['host/proj/y:1.0'] == \
+        {'digest': 'sha256:0123abcd', 'size': 6, 'platform': 'linux/amd64'}
+
+    charts[1].write_bytes(b'changed')
+    chart_images['b-1.0.0.tgz'] = ['host/proj/y:2.0']
+    with collect, pytest.raises(SystemExit):
+        generate.__get_locked_images(args)
+
+    args.refresh_lock = True
+    with collect as collect_images:
+        images, _ = generate.__get_locked_images(args)
+    collect_images.assert_called_once_with(args, [str(charts[1])])
+    assert list(map(str, images)) == ['host/proj/x:1.0', 'host/proj/y:2.0']
+    assert list(safe_load(Path(args.images_lock).read_text())['images']) == \
+        ['host/proj/x:1.0', 'host/proj/y:2.0']
+
+
+def test_docker_exporter_saves_concurrently(tmp_path):
+    def docker_save(list_of_images, output):
+        with tarfile.open(fileobj=output, mode='w|') as tar:
+            for name, data in (('base/layer.tar', b'base'),
+                               ('manifest.json', json.dumps([
+                                   {'Config': f'{image}.json', 'RepoTags': [image],
+                                    'Layers': ['base/layer.tar']} for image in list_of_images]))):
+                data = data.encode() if isinstance(data, str) else data
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+    image_list = [Image.parse(image) for image in ('x:1', 'y:1', 'z:1')]
+    filename = str(tmp_path / 'docker.tar')
+    exporter = image_exporter.DockerExporter(argparse.Namespace(save_workers=2))
+    with patch.object(image_exporter.DockerExporter, 'docker_save', side_effect=docker_save) as save:
+        exporter.save_images(image_list, filename, ['sha-256'])
+
+    assert [call.args[0] for call in save.call_args_list] in \
+        ([['x:1', 'z:1'], ['y:1']], [['y:1'], ['x:1', 'z:1']])
+    assert sorted(generate.read_docker_tar_images(filename)) == ['x:1', 'y:1', 'z:1']
+    with tarfile.open(filename) as tar:
+        assert tar.getnames().count('base/layer.tar') == 1
+    assert os.listdir(tmp_path) == ['docker.tar']
@@ -0,0 +1,213 @@
+# ******************************************************************************
+# COPYRIGHT Ericsson 2024
+#
+#
+#
+# The copyright to the computer program(s) herein is the property of
+#
+# Ericsson Inc. The programs may be used and/or copied only with written
+#
+# permission from Ericsson Inc. or in accordance with the terms and
+#
+# conditions stipulated in the agreement/contract under which the
+#
+# program(s) have been supplied.
+# ******************************************************************************
+import argparse
+import io
+import hashlib
+import json
+import subprocess
+import sys
+import tarfile
+from unittest.mock import patch
+
+import pytest
+
+from eric_am_package_manager.generator import image_exporter, hash_utils
+from eric_am_package_manager.generator.image import Image
+
+
+def add_blob(layout, data):
+    digest = hashlib.sha256(data).hexdigest()
+    (layout / 'blobs' / 'sha256' / digest).write_bytes(data)
+    return {'digest': f'sha256:{digest}', 'size': len(data)}
+
+
+def create_layout(layout, images):
+    (layout / 'blobs' / 'sha256').mkdir(parents=True)
+    (layout / 'oci-layout').write_text('{"imageLayoutVersion": "1.0.0"}')
+    base = add_blob(layout, b'base layer')
+    manifests = []
+    for name in images:
+        manifest = {'schemaVersion': 2,
+                    'mediaType': 'application/vnd.oci.image.manifest.v1+json',
+                    'config': add_blob(layout, f'{{"name": "{name}"}}'.encode()),
+                    'layers': [base, add_blob(layout, name.encode())]}
+        descriptor = add_blob(layout, json.dumps(manifest).encode())
+        descriptor['annotations'] = {'io.containerd.image.name': name}
+        manifests.append(descriptor)
+    (layout / 'index.json').write_text(json.dumps({'schemaVersion': 2, 'manifests': manifests}))
+    return base
+
+
+def test_oci_layout_exporter(tmp_path):
+    base = create_layout(tmp_path / 'layout', ['host/proj/x:1.0', 'docker.io/library/y:2.0'])
+    args = argparse.Namespace(image_exporter=image_exporter.EXPORTER_OCI_LAYOUT,
+                              oci_layout=[str(tmp_path / 'layout')], export_workers=2)
+    images = [Image.parse('host/proj/x:1.0'), Image.parse('y:2.0')]
+
+    exporter = image_exporter.get_exporter(args, ['sha-256'], 0)
+    summary = exporter.run(images, str(tmp_path / 'docker.tar'))
+
+    assert summary['exporter'] == image_exporter.EXPORTER_OCI_LAYOUT
+    assert summary['images'] == 2
+    assert summary['bytes_written'] == (tmp_path / 'docker.tar').stat().st_size
+    with tarfile.open(tmp_path / 'docker.tar') as tar:
+        names = tar.getnames()
+        manifest = json.load(tar.extractfile('manifest.json'))
+    assert names.count('blobs/sha256/' + base['digest'].split(':')[1]) == 1
+    assert [entry['RepoTags'] for entry in manifest] == [['host/proj/x:1.0'], ['y:2.0']]
+    assert all(layer in names for entry in manifest for layer in entry['Layers'])
+    assert 'sha256' in hash_utils.get_digests(str(tmp_path / 'docker.tar'))
+
+    (tmp_path / 'layout' / 'blobs' / 'sha256' / base['digest'].split(':')[1]).write_bytes(
+        b'base LAYER')
+    with pytest.raises(image_exporter.ImageExportError, match='Digest mismatch'):
+        image_exporter.get_exporter(args).run(images, str(tmp_path / 'other.tar'))
+    with pytest.raises(image_exporter.ImageExportError, match='not found'):
+        image_exporter.get_exporter(args).run([Image.parse('z:1')], str(tmp_path / 'z.tar'))
+
+
+@patch('eric_am_package_manager.generator.image_exporter.DockerApi')
+def test_registry_exporter_downloads_blob_once(docker_api, tmp_path):
+    create_layout(tmp_path / 'layout', ['host/proj/x:1.0', 'host/proj/y:1.0'])
+    index = json.loads((tmp_path / 'layout' / 'index.json').read_text())
+    manifests = {descriptor['annotations']['io.containerd.image.name']:
+                 (tmp_path / 'layout' / 'blobs' / 'sha256' / descriptor['digest'][7:]).read_bytes()
+                 for descriptor in index['manifests']}
+
+    def download_blob(image, digest, output):
+        data = (tmp_path / 'layout' / 'blobs' / 'sha256' / digest[7:]).read_bytes()
+        output.write(data)
+        return len(data)
+
+    docker_api.return_value.get_manifest_content.side_effect = manifests.get
+    docker_api.return_value.download_blob.side_effect = download_blob
+    args = argparse.Namespace(image_exporter=image_exporter.EXPORTER_REGISTRY, docker_config='',
+                              timeout=1, export_workers=2)
+
+    summary = image_exporter.get_exporter(args).run(
+        [Image.parse(name) for name in manifests], str(tmp_path / 'docker.tar'))
+
+    # Two configs, two layers and the shared base layer
+    assert docker_api.return_value.download_blob.call_count == 5
+    assert summary['images'] == 2
+    assert summary['bytes_fetched'] == sum(
+        (tmp_path / 'layout' / 'blobs' / 'sha256' / call.args[1][7:]).stat().st_size
+        for call in docker_api.return_value.download_blob.call_args_list)
+
+
+@patch('eric_am_package_manager.generator.image_exporter.DockerApi')
+def test_registry_exporter_blob_cache(docker_api, tmp_path):
+    create_layout(tmp_path / 'layout', ['host/proj/x:1.0'])
+    descriptor = json.loads((tmp_path / 'layout' / 'index.json').read_text())['manifests'][0]
+
+    def download_blob(image, digest, output):
+        data = (tmp_path / 'layout' / 'blobs' / 'sha256' / digest[7:]).read_bytes()
+        output.write(data)
+        return len(data)
+
+    docker_api.return_value.get_manifest_content.return_value = (
+        tmp_path / 'layout' / 'blobs' / 'sha256' / descriptor['digest'][7:]).read_bytes()
+    docker_api.return_value.download_blob.side_effect = download_blob
+    args = argparse.Namespace(image_exporter=image_exporter.EXPORTER_REGISTRY, docker_config='',
+                              timeout=1, export_workers=2, blob_cache=str(tmp_path / 'cache'))
+    images = [Image.parse('host/proj/x:1.0')]
+
+    image_exporter.get_exporter(args).run(images, str(tmp_path / 'docker.tar'))
+    assert docker_api.return_value.download_blob.call_count == 3
+    cache_index = json.loads((tmp_path / 'cache' / 'index.json').read_text())
+    assert [manifest['digest'] for manifest in cache_index['manifests']] == [descriptor['digest']]
+
+    docker_api.reset_mock()
+    args.offline = True
+    summary = image_exporter.get_exporter(args).run(images, str(tmp_path / 'offline.tar'))
+    assert not docker_api.return_value.get_manifest_content.called
+    assert not docker_api.return_value.download_blob.called
+    assert summary['bytes_fetched'] == 0
+    assert summary['bytes_local'] > 0
+    assert (tmp_path / 'offline.tar').read_bytes() == (tmp_path / 'docker.tar').read_bytes()
+
+    with pytest.raises(image_exporter.ImageExportError, match='host/proj/z:1'):
+        image_exporter.get_exporter(args).run([Image.parse('host/proj/z:1')],
+                                              str(tmp_path / 'z.tar'))
+
+
+def test_docker_exporter_reads_local_images(tmp_path):
+    create_layout(tmp_path / 'layout', ['host/proj/x:1.0'])
+    args = argparse.Namespace(image_exporter=image_exporter.EXPORTER_DOCKER,
+                              oci_layout=[str(tmp_path / 'layout')], export_workers=1)
+    images = [Image.parse('host/proj/x:1.0'), Image.parse('host/proj/y:1.0')]
+
+    def export(exported, filename, hash_algorithms, digests, image_groups):
+        assert exported == images[1:] and image_groups == [images[1:]]
+        with tarfile.open(filename, 'w') as tar:
+            for name, data in (('y.json', b'{}'), ('manifest.json', json.dumps(
+                    [{'Config': 'y.json', 'RepoTags': ['host/proj/y:1.0'], 'Layers': []}]).encode())):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+    with patch.object(image_exporter.DockerExporter, 'export', side_effect=export):
+        summary = image_exporter.get_exporter(args, ['sha-256']).run(
+            images, str(tmp_path / 'docker.tar'))
+
+    assert summary['images'] == 1
+    with tarfile.open(tmp_path / 'docker.tar') as tar:
+        manifest = json.load(tar.extractfile('manifest.json'))
+    assert [entry['RepoTags'] for entry in manifest] == [['host/proj/x:1.0'], ['host/proj/y:1.0']]
+    assert 'sha256' in hash_utils.get_digests(str(tmp_path / 'docker.tar'))
+
+
+@patch('eric_am_package_manager.generator.image_exporter.DockerApi')
+def test_registry_exporter_resolves_index(docker_api, tmp_path):
+    create_layout(tmp_path / 'layout', ['host/proj/x:1.0'])
+    descriptor = json.loads((tmp_path / 'layout' / 'index.json').read_text())['manifests'][0]
+    blobs = tmp_path / 'layout' / 'blobs' / 'sha256'
+    index = {'schemaVersion': 2, 'mediaType': 'application/vnd.oci.image.index.v1+json',
+             'manifests': [dict(descriptor, platform={'os': 'linux', 'architecture': 'arm64'}),
+                           dict(descriptor, platform={'os': 'linux', 'architecture': 'amd64'})]}
+    contents = {'host/proj/x:1.0': json.dumps(index).encode(),
+                f'host/proj/x@{descriptor["digest"]}': (blobs / descriptor['digest'][7:]).read_bytes()}
+
+    def download_blob(image, digest, output):
+        return output.write((blobs / digest[7:]).read_bytes())
+
+    docker_api.return_value.get_manifest_content.side_effect = contents.get
+    docker_api.return_value.download_blob.side_effect = download_blob
+    args = argparse.Namespace(image_exporter=image_exporter.EXPORTER_REGISTRY, docker_config='',
+                              timeout=1, export_workers=1)
+
+    image_exporter.get_exporter(args).run([Image.parse('host/proj/x:1.0')],
+                                          str(tmp_path / 'docker.tar'))
+
+    with tarfile.open(tmp_path / 'docker.tar') as tar:
+        exported = json.load(tar.extractfile('index.json'))['manifests']
+    assert [manifest['digest'] for manifest in exported] == [descriptor['digest']]
+
+
+def test_docker_save_drains_stderr(tmp_path):
+    # More stderr than a pipe buffer holds before any stdout
+    script = ('import sys; sys.stderr.write("warning\\n" * 100000); sys.stderr.flush(); '
+              'sys.stdout.buffer.write(b"tar" * 100000); sys.exit(int(sys.argv[1]))')
+
+    def popen(command, **kwargs):
+        return subprocess.Popen([sys.executable, '-c', script, command[-1]], **kwargs)
+
+    output = io.BytesIO()
+    with patch.object(image_exporter, 'Popen', side_effect=popen):
+        image_exporter.DockerExporter.docker_save(['0'], output)
+        assert output.getvalue() == b'tar' * 100000
+        with pytest.raises(SystemExit):
+            image_exporter.DockerExporter.docker_save(['1'], io.BytesIO())
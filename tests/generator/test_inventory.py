@@ -0,0 +1,115 @@
+# ******************************************************************************
+# COPYRIGHT Ericsson 2024
+#
+#
+#
+# The copyright to the computer program(s) herein is the property of
+#
+# Ericsson Inc. The programs may be used and/or copied only with written
+#
+# permission from Ericsson Inc. or in accordance with the terms and
+#
+# conditions stipulated in the agreement/contract under which the
+#
+# program(s) have been supplied.
+# ******************************************************************************
+import io
+import os
+import tarfile
+from unittest.mock import patch
+
+from eric_am_package_manager.generator import inventory
+
+
+def create_archive(path, files):
+    with tarfile.open(path, 'w:gz') as tar:
+        for name, data in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+def test_archive_index(tmp_path):
+    chart = tmp_path / 'chart-1.0.0.tgz'
+    create_archive(chart, [('chart/Chart.yaml', b'name: chart'),
+                           ('chart/values.yaml', b'image: a'),
+                           ('chart/charts/sub/values.yaml', b'image: b'),
+                           ('chart/charts/sub/eric-crd/crd-1.0.0.tgz', b'crd'),
+                           ('chart/templates/deployment.yaml', b'kind: Deployment')])
+    index = inventory.get_archive(str(chart))
+
+    assert index.read_values() == b'image: a'
+    assert not index.complete
+    assert [member.name for member in index.members] == ['chart/Chart.yaml',
+                                                         'chart/values.yaml']
+    assert index.has_crds()
+    assert not index.has_helmfile()
+    assert index.complete
+    assert [member.name for member in index.members] == ['chart/Chart.yaml',
+                                                         'chart/values.yaml',
+                                                         'chart/charts/sub/values.yaml',
+                                                         'chart/charts/sub/eric-crd/crd-1.0.0.tgz',
+                                                         'chart/templates/deployment.yaml']
+    assert inventory.get_archive(str(chart)) is index
+
+
+def test_archive_index_closed_between_questions(tmp_path):
+    chart = tmp_path / 'chart-3.0.0.tgz'
+    create_archive(chart, [('chart/Chart.yaml', b'name: chart'),
+                           ('chart/values.yaml', b'image: a'),
+                           ('chart/charts/sub/eric-crd/crd-1.0.0.tgz', b'crd')])
+    index = inventory.get_archive(str(chart))
+    streams = []
+    tarfile_open = tarfile.open
+
+    def open_archive(*args, **kwargs):
+        streams.append(tarfile_open(*args, **kwargs))
+        return streams[-1]
+
+    with patch('tarfile.open', side_effect=open_archive):
+        assert index.read_values() == b'image: a'
+        assert index.has_crds()
+
+    assert len(streams) == 2
+    assert all(stream.closed for stream in streams)
+    assert len(index.members) == 3
+
+
+def test_archive_index_decompressed_once(tmp_path):
+    chart = tmp_path / 'chart-2.0.0.tgz'
+    create_archive(chart, [('chart/Chart.yaml', b'name: chart'),
+                           ('chart/charts/sub/eric-crd/crd-1.0.0.tgz', b'crd'),
+                           ('chart/values.yaml', b'image: a'),
+                           ('chart/templates/deployment.yaml', b'kind: Deployment')])
+    index = inventory.get_archive(str(chart))
+
+    with patch('tarfile.open', side_effect=tarfile.open) as open_archive:
+        assert not index.has_helmfile()
+        # Passed while looking for helmfile.yaml, kept without reading the archive again
+        assert index.read_values() == b'image: a'
+        assert index.has_crds()
+        assert len(index.get_members()) == 4
+
+    assert open_archive.call_count == 1
+
+
+def test_archive_index_helmfile(tmp_path):
+    helmfile = tmp_path / 'helmfile-1.0.0.tgz'
+    create_archive(helmfile, [('helmfile/helmfile.yaml', b'releases: []')])
+    index = inventory.get_archive(str(helmfile))
+
+    assert index.has_helmfile()
+    assert not index.has_crds()
+    assert index.read_values() is None
+
+
+def test_helm_dir_charts_listed_once(tmp_path):
+    (tmp_path / 'sub').mkdir()
+    for name in ('a-1.0.0.tgz', os.path.join('sub', 'b-1.0.0.tgz'), 'values.yaml'):
+        (tmp_path / name).write_bytes(b'')
+
+    charts = inventory.get_helm_dir_charts(str(tmp_path))
+    (tmp_path / 'c-1.0.0.tgz').write_bytes(b'')
+
+    assert sorted(charts) == ['a-1.0.0.tgz', os.path.join('sub', 'b-1.0.0.tgz')]
+    assert inventory.get_helm_dir_charts(str(tmp_path)) == charts
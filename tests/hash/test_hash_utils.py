@@ -13,6 +13,7 @@
 #
 # program(s) have been supplied.
 # ******************************************************************************
+import hashlib
 from eric_am_package_manager.generator import hash_utils
 import pytest
 import os
@@ -42,3 +43,28 @@ def test_sha224():
 def test_unknown_sha_key():
     with pytest.raises(KeyError) as output:
         hash_utils.HASH['md5'](RESOURCES + '/test_hash_dont_modify.tar')
+
+
+def test_hashing_writer_digests_reused(tmp_path):
+    file_path = tmp_path / 'docker.tar'
+    with open(file_path, 'wb') as file:
+        writer = hash_utils.HashingWriter(file, ['sha-256', 'sha-512'])
+        writer.write(b'layer')
+        writer.write(b'manifest')
+    digests = writer.hexdigests()
+    assert digests['sha256'] == hashlib.sha256(b'layermanifest').hexdigest()
+    assert writer.size == len(b'layermanifest')
+
+    hash_utils.remember_digests(file_path, {'sha256': 'ffff'})
+    assert hash_utils.HASH['sha-256'](file_path) == 'ffff'
+    assert hash_utils.HASH['sha-384'](file_path) == hashlib.sha384(b'layermanifest').hexdigest()
+
+
+def test_digests_shared_by_hard_links(tmp_path):
+    file_path = tmp_path / 'chart.tgz'
+    file_path.write_bytes(b'chart')
+    link_path = tmp_path / 'link.tgz'
+    os.link(file_path, link_path)
+
+    hash_utils.remember_digests(file_path, {'sha256': 'ffff'})
+    assert hash_utils.HASH['sha-256'](link_path) == 'ffff'
@@ -17,13 +17,20 @@
 """Unit tests for Product Report"""
 
 import argparse
+import hashlib
 import os
+import shutil
 import sys
-from unittest.mock import patch, ANY
+import threading
+import time
+from unittest.mock import patch, ANY, MagicMock
 from tempfile import NamedTemporaryFile
 import pytest
+import yaml
 
-from eric_am_package_manager.generator import product_report
+from eric_am_package_manager.generator import product_report, helm_utils, helm_template
+from eric_am_package_manager.generator.docker_api import DockerApi, DockerApiError
+from eric_am_package_manager.generator.helm_template import HelmTemplateIndex, render_once
 from eric_am_package_manager.generator.utils import load_yaml_file
 
 ROOT_DIR = os.path.abspath(os.path.join((os.path.abspath(__file__)),
@@ -31,6 +38,12 @@ ROOT_DIR = os.path.abspath(os.path.join((os.path.abspath(__file__)),
 RESOURCES = os.path.abspath(os.path.join(ROOT_DIR, 'resources'))
 
 
+@pytest.fixture(autouse=True)
+def clear_rendered_cache():
+    with patch.dict(helm_template._RENDERED_CACHE, clear=True):  # pylint: disable=protected-access
+        yield
+
+
 @pytest.fixture(name="mock_args")
 def default_args():
     return argparse.Namespace(docker_config="",
@@ -471,6 +484,305 @@ def test_helm_values(check_output, docker, labels, mock_extract, config, mock_sh
                                          ANY])
 
 
+RENDERED_CLOUD_NATIVE_BASE = b"""---
+# Source: eric-cloud-native-base/charts/eric-cm-mediator/templates/configmap.yaml
+apiVersion: v1
+kind: ConfigMap
+metadata:
+  name: eric-cm-mediator
+---
+# Source: eric-cloud-native-base/charts/eric-ctrl-bro/templates/deployment.yaml
+apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: eric-ctrl-bro
+---
+# Source: eric-cloud-native-base/templates/configmap.yaml
+apiVersion: v1
+kind: ConfigMap
+metadata:
+  name: eric-cloud-native-base
+"""
+
+
+def template_names(template):
+    return [obj['metadata']['name'] for obj in template.templates]
+
+
+def test_helm_template_index():
+    index = HelmTemplateIndex(RENDERED_CLOUD_NATIVE_BASE)
+    names = template_names
+
+    assert names(index.get_template()) == ['eric-cm-mediator', 'eric-ctrl-bro',
+                                           'eric-cloud-native-base']
+    assert names(index.get_template('charts/eric-ctrl-bro')) == ['eric-ctrl-bro']
+    assert not names(index.get_template('charts/eric-ctrl'))
+
+
+@patch('eric_am_package_manager.generator.docker_api.DockerApi.get_manifest_hash')
+@patch('eric_am_package_manager.generator.docker_api.DockerConfig.parse_config')
+@patch('eric_am_package_manager.generator.docker_api.DockerApi.get_labels')
+@patch('eric_am_package_manager.generator.product_report.ImageData.from_labels')
+@patch('eric_am_package_manager.generator.helm_utils.check_output')
+def test_helm_template_rendered_once(check_output, docker, labels, config, manifest_hash):
+    check_output.return_value = RENDERED_CLOUD_NATIVE_BASE
+    manifest_hash.return_value = 'ffff'
+    path = os.path.join(RESOURCES, "helmdirs/eric-cloud-native-base")
+
+    helm = product_report.HelmChart(path,
+                                    "eric-cloud-native-base",
+                                    sha256sum='ffff',
+                                    include_helm=True)
+    helm.parse()
+
+    check_output.assert_called_once_with(['helm3', 'template', path])
+    subcharts = {chart.template_path: chart for chart in helm.packages}
+    assert set(subcharts) == {'charts/eric-cm-mediator', 'charts/eric-ctrl-bro'}
+    # pylint: disable=protected-access
+    assert template_names(subcharts['charts/eric-ctrl-bro']._get_template()) == ['eric-ctrl-bro']
+
+
+RENDERED_ALIASED_BRO = b"""---
+# Source: eric-cloud-native-base/charts/bro-a/templates/deployment.yaml
+apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: bro-a
+---
+# Source: eric-cloud-native-base/charts/bro-b/templates/deployment.yaml
+apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: bro-b
+"""
+
+
+@patch('eric_am_package_manager.generator.docker_api.DockerApi.get_manifest_hash')
+@patch('eric_am_package_manager.generator.docker_api.DockerConfig.parse_config')
+@patch('eric_am_package_manager.generator.docker_api.DockerApi.get_labels')
+@patch('eric_am_package_manager.generator.product_report.ImageData.from_labels')
+@patch('eric_am_package_manager.generator.helm_utils.check_output')
+def test_helm_template_aliased_dependency(check_output, docker, labels, config, manifest_hash,
+                                          tmp_path):
+    check_output.return_value = RENDERED_ALIASED_BRO
+    manifest_hash.return_value = 'ffff'
+    path = os.path.join(tmp_path, "eric-cloud-native-base")
+    shutil.copytree(os.path.join(RESOURCES, "helmdirs/eric-cloud-native-base"), path,
+                    ignore=shutil.ignore_patterns('eric-cm-mediator'))
+    chart = load_yaml_file(os.path.join(path, 'Chart.yaml'))
+    chart['dependencies'] = [{'name': 'eric-ctrl-bro', 'alias': 'bro-a'},
+                             {'name': 'eric-ctrl-bro', 'alias': 'bro-b'}]
+    with open(os.path.join(path, 'Chart.yaml'), 'w', encoding='utf-8') as chart_file:
+        yaml.safe_dump(chart, chart_file)
+
+    helm = product_report.HelmChart(path,
+                                    "eric-cloud-native-base",
+                                    sha256sum='ffff',
+                                    include_helm=True)
+    helm.parse()
+
+    subcharts = {chart.template_path: chart for chart in helm.packages}
+    assert set(subcharts) == {'charts/bro-a', 'charts/bro-b'}
+    assert [chart.data.path for chart in helm.packages] == [
+        'eric-cloud-native-base/charts/bro-a', 'eric-cloud-native-base/charts/bro-b']
+    # pylint: disable=protected-access
+    assert template_names(subcharts['charts/bro-a']._get_template()) == ['bro-a']
+    assert template_names(subcharts['charts/bro-b']._get_template()) == ['bro-b']
+
+
+@patch('eric_am_package_manager.generator.docker_api.DockerApi.get_manifest_hash')
+@patch('eric_am_package_manager.generator.docker_api.DockerConfig.parse_config')
+@patch('eric_am_package_manager.generator.docker_api.DockerApi.get_labels')
+@patch('eric_am_package_manager.generator.product_report.HelmChart._parse_helm_template')
+def test_shared_image_resolved_once(_, labels, config, manifest_hash, tmp_path):
+    manifest_hash.side_effect = DockerApiError(404, 'Error requesting manifest')
+    path = os.path.join(tmp_path, "eric-cloud-native-base")
+    shutil.copytree(os.path.join(RESOURCES, "helmdirs/eric-cloud-native-base"), path)
+    shutil.copytree(os.path.join(path, "charts/eric-ctrl-bro"),
+                    os.path.join(path, "charts/eric-ctrl-bro-copy"))
+
+    helm = product_report.HelmChart(path,
+                                    "eric-cloud-native-base",
+                                    sha256sum='ffff',
+                                    include_helm=True)
+    helm.set_config(disable_helm_template=True)
+    helm.parse()
+
+    bro_image = 'armdocker.rnd.ericsson.se/proj-adp-eric-ctrl-bro-drop/eric-ctrl-bro:4.7.0-23'
+    assert [call.args[0] for call in manifest_hash.call_args_list].count(bro_image) == 1
+    assert len(manifest_hash.call_args_list) == 4
+    errors = helm.get_errors()
+    assert errors["eric-cloud-native-base/charts/eric-ctrl-bro"] == \
+        ['Error requesting manifest']
+    assert errors["eric-cloud-native-base/charts/eric-ctrl-bro-copy"] == \
+        ['Error requesting manifest']
+    assert not helm.get_components()[1]
+
+
+@patch('eric_am_package_manager.generator.product_report.DockerApi')
+@patch('eric_am_package_manager.generator.product_report.process_helm_chart')
+def test_report_parallel_charts_in_order(process_helm_chart, docker_api, mock_args):
+    helms = [f'/helm/chart-{index}.tgz' for index in range(4)]
+
+    def process(helm, _, shared_docker_api):
+        assert shared_docker_api is docker_api.return_value
+        index = helms.index(helm)
+        # The first charts finish last
+        time.sleep((len(helms) - index) * 0.01)
+        package = product_report.HelmData(path=helm,
+                                          package=os.path.basename(helm),
+                                          chart_name=f'chart-{index}',
+                                          sha256sum=str(index))
+        return [package], [], {helm: [f'error {index}']}, {}
+
+    process_helm_chart.side_effect = process
+    mock_args.jobs = 4
+
+    with NamedTemporaryFile() as temp:
+        mock_args.product_report = temp.name
+        with pytest.raises(product_report.ProductReportError):
+            product_report.create_product_report(mock_args, helms)
+        report = load_yaml_file(temp.name)
+
+    assert [p['chart_name'] for p in report['includes']['packages']] == \
+        [f'chart-{index}' for index in range(4)]
+
+
+@patch('eric_am_package_manager.generator.docker_api.DockerApi.get_manifest_hash')
+@patch('eric_am_package_manager.generator.docker_api.DockerConfig.parse_config')
+@patch('eric_am_package_manager.generator.docker_api.DockerApi.get_labels')
+@patch('eric_am_package_manager.generator.product_report.ImageData.from_labels')
+@patch('eric_am_package_manager.generator.helm_utils.check_output')
+def test_helm_template_reused(check_output, docker, labels, config, manifest_hash):
+    render_once('cafe', 'helm3', '--debug --values a.yaml,b.yaml', lambda: RENDERED_CLOUD_NATIVE_BASE)
+    path = os.path.join(RESOURCES, "helmdirs/eric-cloud-native-base")
+
+    helm = product_report.HelmChart(path,
+                                    "eric-cloud-native-base",
+                                    sha256sum='cafe',
+                                    include_helm=True)
+    helm.set_config(helm_options=' --values a.yaml,b.yaml --debug')
+    helm.parse()
+
+    check_output.assert_not_called()
+    # pylint: disable=protected-access
+    assert template_names(helm._get_template())[-1] == 'eric-cloud-native-base'
+
+
+@patch('eric_am_package_manager.generator.helm_utils.check_output')
+def test_helm_template_rendered_once_concurrently(check_output):
+    rendering = threading.Event()
+
+    def render():
+        rendering.set()
+        time.sleep(0.1)
+        return RENDERED_CLOUD_NATIVE_BASE
+
+    # The images of the chart are being collected while the report is generated
+    collecting = threading.Thread(target=render_once, args=('beef', 'helm3', '', render))
+    collecting.start()
+    rendering.wait()
+    path = os.path.join(RESOURCES, "helmdirs/eric-cloud-native-base")
+    helm = product_report.HelmChart(path,
+                                    "eric-cloud-native-base",
+                                    sha256sum='beef',
+                                    include_helm=True)
+    helm.set_config(disable_helm_template=False)
+    helm._parse_helm_template()  # pylint: disable=protected-access
+    collecting.join()
+
+    check_output.assert_not_called()
+    # pylint: disable=protected-access
+    assert template_names(helm._get_template())[-1] == 'eric-cloud-native-base'
+
+
+@patch('eric_am_package_manager.generator.docker_api.DockerConfig.parse_config')
+@patch('eric_am_package_manager.generator.docker_api.DockerConfig.get_credentials')
+@patch('eric_am_package_manager.generator.docker_api.requests.get')
+def test_docker_api_responses_reused(get, credentials, config):
+    manifest = MagicMock(content=b'{"config": {"digest": "sha256:abcd", "mediaType": "json"}}')
+    blob = MagicMock()
+    blob.json.return_value = {'config': {'Labels': {'com.ericsson.product-number': 'CXC 1'}}}
+    get.side_effect = [manifest, blob, manifest, blob]
+    image = 'armdocker.rnd.ericsson.se/proj-reuse/eric-reuse:1.0.0-1'
+
+    docker_api = DockerApi('')
+    for _ in range(2):
+        assert docker_api.get_manifest_hash(image) == hashlib.sha256(manifest.content).hexdigest()
+        assert docker_api.get_labels(image) == {'com.ericsson.product-number': 'CXC 1'}
+    assert get.call_count == 2
+
+    # Not shared with other clients, e.g. ones with other credentials
+    other_docker_api = DockerApi('')
+    assert other_docker_api.get_labels(image) == {'com.ericsson.product-number': 'CXC 1'}
+    assert get.call_count == 4
+    # pylint: disable=protected-access
+    assert not any(isinstance(content, MagicMock) for content in docker_api._manifest_cache.values())
+
+
+@patch('eric_am_package_manager.generator.product_report.write_product_report')
+@patch('eric_am_package_manager.generator.product_report.collect_product_report')
+def test_directory_product_report(collect_product_report, write_product_report,
+                                  mock_args, tmp_path):
+    charts_dir = tmp_path / 'Definitions' / 'OtherTemplates'
+    charts_dir.mkdir(parents=True)
+    (charts_dir / 'b-1.0.0.tgz').write_bytes(b'b')
+    (charts_dir / 'a-1.0.0.tgz').write_bytes(b'a')
+    (charts_dir / 'values.yaml').write_text('')
+    (tmp_path / 'Files').mkdir()
+    (tmp_path / 'Files' / 'images.txt').write_text('image:1.0.0')
+    mock_args.helm = ['a-1.0.0.tgz', 'b-1.0.0.tgz']
+    mock_args.helmfile = None
+
+    product_report.directory_product_report(mock_args, str(tmp_path))
+
+    collect_product_report.assert_called_once_with(
+        mock_args, [str(charts_dir / 'a-1.0.0.tgz'), str(charts_dir / 'b-1.0.0.tgz')])
+    write_product_report.assert_called_once_with(
+        mock_args, collect_product_report.return_value, 'image:1.0.0')
+
+
+@patch('eric_am_package_manager.generator.docker_api.DockerApi.get_manifest_hash')
+@patch('eric_am_package_manager.generator.docker_api.DockerConfig.parse_config')
+@patch('eric_am_package_manager.generator.docker_api.DockerApi.get_labels')
+@patch.dict(helm_utils._ANALYSIS_CACHE, clear=True)
+def test_identical_subcharts_parsed_once(labels, config, manifest_hash, tmp_path):
+    manifest_hash.side_effect = DockerApiError(404, 'Error requesting manifest')
+    source = os.path.join(RESOURCES, "helmdirs/eric-cloud-native-base")
+    parse_chart_metadata = helm_utils.HelmChart._parse_chart_metadata
+
+    errors = {}
+    with patch.object(helm_utils.HelmChart, '_parse_chart_metadata', autospec=True,
+                      side_effect=parse_chart_metadata) as parse:
+        for name in ('eric-app-1', 'eric-app-2'):
+            path = os.path.join(tmp_path, name)
+            shutil.copytree(source, path)
+            helm = product_report.HelmChart(path, name, sha256sum='ffff', include_helm=True)
+            helm.set_config(disable_helm_template=True)
+            helm.parse()
+            errors.update(helm.get_errors())
+
+    # Two umbrella charts and their two subcharts once
+    assert parse.call_count == 4
+    assert errors["eric-app-2/charts/eric-ctrl-bro"] == ['Error requesting manifest']
+    assert len(errors) == 4
+
+
+
+def test_copied_chart_errors_report_copy_path():
+    helm = product_report.HelmChart('crd', 'eric-app-1/eric-crd/crd-1.0.0.tgz', 'ffff',
+                                    include_helm=True)
+    helm.chart = {'name': 'crd', 'version': '1.0.0'}
+    helm.eric_product_info = {}
+    helm._process_chart_metadata()  # pylint: disable=protected-access
+
+    copy = helm._copy_for('eric-app-2/eric-crd/crd.tgz')  # pylint: disable=protected-access
+
+    [message] = copy.get_errors()['eric-app-2/eric-crd/crd.tgz']
+    assert 'package: crd.tgz' in message
+    assert 'crd-1.0.0.tgz' not in message
+    assert 'package: crd-1.0.0.tgz' in helm.get_errors()['eric-app-1/eric-crd/crd-1.0.0.tgz'][0]
+
 def test_remove_duplicate_images_with_same_sha():
     image = product_report.ImageData(
         image='armdocker.rnd.ericsson.se/proj-common-assets-cd/security/'
@@ -491,5 +803,14 @@ def test_remove_duplicate_images_with_same_sha():
     assert len(components["images"]) == 1
 
 
+def test_image_data_from_labels_with_registry_port():
+    labels = {'com.ericsson.product-number': 'CXC 123', 'org.opencontainers.image.version': '1.0.0'}
+    image_data = helm_utils.ImageData.from_labels('localhost:5000/proj/name:1.0.0-1', labels, 'abc')
+
+    assert (image_data['image_name'], image_data['image_tag']) == ('name', '1.0.0-1')
+    assert DockerApi.get_path_components('localhost:5000/proj/name:1.0.0-1') == \
+        ('localhost:5000', 'proj/name', '1.0.0-1')
+
+
 if __name__ == "__main__":
     sys.exit(pytest.main(["-v --doctest-modules", __file__]))